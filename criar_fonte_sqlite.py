@@ -0,0 +1,58 @@
+"""
+Cria um banco SQLite com as OS de churn, para usar ou testar a fonte SQL do painel.
+
+Copia as linhas de churn_2024.xlsx e churn_2025.xlsx da pasta do conjunto de dados para a tabela
+informada de um banco SQLite (as datas ficam como texto 'AAAA-MM-DD HH:MM:SS', que o SQLite
+compara em ordem cronológica). Com --ativar, grava também o arquivo de configuração da fonte SQL
+(sql_source_config_file) na pasta: a partir daí o painel lê as OS do banco, em cargas
+incrementais, no lugar dos arquivos .xlsx de churn.
+
+Uso:
+    python criar_fonte_sqlite.py [--dataset NOME] [--banco churn.db] [--tabela os_churn] [--ativar]
+"""
+import argparse
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+import dashboard_churn as dc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cria um banco SQLite com as OS de churn dos arquivos .xlsx.")
+    parser.add_argument('--dataset', default=None, help="Nome do conjunto de dados no catálogo (padrão: o primeiro).")
+    parser.add_argument('--banco', default='churn.db', help="Arquivo do banco, relativo à pasta do conjunto.")
+    parser.add_argument('--tabela', default='os_churn')
+    parser.add_argument('--ativar', action='store_true', help=f"Grava '{dc.sql_source_config_file}' para o painel usar o banco.")
+    args = parser.parse_args()
+
+    catalog = dc.load_dataset_catalog(dc.datasets_config_file)
+    dataset_name = args.dataset or next(iter(catalog))
+    if dataset_name not in catalog:
+        raise SystemExit(f"Conjunto de dados '{dataset_name}' não encontrado. Disponíveis: {', '.join(catalog)}.")
+    data_folder = catalog[dataset_name]
+
+    df_rows = pd.concat(
+        [pd.read_excel(os.path.join(data_folder, file_name)) for file_name in [dc.file_2024, dc.file_2025]],
+        ignore_index=True
+    )
+    database_path = os.path.join(data_folder, args.banco)
+    with sqlite3.connect(database_path) as conn:
+        df_rows.to_sql(args.tabela, conn, if_exists='replace', index=False, chunksize=dc.sql_fetch_chunk_rows)
+        for column in dc.sql_watermark_columns:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{args.tabela}_{column}" ON "{args.tabela}" ("{column}")')
+    print(f"{len(df_rows)} OS gravadas na tabela '{args.tabela}' de '{database_path}'.")
+
+    config = {'banco': args.banco, 'consulta': f'SELECT * FROM "{args.tabela}"'}
+    if args.ativar:
+        with open(os.path.join(data_folder, dc.sql_source_config_file), 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+        print(f"Fonte SQL ativada em '{os.path.join(data_folder, dc.sql_source_config_file)}'.")
+    else:
+        print(f"Para usar o banco no painel, grave em '{dc.sql_source_config_file}': {json.dumps(config, ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    main()
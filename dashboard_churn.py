@@ -1,8 +1,22 @@
 import pandas as pd
+import numpy as np
 import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import functools
+import tempfile
+import zipfile
+import threading
+import queue
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import plotly.express as px
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import io
 
 # --- 1. Configurações e Caminhos ---
@@ -17,79 +31,679 @@ file_backlog_churn = 'backlog_churn.xlsx'
 
 # NOVO: Caminho para o arquivo de projeções OTL
 otl_projections_file = 'otl_churn.xlsx'
-
-# --- Função para Carregar Projeções OTL do Excel ---
-@st.cache_data
-def load_otl_projections_from_excel(filepath):
+# Metas OTL em tabela longa: uma meta por mês, segmento (Tipo de Cliente ou 'Geral') e métrica
+otl_target_columns = ['Mes', 'Segmento', 'Metrica', 'Valor']
+otl_target_index = ['Metrica', 'Segmento', 'Ano', 'Mes']
+otl_total_segment = 'Geral'
+otl_metric_aliases = {'OTL Churn Op': 'OTL Churn Operacional'}
+otl_stock_metrics = ['OTL Backlog'] # Estoque no fim do mês: sem acumulado nem saldo anual
+
+# Hierarquia comercial opcional: uma linha por Filial com a Regional e a Diretoria. É juntada às OS
+# uma vez na carga e os volumes mensais são pré-calculados em todos os níveis. Filiais fora do
+# arquivo ficam em hierarchy_unmapped_label; sem o arquivo, a aba de hierarquia fica sem dados.
+hierarchy_file = 'hierarquia_filiais.xlsx'
+hierarchy_levels = ['Diretoria', 'Regional', 'Filial'] # Do nível mais alto ao mais baixo
+hierarchy_national_label = 'Nacional'
+hierarchy_unmapped_label = 'Sem Regional'
+hierarchy_measure_keys = ['Ano Churn', 'Mes Churn', 'Tipo de Cliente', 'Tipo de Churn']
+
+# Fonte SQL opcional das OS de churn, no lugar de churn_2024.xlsx e churn_2025.xlsx: arquivo JSON
+# na pasta do conjunto com o banco SQLite e a consulta ({"banco": "churn.db", "consulta": "SELECT ..."}).
+# A carga é incremental, pela marca d'água das datas de criação e de desinstalação da OS.
+sql_source_config_file = 'fonte_sql.json'
+sql_state_file = 'fonte_sql_estado.pkl' # OS já lidas e marca d'água, dentro de dataset_cache_subdir
+sql_watermark_columns = ['Datacriacaoos', 'DATADESINSTALACAO']
+sql_fetch_chunk_rows = 20_000
+sql_pool_size = 4
+sql_poll_interval_seconds = 30 # Intervalo mínimo entre as consultas que verificam se há OS novas
+
+# Eventos de churn do dia: OS acrescentadas ao longo do dia a um arquivo JSON Lines ou CSV na pasta
+# do conjunto (o primeiro que existir). Só as linhas novas são lidas, em micro-lotes, e somadas aos
+# agregados mensais em cache, sem recarregar o conjunto; a próxima carga completa as absorve.
+churn_event_files = ['eventos_churn.jsonl', 'eventos_churn.csv']
+churn_event_batch_max_bytes = 4 * 1024 * 1024 # Máximo lido do arquivo por micro-lote
+churn_event_refresh_seconds = int(os.environ.get('CHURN_EVENT_REFRESH_S', '60')) # Verificação automática (0 desliga)
+
+# Arquivos que definem a versão de um conjunto de dados (e, com ela, a validade dos caches)
+dataset_version_files = [file_2024, file_2025, file_active_base, file_backlog_churn, otl_projections_file, sql_source_config_file, hierarchy_file]
+
+# Vários conjuntos de dados no mesmo servidor: catálogo opcional {"nome": "pasta"}, escolhido
+# pelo parâmetro de URL ?dataset=nome. Sem catálogo, só existe o conjunto padrão em data_dir.
+datasets_config_file = 'datasets.json'
+default_dataset_name = 'padrao'
+dataset_cache_subdir = '.churn_cache' # Cache em disco de cada conjunto, dentro da sua pasta
+memory_budget_mb = int(os.environ.get('CHURN_MEMORY_BUDGET_MB', '2048')) # Orçamento global de memória
+
+# Exportação: formatos oferecidos (extensão, MIME), linhas por lote e limite do arquivo em memória
+export_formats = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'XLSX': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+}
+export_chunk_rows = 50_000
+export_spool_max_bytes = 32 * 1024 * 1024 # Acima disso o arquivo gerado vai para o disco
+xlsx_max_rows_per_sheet = 1_048_575 # Limite do Excel, sem contar o cabeçalho
+
+# Snapshot de KPIs materializado por materializar_snapshot.py (dentro do cache de cada conjunto)
+snapshot_file = 'snapshot_kpis.pkl.gz'
+snapshot_format_version = 3 # Muda quando o formato ou o cálculo dos resultados muda: snapshots antigos deixam de valer
+
+# Métricas de cache: arquivo no formato texto do Prometheus (lido por um coletor local)
+metrics_file = os.environ.get('CHURN_METRICS_FILE', 'churn_cache_metrics.prom')
+
+# Orçamento de inicialização, conferido por verificar_inicializacao.py. plotly.express e openpyxl
+# só são importados nos trechos que desenham gráficos ou leem/gravam Excel.
+import_time_budget_seconds = float(os.environ.get('CHURN_IMPORT_BUDGET_S', '2.0'))
+first_render_budget_seconds = float(os.environ.get('CHURN_FIRST_RENDER_BUDGET_S', '60'))
+deferred_modules = ['plotly.express', 'openpyxl']
+
+# Resultados por seleção compartilhados entre as sessões e pré-cálculo especulativo das seleções
+# vizinhas (mês anterior/seguinte, cada Tipo de Cliente) depois de cada renderização
+result_cache_max_entries = 256
+prefetch_enabled = os.environ.get('CHURN_PREFETCH', '1') == '1'
+prefetch_workers = 2
+prefetch_max_selections = 8
+
+month_order_num_pt = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
+                      "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
+month_abbr_order_pt = ["Jan", "Fev", "Mar", "Abr", "Mai", "Jun",
+                       "Jul", "Ago", "Set", "Out", "Nov", "Dez"]
+month_to_abbr_map = dict(zip(month_order_num_pt, month_abbr_order_pt))
+
+# Colunas que identificam uma OS (nomes originais dos arquivos), usadas na deduplicação
+os_identity_columns = ['Numos', 'Nroitemos']
+
+# Validação das OS de churn (nomes originais das colunas), na mesma passada da conversão: datas
+# inválidas, códigos de Formajuridica desconhecidos, colunas obrigatórias vazias e status fora da
+# lista vão para a quarentena (load_report['quarantine']) com o motivo, em vez de sumirem em silêncio.
+# Formajuridica vazia é PF. Tirar 'obrigatoria' de uma coluna devolve essas OS às análises.
+churn_concluded_status = 'Concluído'
+churn_expected_statuses = ['Concluído', 'Cancelado', 'Em processamento']
+legal_form_client_types = {'': 'PF', 'P1': 'PME', 'C1': 'Corporativo', 'PF': 'PF', 'PME': 'PME', 'CORPORATIVO': 'Corporativo'}
+churn_row_schema = {
+    'Datacriacaoos': {'tipo': 'data'},
+    'DATADESINSTALACAO': {'tipo': 'data', 'obrigatoria': True},
+    'Formajuridica': {'tipo': 'codigo', 'valores': list(legal_form_client_types)},
+    'Filialos': {'tipo': 'texto', 'obrigatoria': True}
+}
+
+# Dimensões para as quais as séries mensais de churn são projetadas de uma só vez
+forecast_dimensions = ['Tipo de Cliente', 'Tipo de Churn', 'Filial']
+forecast_interval_z = 1.96 # Intervalo de ~95% para as projeções
+
+# Tempo entre a criação da OS e a desinstalação: histograma diário até lead_time_max_days,
+# mais uma faixa para valores negativos e outra para valores acima do limite
+lead_time_max_days = 365
+lead_time_display_edges = [0, 1, 3, 7, 15, 30, 60, 90, 180, 365]
+lead_time_percentiles = [0.5, 0.75, 0.9, 0.95]
+
+# Detalhamento de OS: chave do índice ordenado, colunas exibidas por padrão e tamanhos de página
+drilldown_index_columns = ['AnoMes', 'Filial', 'Tipo de Churn']
+drilldown_default_columns = ['Numos', 'Contrato', 'AnoMes', 'Filial', 'Tipo de Cliente', 'Tipo de Churn',
+                             'Categoria4_Motivo', 'Data de Criacao da OS', 'Data de Desinstalacao', 'Status da OS']
+drilldown_page_sizes = [25, 50, 100, 250]
+
+# Categorias de alta cardinalidade (filiais, motivos, tipos de churn): gráficos e tabelas mostram as
+# top_n_default de maior volume e somam as demais em "Outros" (N ajustável na página). Tabelas
+# completas são paginadas e gráficos de linha a partir de webgl_min_points pontos usam WebGL.
+top_n_default = 15
+top_n_other_label = 'Outros'
+table_page_sizes = [25, 50, 100, 250]
+webgl_min_points = 1000
+
+# Consultas por período: segmentos com contagens diárias acumuladas e início do ano fiscal
+date_range_segment_columns = ['Tipo de Cliente', 'Tipo de Churn', 'Filial']
+fiscal_year_start_month = 1
+date_range_presets = ["Personalizado", "Semana até a data", "Últimos 30 dias", "Últimos 90 dias", "Ano fiscal até a data"]
+
+# Alertas de churn: z-score robusto de cada série (Filial x Motivo x Tipo de Cliente x Tipo de Churn)
+# contra a mediana e o MAD dos meses anteriores. Limiar 3,5 (Iglewicz e Hoaglin).
+anomaly_dimensions = ['Filial', 'Categoria4_Motivo', 'Tipo de Cliente', 'Tipo de Churn']
+anomaly_baseline_months = 12 # Janela de referência antes de cada mês
+anomaly_min_history = 6 # Meses de referência exigidos para avaliar um mês
+anomaly_z_threshold = 3.5
+anomaly_min_volume = 5 # Volume mínimo no mês para gerar alerta (evita ruído de séries pequenas)
+
+# Tabela mensal de fatos: chave, prefixo das colunas de churn por tipo e metas OTL do mês corrente
+fact_table_keys = ['Ano', 'Mes', 'Tipo de Cliente']
+fact_churn_prefix = 'Churn: '
+fact_otl_columns = ['OTL Churn', 'OTL Churn Operacional', 'OTL Backlog']
+
+# Churn LTM (últimos 12 meses): janela móvel e dimensões com uma série por valor
+ltm_window_months = 12
+ltm_dimensions = ['Tipo de Cliente', 'Tipo de Churn', 'Filial']
+
+# Simulador de cenários: reduções por motivo (Categoria4_Motivo) e por Tipo de Churn, com faixas
+# de Monte Carlo (meses reamostrados e efeito realizado entre 1 -/+ spread da redução planejada)
+scenario_simulations = 2000
+scenario_effect_spread = 0.5
+scenario_band_percentiles = [5, 50, 95]
+scenario_sweep_steps = 11 # Pontos da curva de 0% a 100% do cenário configurado
+scenario_seed = 0
+
+# --- Versão do Conjunto de Dados ---
+def get_dataset_version(data_folder, filenames):
     """
-    Carrega as projeções OTL de um arquivo Excel (.xlsx) no formato especificado.
-    Espera duas colunas: 'OTL' (nomes das projeções) e 'Valores' (os valores).
+    Gera uma assinatura curta do conjunto de dados a partir da pasta, do tamanho e da data de
+    modificação dos arquivos de origem. Muda sempre que algum arquivo é atualizado,
+    e por isso é usada como chave dos caches derivados dos dados.
     """
-    otl_values = {
-        'OTL Churn': 0,
-        'OTL Churn Operacional': 0, # This is the key we want to map to
-        'OTL Backlog': 0
-    }
-    
-    if os.path.exists(filepath):
+    # O esquema de validação também entra: mudá-lo refaz a carga (e a quarentena) do conjunto
+    parts = [os.path.abspath(data_folder), json.dumps([churn_row_schema, churn_expected_statuses], sort_keys=True)]
+    for filename in filenames:
+        path = os.path.join(data_folder, filename)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}")
+        else:
+            parts.append(f"{filename}:ausente")
+    # Com fonte SQL, a versão acompanha também a contagem e as maiores datas das OS no banco
+    sql_source = get_sql_churn_source(data_folder)
+    if sql_source is not None:
         try:
-            df_otl = pd.read_excel(filepath)
-            
-            # Normalize column names to make them easier to match
-            df_otl.columns = [col.strip() for col in df_otl.columns] 
-            
-            # Check if the expected columns exist before trying to rename
-            if 'OTL' in df_otl.columns and 'Valores' in df_otl.columns:
-                df_otl.set_index('OTL', inplace=True)
-                
-                for key_expected in otl_values.keys():
-                    # Check for direct match or variations like 'OTL Churn Op'
-                    if key_expected in df_otl.index:
-                        otl_values[key_expected] = int(df_otl.loc[key_expected, 'Valores'])
-                    elif key_expected == 'OTL Churn Operacional':
-                        # Check for 'OTL Churn Op' specifically
-                        if 'OTL Churn Op' in df_otl.index:
-                            otl_values['OTL Churn Operacional'] = int(df_otl.loc['OTL Churn Op', 'Valores'])
+            parts.append(f"sql:{sql_source.probe()}")
+        except sqlite3.Error as e:
+            parts.append(f"sql:indisponível:{e}")
+    return hashlib.md5("|".join(parts).encode('utf-8')).hexdigest()[:12]
+
+# --- Métricas de Cache e Memória ---
+def estimate_object_size(value):
+    """Estimativa (em bytes) da memória ocupada por um resultado em cache."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_object_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_object_size(item) for item in value)
+    return sys.getsizeof(value)
+
+class CacheMetrics:
+    """
+    Contadores de chamadas, falhas, descartes e tempo de carga de cada cache, mais o tamanho
+    residente de cada entrada. Acertos não são contados à parte: são as chamadas menos as falhas,
+    o que mantém todos os contadores exportados só crescendo. Um único objeto por servidor (ver
+    get_cache_metrics), protegido por lock porque as sessões rodam em threads diferentes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {} # cache -> calls, misses, evictions, load_seconds, last_load_seconds, storage
+        self.entry_sizes = {} # cache -> {chave: bytes}, da entrada usada há mais tempo para a mais recente
+        self.timings = {} # etapa da renderização -> first, last, max, count (segundos)
+
+    def _counter(self, cache_name, storage=None):
+        counter = self.counters.setdefault(cache_name, {
+            'calls': 0, 'misses': 0, 'evictions': 0, 'load_seconds': 0.0, 'last_load_seconds': 0.0, 'storage': storage
+        })
+        if storage is not None:
+            counter['storage'] = storage
+        return counter
+
+    def record_call(self, cache_name, storage=None, missed=False, key=None):
+        # Chamada e falha entram juntas, no fim da chamada, para acertos (chamadas - falhas) nunca recuarem
+        with self._lock:
+            counter = self._counter(cache_name, storage)
+            counter['calls'] += 1
+            counter['misses'] += int(missed)
+            sizes = self.entry_sizes.get(cache_name, {})
+            if key is not None and key in sizes:
+                sizes[key] = sizes.pop(key) # Entrada usada agora passa a ser a mais recente
+
+    def record_load(self, cache_name, key, seconds, size_bytes, max_entries=None):
+        # Com max_entries, o Streamlit descarta a entrada usada há mais tempo; o mesmo vale aqui
+        with self._lock:
+            counter = self._counter(cache_name)
+            counter['load_seconds'] += seconds
+            counter['last_load_seconds'] = seconds
+            sizes = self.entry_sizes.setdefault(cache_name, {})
+            sizes.pop(key, None)
+            sizes[key] = size_bytes
+            while max_entries is not None and len(sizes) > max_entries:
+                sizes.pop(next(iter(sizes)))
+                counter['evictions'] += 1
+
+    def record_eviction(self, cache_name, key=None):
+        with self._lock:
+            self._counter(cache_name)['evictions'] += 1
+            sizes = self.entry_sizes.get(cache_name, {})
+            if key is None:
+                sizes.clear()
             else:
-                st.warning(f"AVISO: Colunas 'OTL' ou 'Valores' não encontradas no arquivo '{filepath}'. Verifique o formato.")
-            
-        except FileNotFoundError:
-            st.warning(f"AVISO: Arquivo '{filepath}' não encontrado. As projeções OTL não serão exibidas.")
-        except Exception as e:
-            st.error(f"ERRO: Problema ao carregar ou ler dados do arquivo OTL. Verifique o formato. Detalhes: {e}")
-    else:
-        st.warning(f"AVISO: Arquivo '{filepath}' não encontrado. As projeções OTL não serão exibidas.")
-        
-    return otl_values
+                sizes.pop(key, None)
+
+    def record_timing(self, stage, seconds):
+        # A primeira medição do processo é a renderização a frio
+        with self._lock:
+            timing = self.timings.setdefault(stage, {'first': seconds, 'last': 0.0, 'max': 0.0, 'count': 0})
+            timing['last'] = seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['count'] += 1
+
+    def timing_summary(self):
+        """Tabela com o tempo de cada etapa da renderização (primeira execução, última e pior caso)."""
+        with self._lock:
+            return pd.DataFrame(
+                [{'Etapa': stage, 'Primeira (s)': round(t['first'], 3), 'Última (s)': round(t['last'], 3),
+                  'Máxima (s)': round(t['max'], 3), 'Execuções': t['count']} for stage, t in self.timings.items()],
+                columns=['Etapa', 'Primeira (s)', 'Última (s)', 'Máxima (s)', 'Execuções']
+            )
+
+    def summary(self):
+        """Tabela com uma linha por cache, para o painel de administração."""
+        with self._lock:
+            rows = []
+            for cache_name, counter in self.counters.items():
+                calls = counter['calls']
+                hits = calls - counter['misses']
+                sizes = self.entry_sizes.get(cache_name, {})
+                rows.append({
+                    'Cache': cache_name,
+                    'Armazenamento': counter['storage'],
+                    'Entradas': len(sizes),
+                    'Memória (MB)': round(sum(sizes.values()) / 1024 / 1024, 2),
+                    'Acertos': hits,
+                    'Falhas': counter['misses'],
+                    'Taxa de Acerto': round(hits / calls, 3) if calls else None,
+                    'Descartes': counter['evictions'],
+                    'Carga Total (s)': round(counter['load_seconds'], 3),
+                    'Última Carga (s)': round(counter['last_load_seconds'], 3)
+                })
+            return pd.DataFrame(rows)
+
+    def entries(self):
+        """Tabela com o tamanho residente de cada entrada de cada cache."""
+        with self._lock:
+            return pd.DataFrame(
+                [{'Cache': cache_name, 'Chave': key, 'Memória (MB)': round(size / 1024 / 1024, 3)}
+                 for cache_name, sizes in self.entry_sizes.items() for key, size in sizes.items()],
+                columns=['Cache', 'Chave', 'Memória (MB)']
+            )
+
+    def to_prometheus(self, memory_budget_bytes):
+        """Exporta as métricas no formato texto do Prometheus."""
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        metric_specs = [
+            ('churn_cache_calls_total', 'counter', 'Chamadas ao cache.', lambda counter: counter['calls']),
+            ('churn_cache_hits_total', 'counter', 'Chamadas atendidas pelo cache (chamadas - falhas).', lambda counter: counter['calls'] - counter['misses']),
+            ('churn_cache_misses_total', 'counter', 'Chamadas que precisaram calcular ou carregar o valor.', lambda counter: counter['misses']),
+            ('churn_cache_evictions_total', 'counter', 'Entradas descartadas do cache.', lambda counter: counter['evictions']),
+            ('churn_cache_load_seconds_total', 'counter', 'Tempo total gasto em cargas, em segundos.', lambda counter: counter['load_seconds']),
+            ('churn_cache_last_load_seconds', 'gauge', 'Duração da última carga, em segundos.', lambda counter: counter['last_load_seconds'])
+        ]
+        with self._lock:
+            lines = []
+            for metric_name, metric_type, help_text, value in metric_specs:
+                lines += [f"# HELP {metric_name} {help_text}", f"# TYPE {metric_name} {metric_type}"]
+                lines += [f'{metric_name}{{cache="{label(name)}"}} {value(counter)}' for name, counter in self.counters.items()]
+            lines += ["# HELP churn_cache_entries Entradas residentes no cache.", "# TYPE churn_cache_entries gauge"]
+            lines += [f'churn_cache_entries{{cache="{label(name)}"}} {len(self.entry_sizes.get(name, {}))}' for name in self.counters]
+            lines += ["# HELP churn_cache_resident_bytes Memória estimada de cada entrada do cache.", "# TYPE churn_cache_resident_bytes gauge"]
+            lines += [f'churn_cache_resident_bytes{{cache="{label(name)}",key="{label(key)}"}} {size}'
+                      for name, sizes in self.entry_sizes.items() for key, size in sizes.items()]
+            lines += ["# HELP churn_memory_budget_bytes Orçamento global de memória dos conjuntos de dados.", "# TYPE churn_memory_budget_bytes gauge",
+                      f"churn_memory_budget_bytes {memory_budget_bytes}"]
+            lines += ["# HELP churn_render_seconds Duração de cada etapa da renderização, em segundos.", "# TYPE churn_render_seconds gauge"]
+            lines += [f'churn_render_seconds{{stage="{label(stage)}",measure="{measure}"}} {t[measure]}'
+                      for stage, t in self.timings.items() for measure in ('first', 'last', 'max')]
+            return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path, memory_budget_bytes):
+        """Grava o arquivo de métricas de forma atômica (arquivo temporário + os.replace)."""
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus(memory_budget_bytes))
+        os.replace(temp_path, path)
+
+@st.cache_resource(show_spinner=False)
+def get_cache_metrics():
+    """Métricas de cache únicas por servidor, preservadas entre os reruns do script."""
+    return CacheMetrics()
+
+def instrumented_cache(cache_decorator, storage='cache_data', max_entries=None):
+    """
+    Aplica um decorador de cache do Streamlit (st.cache_data / st.cache_resource) registrando
+    em get_cache_metrics() as chamadas, as falhas (com duração e tamanho do resultado) e os
+    descartes feitos por .clear(). A chave de cada entrada são os argumentos que o Streamlit
+    considera no hash (os que não começam com '_'). max_entries deve repetir o do decorador:
+    o Streamlit não avisa quando descarta a entrada usada há mais tempo, então o descarte é
+    reproduzido nas métricas para o tamanho residente não crescer sem limite.
+    .clear_version(versão) descarta as entradas cujo argumento dataset_version é a versão
+    (inclusive com os eventos do dia, "versão+e..."), qualquer que seja o resto da chave.
+    """
+    def decorator(func):
+        cache_name = func.__name__
+        signature = inspect.signature(func)
+        # Pilha por thread de chamadas em andamento: o loader marca a chamada do topo como falha
+        calls_in_progress = threading.local()
+        # Argumentos do hash de cada entrada carregada (chave -> argumentos), do uso mais antigo ao mais recente
+        loaded_arguments = OrderedDict()
+        loaded_arguments_lock = threading.Lock()
+
+        def hashed_arguments(args, kwargs):
+            bound = signature.bind_partial(*args, **kwargs)
+            return {name: value for name, value in bound.arguments.items() if not name.startswith('_')}
+
+        def entry_key(args, kwargs):
+            return ", ".join(f"{name}={value!r}" for name, value in hashed_arguments(args, kwargs).items())
+
+        @functools.wraps(func)
+        def loader(*args, **kwargs):
+            calls_in_progress.stack[-1] = True
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            key = entry_key(args, kwargs)
+            get_cache_metrics().record_load(cache_name, key, time.perf_counter() - start, estimate_object_size(result), max_entries)
+            with loaded_arguments_lock:
+                loaded_arguments[key] = hashed_arguments(args, kwargs)
+                loaded_arguments.move_to_end(key)
+                while max_entries is not None and len(loaded_arguments) > max_entries:
+                    loaded_arguments.popitem(last=False)
+            return result
+
+        cached_func = cache_decorator(loader)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not hasattr(calls_in_progress, 'stack'):
+                calls_in_progress.stack = []
+            calls_in_progress.stack.append(False)
+            try:
+                return cached_func(*args, **kwargs)
+            finally:
+                missed = calls_in_progress.stack.pop()
+                key = entry_key(args, kwargs) if max_entries is not None else None
+                if key is not None:
+                    with loaded_arguments_lock:
+                        if key in loaded_arguments:
+                            loaded_arguments.move_to_end(key)
+                get_cache_metrics().record_call(cache_name, storage, missed, key)
+
+        def clear(*args, **kwargs):
+            cached_func.clear(*args, **kwargs)
+            key = entry_key(args, kwargs) if args or kwargs else None
+            with loaded_arguments_lock:
+                if key is None:
+                    loaded_arguments.clear()
+                else:
+                    loaded_arguments.pop(key, None)
+            get_cache_metrics().record_eviction(cache_name, key)
+
+        def clear_version(version):
+            with loaded_arguments_lock:
+                stale = [(key, arguments) for key, arguments in loaded_arguments.items()
+                         if arguments.get('dataset_version') == version or str(arguments.get('dataset_version')).startswith(f"{version}+")]
+                for key, _ in stale:
+                    del loaded_arguments[key]
+            for key, arguments in stale:
+                cached_func.clear(**arguments)
+                get_cache_metrics().record_eviction(cache_name, key)
+
+        wrapper.clear = clear
+        wrapper.clear_version = clear_version
+        return wrapper
+    return decorator
+
+# --- Metas OTL (tabela longa por mês, segmento e métrica) ---
+def empty_otl_targets():
+    """Tabela de metas OTL sem linhas, no formato retornado por load_otl_targets."""
+    return pd.DataFrame(
+        {'Valor': pd.Series(dtype=float)},
+        index=pd.MultiIndex.from_arrays([pd.Series(dtype=str), pd.Series(dtype=str), pd.Series(dtype='Int64'), pd.Series(dtype='Int64')], names=otl_target_index)
+    )
+
+@instrumented_cache(st.cache_data(show_spinner=False))
+def load_otl_targets(_filepath, dataset_version):
+    """
+    Lê as metas OTL do arquivo Excel em uma tabela indexada por (Metrica, Segmento, Ano, Mes), com
+    a coluna 'Valor'. Aceita dois formatos:
+      - a tabela longa, uma meta por linha, com as colunas 'Mes' (data ou 'AAAA-MM'), 'Segmento'
+        (Tipo de Cliente ou 'Geral'), 'Metrica' (uma de fact_otl_columns) e 'Valor';
+      - o formato antigo, com as colunas 'OTL' e 'Valores': metas gerais do mês corrente.
+    Mês em branco vale para o mês corrente (ver resolve_otl_targets). Sem arquivo, retorna a tabela
+    vazia. Problemas de formato (colunas ausentes, métricas desconhecidas, meses ou valores
+    inválidos, metas repetidas) geram ValueError com as linhas do Excel afetadas.
+    Em cache por versão do conjunto de dados.
+    """
+    if not os.path.exists(_filepath):
+        return empty_otl_targets()
+    try:
+        df_raw = pd.read_excel(_filepath)
+    except (OSError, zipfile.BadZipFile) as e:
+        raise ValueError(f"não foi possível ler o arquivo: {e}") from e
+    df_raw.columns = [str(column).strip() for column in df_raw.columns]
+    if {'OTL', 'Valores'} <= set(df_raw.columns):
+        df_raw = pd.DataFrame({'Mes': None, 'Segmento': otl_total_segment, 'Metrica': df_raw['OTL'], 'Valor': df_raw['Valores']})
+    missing_columns = [column for column in otl_target_columns if column not in df_raw.columns]
+    if missing_columns:
+        raise ValueError(f"colunas ausentes: {', '.join(missing_columns)}. Esperado {', '.join(otl_target_columns)} "
+                         "(ou o formato antigo, com as colunas 'OTL' e 'Valores').")
+
+    metrics = df_raw['Metrica'].astype(str).str.strip().replace(otl_metric_aliases)
+    segments = df_raw['Segmento'].astype(str).str.strip()
+    segments = segments.mask(df_raw['Segmento'].isna() | (segments.str.lower() == otl_total_segment.lower()), otl_total_segment)
+    values = pd.to_numeric(df_raw['Valor'], errors='coerce')
+    blank_month = df_raw['Mes'].isna() | (df_raw['Mes'].astype(str).str.strip() == '')
+    months = pd.to_datetime(df_raw['Mes'].where(~blank_month), errors='coerce', format='ISO8601')
+    df_targets = pd.DataFrame({
+        'Metrica': metrics,
+        'Segmento': segments,
+        'Ano': months.dt.year.astype('Int64'),
+        'Mes': months.dt.month.astype('Int64'),
+        'Valor': values.astype(float)
+    })
+
+    excel_rows = df_raw.index.to_numpy() + 2 # Linha no Excel (cabeçalho na linha 1)
+    checks = [
+        (~metrics.isin(fact_otl_columns), f"métrica fora de {', '.join(fact_otl_columns)}"),
+        (months.isna() & ~blank_month, "mês inválido (use uma data ou 'AAAA-MM')"),
+        (values.isna(), "valor ausente ou não numérico"),
+        (df_targets.duplicated(otl_target_index, keep=False), "meta repetida para o mesmo mês, segmento e métrica")
+    ]
+    problems = []
+    for invalid, description in checks:
+        if invalid.any():
+            rows = excel_rows[invalid.to_numpy()]
+            problems.append(f"{description}: linha(s) {', '.join(str(row) for row in rows[:10])}{' ...' if len(rows) > 10 else ''}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    return df_targets.set_index(otl_target_index).sort_index()
+
+def resolve_otl_targets(df_otl_targets, current_year, current_month):
+    """
+    Metas com o mês em branco passam a valer para o mês corrente, a menos que a mesma métrica e
+    segmento já tenham meta explícita nesse mês. Retorna as colunas de otl_target_index e 'Valor'.
+    """
+    df_targets = df_otl_targets.reset_index()
+    blank_month = df_targets['Ano'].isna()
+    df_targets.loc[blank_month, 'Ano'] = current_year
+    df_targets.loc[blank_month, 'Mes'] = current_month
+    df_targets = df_targets.astype({'Ano': 'int64', 'Mes': 'int64'})
+    # As metas datadas vêm antes das em branco: em caso de conflito, fica a datada
+    return df_targets.iloc[np.argsort(blank_month.to_numpy(), kind='stable')].drop_duplicates(otl_target_index).reset_index(drop=True)
+
+def current_otl_projections(df_otl_targets, current_year, current_month):
+    """
+    Metas gerais do mês corrente de cada métrica de fact_otl_columns: a meta do segmento 'Geral' ou,
+    sem ela, a soma das metas dos tipos de cliente no mês; 0 quando o mês não tem meta.
+    """
+    df_targets = resolve_otl_targets(df_otl_targets, current_year, current_month)
+    df_month = df_targets[(df_targets['Ano'] == current_year) & (df_targets['Mes'] == current_month)]
+    df_total = df_month[df_month['Segmento'] == otl_total_segment].set_index('Metrica')['Valor']
+    df_by_segment = df_month[df_month['Segmento'] != otl_total_segment].groupby('Metrica')['Valor'].sum()
+    return {metric: df_total.get(metric, df_by_segment.get(metric, 0)) for metric in fact_otl_columns}
+
+# --- Fonte SQL das OS de Churn (conexões reutilizáveis e carga incremental) ---
+class SqlConnectionPool:
+    """
+    Conexões reutilizáveis (somente leitura) com um banco SQLite, no máximo max_connections
+    abertas ao mesmo tempo. Uma conexão que falha é fechada em vez de voltar para o pool.
+    """
+
+    def __init__(self, database, max_connections=sql_pool_size):
+        self.database = database
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True, check_same_thread=False)
+            try:
+                yield conn
+            except Exception:
+                conn.close()
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+@st.cache_resource(show_spinner=False)
+def get_sql_connection_pool(database):
+    """Pool único por banco, compartilhado por todas as sessões do servidor."""
+    return SqlConnectionPool(database)
+
+class SqlChurnSource:
+    """
+    OS de churn lidas de um banco pela consulta de sql_source_config_file. As OS já lidas ficam no
+    cache em disco do conjunto; a cada carga, só as OS criadas ou desinstaladas a partir da marca
+    d'água (a maior data já vista em cada coluna de sql_watermark_columns) são buscadas, em lotes
+    de sql_fetch_chunk_rows, e juntadas às anteriores por deduplicate_service_orders, que mantém
+    a versão mais recente de cada OS. OS apagadas no banco, ou alteradas sem mudar essas datas,
+    só entram numa carga completa (apagando o arquivo sql_state_file).
+    """
+
+    def __init__(self, data_folder, config):
+        self.database = os.path.abspath(os.path.join(data_folder, config['banco']))
+        self.query = config['consulta'].strip().rstrip(';')
+        self.watermark_columns = config.get('colunas_marca_dagua', sql_watermark_columns)
+        self.state_path = os.path.join(data_folder, dataset_cache_subdir, sql_state_file)
+        self.pool = get_sql_connection_pool(self.database)
+        self._probe = (0.0, None)
+        self._lock = threading.Lock()
+
+    def probe(self):
+        """Contagem e maiores datas das OS na fonte, consultadas no máximo a cada sql_poll_interval_seconds."""
+        with self._lock:
+            checked_at, signature = self._probe
+            if signature is None or time.monotonic() - checked_at >= sql_poll_interval_seconds:
+                max_columns = ", ".join(f'MAX("{column}")' for column in self.watermark_columns)
+                with self.pool.connection() as conn:
+                    signature = tuple(conn.execute(f"SELECT COUNT(*), {max_columns} FROM ({self.query}) AS fonte").fetchone())
+                self._probe = (time.monotonic(), signature)
+            return signature
+
+    def pull(self):
+        """
+        Carga incremental (ou completa, na primeira vez ou se a fonte mudou). Retorna as OS com as
+        colunas originais, o resumo da deduplicação e o resumo da carga.
+        """
+        start = time.perf_counter()
+        state = pd.read_pickle(self.state_path) if os.path.exists(self.state_path) else None
+        if state is not None and (state['database'], state['query']) != (self.database, self.query):
+            state = None
+
+        sql = f"SELECT * FROM ({self.query}) AS fonte"
+        params = []
+        if state is not None and state['watermark']:
+            sql += " WHERE " + " OR ".join(f'"{column}" >= ?' for column in state['watermark'])
+            params = list(state['watermark'].values())
+        with self.pool.connection() as conn:
+            chunks = list(pd.read_sql_query(sql, conn, params=params, chunksize=sql_fetch_chunk_rows))
+        df_fetched = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+        frames_by_source = {'fonte_sql (novas)': df_fetched}
+        if state is not None:
+            frames_by_source = {'fonte_sql (cache)': state['rows'], **frames_by_source}
+        df_rows, df_duplicates = deduplicate_service_orders(frames_by_source, os_identity_columns)
+
+        watermark = {}
+        for column in self.watermark_columns:
+            if column in df_rows.columns and df_rows[column].notna().any():
+                value = df_rows[column].dropna().max()
+                watermark[column] = value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        pd.to_pickle({'database': self.database, 'query': self.query, 'watermark': watermark, 'rows': df_rows}, temp_path)
+        os.replace(temp_path, self.state_path)
+
+        df_pull_report = pd.DataFrame([{
+            'Carga': 'Incremental' if state is not None else 'Completa',
+            'OS Buscadas': len(df_fetched),
+            'Lotes': len(chunks),
+            'OS na Base': len(df_rows),
+            'Segundos': round(time.perf_counter() - start, 3)
+        }])
+        return df_rows, df_duplicates, df_pull_report
+
+@st.cache_resource(show_spinner=False)
+def load_sql_churn_source(data_folder, config_mtime_ns):
+    """Fonte SQL configurada na pasta, recriada quando o arquivo de configuração muda."""
+    with open(os.path.join(data_folder, sql_source_config_file), encoding='utf-8') as f:
+        return SqlChurnSource(data_folder, json.load(f))
+
+def get_sql_churn_source(data_folder):
+    """Fonte SQL do conjunto de dados, ou None se a pasta não tem sql_source_config_file."""
+    config_path = os.path.join(data_folder, sql_source_config_file)
+    if not os.path.exists(config_path):
+        return None
+    return load_sql_churn_source(os.path.abspath(data_folder), os.stat(config_path).st_mtime_ns)
 
 # --- Função para Carregar e Transformar Dados de Churn e Base Ativa ---
-@st.cache_data
 def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base, file_backlog_churn):
     """
     Carrega e combina os dados de churn de diferentes anos, a base ativa e o backlog,
     aplicando todas as transformações necessárias.
+    O cache fica a cargo do DatasetRegistry, que controla a memória de todos os conjuntos de dados.
+    Além dos três DataFrames, retorna um dicionário load_report com os resumos da carga
+    (ex.: 'duplicates', com as OS duplicadas removidas por arquivo; 'quarantine', com as OS que
+    falharam na validação e o motivo; 'active_quarantine', com as linhas da base ativa sem data ou
+    volume válidos; com o arquivo de hierarquia, 'hierarchy_unmapped', com as filiais fora dele;
+    com fonte SQL, 'sql', com o resumo da carga incremental; e 'warnings', com os avisos da carga,
+    exibidos pelo main() em toda sessão, inclusive quando o conjunto vem do cache em disco).
     """
     df_churn = pd.DataFrame()
     df_combined = pd.DataFrame()
     df_active_processed = pd.DataFrame()
     df_backlog_processed = pd.DataFrame()
+    load_report = {'warnings': []}
 
     # Carregamento e transformação dos dados de CHURN
     try:
-        df_2024 = pd.read_excel(os.path.join(data_folder, file_2024))
-        df_2025 = pd.read_excel(os.path.join(data_folder, file_2025))
-        df_combined = pd.concat([df_2024, df_2025], ignore_index=True)
+        sql_source = get_sql_churn_source(data_folder)
+        if sql_source is not None:
+            # OS vindas do banco (só as novas ou alteradas desde a última carga)
+            df_combined, load_report['duplicates'], load_report['sql'] = sql_source.pull()
+        else:
+            df_2024 = pd.read_excel(os.path.join(data_folder, file_2024))
+            df_2025 = pd.read_excel(os.path.join(data_folder, file_2025))
+            # Os arquivos se sobrepõem na virada do ano e em reexportações: mantém uma versão por OS
+            df_combined, load_report['duplicates'] = deduplicate_service_orders(
+                {file_2024: df_2024, file_2025: df_2025}, os_identity_columns
+            )
 
     except FileNotFoundError as e:
         st.error(f"ERRO: Arquivo .xlsx de CHURN não encontrado. Detalhes: {e}")
         st.stop()
+    except sqlite3.Error as e:
+        st.error(f"ERRO: Problema ao consultar a fonte SQL de CHURN ('{sql_source_config_file}'). Detalhes: {e}")
+        st.stop()
     except Exception as e:
         st.error(f"ERRO: Problema ao carregar ou combinar dados de CHURN: {e}")
         st.stop()
 
     # --- INÍCIO: Carregamento e transformação dos dados da BASE ATIVA ---
     try:
-        df_active_raw = pd.read_excel(os.path.join(data_dir, file_active_base))
+        df_active_raw = pd.read_excel(os.path.join(data_folder, file_active_base))
 
         df_active_raw.rename(columns={
             'Data': 'Data Base Ativa',
@@ -97,10 +711,13 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
             'Volume Clientes Ativos': 'Volume Base Ativa'
         }, inplace=True)
 
-        df_active_raw['Data Base Ativa'] = pd.to_datetime(df_active_raw['Data Base Ativa'], errors='coerce')
-        df_active_raw['Volume Base Ativa'] = pd.to_numeric(df_active_raw['Volume Base Ativa'], errors='coerce')
-
-        df_active_raw.dropna(subset=['Data Base Ativa', 'Volume Base Ativa'], inplace=True)
+        active_dates = pd.to_datetime(df_active_raw['Data Base Ativa'], errors='coerce')
+        active_volumes = pd.to_numeric(df_active_raw['Volume Base Ativa'], errors='coerce')
+        invalid_active = active_dates.isna() | active_volumes.isna()
+        load_report['active_quarantine'] = df_active_raw.loc[invalid_active].assign(**{
+            'Motivo da Quarentena': np.where(active_dates[invalid_active].isna(), 'Data inválida', 'Volume inválido')
+        })
+        df_active_raw = df_active_raw.loc[~invalid_active].assign(**{'Data Base Ativa': active_dates, 'Volume Base Ativa': active_volumes})
         df_active_raw['Volume Base Ativa'] = df_active_raw['Volume Base Ativa'].astype(int)
 
         df_active_raw['Ano Base Ativa'] = df_active_raw['Data Base Ativa'].dt.year.astype(int)
@@ -116,17 +733,17 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
         df_active_processed = df_active_raw.drop(columns=['Tipo de Cliente Base Ativa Raw'])
 
     except FileNotFoundError as e:
-        st.warning(f"AVISO: Arquivo .xlsx da BASE ATIVA não encontrado. A projeção da base ativa não será exibida. Detalhes: {e}")
+        load_report['warnings'].append(f"AVISO: Arquivo .xlsx da BASE ATIVA não encontrado. A projeção da base ativa não será exibida. Detalhes: {e}")
         df_active_processed = pd.DataFrame()
     except Exception as e:
         print(f"Erro detalhado na BASE ATIVA (Transformação): {e}")
-        st.warning(f"AVISO: Problema ao carregar ou transformar dados da BASE ATIVA. A projeção da base ativa pode estar incorreta. Detalhes: {e}")
+        load_report['warnings'].append(f"AVISO: Problema ao carregar ou transformar dados da BASE ATIVA. A projeção da base ativa pode estar incorreta. Detalhes: {e}")
         df_active_processed = pd.DataFrame()
     # FIM: Carregamento e transformação dos dados da BASE ATIVA ---
 
     # --- INÍCIO: Carregamento e transformação dos dados de BACKLOG (NOVO) ---
     try:
-        df_backlog_raw = pd.read_excel(os.path.join(data_dir, file_backlog_churn))
+        df_backlog_raw = pd.read_excel(os.path.join(data_folder, file_backlog_churn))
 
         month_col_map = {
             'Janeiro': 1, 'Fevereiro': 2, 'Março': 3, 'Abril': 4, 'Maio': 5, 'Junho': 6,
@@ -147,9 +764,9 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
         if backlog_col_name:
             df_backlog_general = df_backlog_raw[df_backlog_raw[backlog_col_name] == 'Geral'].copy()
         else:
-            st.warning("AVISO: Coluna de identificação para 'Geral' não encontrada no arquivo 'backlog_churn.xlsx'. Verifique o cabeçalho ou a estrutura.")
+            load_report['warnings'].append("AVISO: Coluna de identificação para 'Geral' não encontrada no arquivo 'backlog_churn.xlsx'. Verifique o cabeçalho ou a estrutura.")
             df_backlog_processed = pd.DataFrame()
-            return df_churn, df_active_processed, df_backlog_processed
+            return df_churn, df_active_processed, df_backlog_processed, load_report
 
 
         if not df_backlog_general.empty:
@@ -196,7 +813,7 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
 
 
         else:
-            st.warning("AVISO: Linha 'Geral' não encontrada no arquivo 'backlog_churn.xlsx'. O KPI de Churn Operacional pode estar incorreto.")
+            load_report['warnings'].append("AVISO: Linha 'Geral' não encontrada no arquivo 'backlog_churn.xlsx'. O KPI de Churn Operacional pode estar incorreto.")
             df_backlog_processed = pd.DataFrame()
             # Se a linha 'Geral' não for encontrada, mas ainda precisamos do Dezembro de 2024
             # Podemos adicionar o valor manual se df_backlog_processed estiver vazio após tentar ler
@@ -213,7 +830,7 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
 
 
     except FileNotFoundError as e:
-        st.warning(f"AVISO: Arquivo .xlsx de BACKLOG não encontrado. O KPI de Churn Operacional não será exibido. Detalhes: {e}")
+        load_report['warnings'].append(f"AVISO: Arquivo .xlsx de BACKLOG não encontrado. O KPI de Churn Operacional não será exibido. Detalhes: {e}")
         df_backlog_processed = pd.DataFrame()
         # Adicionar o valor manual de Dezembro de 2024 mesmo se o arquivo não for encontrado
         total_dez_2024_geral = 787 + 858 + 0
@@ -227,7 +844,7 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
         
     except Exception as e:
         print(f"Erro detalhado no BACKLOG (Transformação): {e}")
-        st.warning(f"AVISO: Problema ao carregar ou transformar dados de BACKLOG. O KPI de Churn Operacional pode estar incorreto. Detalhes: {e}")
+        load_report['warnings'].append(f"AVISO: Problema ao carregar ou transformar dados de BACKLOG. O KPI de Churn Operacional pode estar incorreto. Detalhes: {e}")
         df_backlog_processed = pd.DataFrame()
         # Em caso de erro, ainda tenta adicionar o valor manual de Dezembro de 2024
         total_dez_2024_geral = 787 + 858 + 0
@@ -244,36 +861,92 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
     # --- FIM NOVO ---
 
 
-    # Continuação da transformação dos dados de CHURN
-    df_combined.rename(columns={
+    # Continuação da transformação dos dados de CHURN (validação e quarentena na mesma passada)
+    df_churn, load_report['quarantine'] = transform_churn_rows(df_combined)
+    if 'Statusos' not in df_combined.columns:
+        load_report['warnings'].append("AVISO: Coluna 'Status da OS' não encontrada para filtrar churn. Todas as OS foram para a quarentena e df_churn está vazio.")
+
+    # Hierarquia comercial (Filial → Regional → Diretoria), juntada uma única vez aqui
+    try:
+        df_hierarchy = load_hierarchy_mapping(os.path.join(data_folder, hierarchy_file))
+    except ValueError as e:
+        load_report['warnings'].append(f"AVISO: Arquivo de hierarquia '{hierarchy_file}' fora do formato esperado. A análise por Regional e Diretoria não será exibida. Detalhes: {e}")
+        df_hierarchy = None
+    if df_hierarchy is not None and not df_churn.empty:
+        df_churn = join_hierarchy(df_churn, df_hierarchy)
+        unmapped = ~df_churn['Filial'].isin(df_hierarchy['Filial'])
+        load_report['hierarchy_unmapped'] = df_churn.loc[unmapped].groupby('Filial').agg(OS=('Volume', 'sum')).reset_index()
+
+    for col in df_active_processed.select_dtypes(include=['object']).columns:
+        df_active_processed[col] = df_active_processed[col].astype(str)
+    
+    return df_churn, df_active_processed, df_backlog_processed, load_report
+
+
+# --- Normalização das OS de Churn (arquivos anuais, fonte SQL e eventos do dia) ---
+def transform_churn_rows(df_combined):
+    """
+    Converte as OS com as colunas originais nas linhas de churn do painel, validando cada linha na
+    mesma passada vetorizada em que as colunas são convertidas: exclui o Tipo de Churn
+    "desconsiderar" e os status esperados que não são churn (churn_expected_statuses), converte
+    as datas e os códigos de Formajuridica de churn_row_schema e marca as OS com problema. Numa
+    única seleção, as OS válidas seguem (renomeadas, com Tipo de Cliente, ano, mês e volume) e as
+    demais vão para a quarentena, com as colunas originais e o motivo. Sem a coluna Statusos não
+    há como separar o churn: todas as OS vão para a quarentena com o motivo "Statusos ausente".
+    Retorna (df_churn, df_quarantine).
+    """
+    if 'Statusos' not in df_combined.columns:
+        df_quarantine = df_combined.copy()
+        df_quarantine.insert(0, 'Motivo da Quarentena', 'Statusos ausente')
+        return pd.DataFrame(), df_quarantine
+
+    status = df_combined['Statusos'].astype(str).str.strip()
+    concluded = status.str.contains(churn_concluded_status, na=False, case=False).to_numpy()
+    expected_status = status.isin(churn_expected_statuses).to_numpy() | concluded
+    candidate = concluded | ~expected_status
+    if 'tipoChurn' in df_combined.columns or 'Tipo de Churn' in df_combined.columns:
+        churn_type = df_combined['tipoChurn' if 'tipoChurn' in df_combined.columns else 'Tipo de Churn']
+        candidate &= (churn_type.astype(str).str.strip().str.lower() != 'desconsiderar').to_numpy()
+
+    # Conversão e validação de cada coluna do esquema; os problemas só contam nas OS candidatas a churn
+    problems = {'status inesperado': candidate & ~expected_status}
+    parsed = {}
+    for column, rule in churn_row_schema.items():
+        raw = df_combined[column] if column in df_combined.columns else pd.Series(np.nan, index=df_combined.index)
+        present = raw.notna().to_numpy()
+        if not pd.api.types.is_datetime64_any_dtype(raw) and not pd.api.types.is_numeric_dtype(raw):
+            present = present & (raw.astype(str).str.strip() != '').to_numpy()
+        if rule.get('obrigatoria'):
+            problems[f"{column} ausente"] = candidate & ~present
+        if rule['tipo'] == 'data':
+            parsed[column] = pd.to_datetime(raw.where(present), errors='coerce')
+            problems[f"{column} inválida"] = candidate & present & parsed[column].isna().to_numpy()
+        elif rule['tipo'] == 'codigo':
+            parsed[column] = raw.astype(str).str.strip().str.upper().where(present, '')
+            problems[f"{column} desconhecido"] = candidate & present & ~parsed[column].isin(rule['valores']).to_numpy()
+    quarantined = candidate & np.logical_or.reduce(list(problems.values()))
+    valid = candidate & ~quarantined
+
+    df_quarantine = df_combined.loc[quarantined].copy()
+    reasons = np.full(int(quarantined.sum()), '', dtype=object)
+    for reason, mask in problems.items():
+        reasons = np.where(mask[quarantined], reasons + np.where(reasons == '', '', '; ') + reason, reasons)
+    df_quarantine.insert(0, 'Motivo da Quarentena', reasons)
+
+    df_churn = df_combined.loc[valid].rename(columns={
         'Datacriacaoos': 'Data de Criacao da OS',
         'Statusos': 'Status da OS',
         'DATADESINSTALACAO': 'Data de Desinstalacao',
         'Formajuridica': 'Forma Juridica Original',
         'tipoChurn': 'Tipo de Churn',
         'Filialos': 'Filial'
-    }, inplace=True)
-
-    if 'Categoria4' in df_combined.columns:
-        df_combined['Categoria4_Motivo'] = df_combined['Categoria4'].astype(str)
-    else:
-        df_combined['Categoria4_Motivo'] = None
-
-    if 'Tipo de Churn' in df_combined.columns:
-        df_combined = df_combined[df_combined['Tipo de Churn'].astype(str).str.strip().str.lower() != 'desconsiderar'].copy()
-
-    df_combined['Data de Criacao da OS'] = pd.to_datetime(df_combined['Data de Criacao da OS'], errors='coerce')
-    df_combined['Data de Desinstalacao'] = pd.to_datetime(df_combined['Data de Desinstalacao'], errors='coerce')
-
-    if 'Status da OS' in df_combined.columns:
-        df_churn = df_combined[df_combined['Status da OS'].astype(str).str.strip().str.contains('Concluído', na=False, case=False)].copy()
-    else:
-        st.warning("AVISO: Coluna 'Status da OS' não encontrada para filtrar churn. df_churn pode estar vazio.")
-        df_churn = pd.DataFrame()
+    })
+    df_churn['Categoria4_Motivo'] = df_churn['Categoria4'].astype(str) if 'Categoria4' in df_churn.columns else None
+    df_churn['Data de Criacao da OS'] = parsed['Datacriacaoos'][valid]
+    df_churn['Data de Desinstalacao'] = parsed['DATADESINSTALACAO'][valid]
 
     if not df_churn.empty:
-        df_churn['Tipo de Cliente'] = df_churn['Forma Juridica Original'].apply(map_tipo_cliente)
-        df_churn.dropna(subset=['Data de Desinstalacao'], inplace=True)
+        df_churn['Tipo de Cliente'] = parsed['Formajuridica'][valid].map(legal_form_client_types).fillna('Outros')
         df_churn['Ano Churn'] = df_churn['Data de Desinstalacao'].dt.year.astype(int)
         df_churn['Mes Churn'] = df_churn['Data de Desinstalacao'].dt.month.astype(int)
 
@@ -286,32 +959,2293 @@ def load_and_transform_data(data_folder, file_2024, file_2025, file_active_base,
     for col in df_churn.select_dtypes(include=['object']).columns:
         df_churn[col] = df_churn[col].astype(str)
 
-    for col in df_active_processed.select_dtypes(include=['object']).columns:
-        df_active_processed[col] = df_active_processed[col].astype(str)
-    
-    return df_churn, df_active_processed, df_backlog_processed
+    return df_churn, df_quarantine
+
+# --- Deduplicação de OS entre os arquivos anuais ---
+def deduplicate_service_orders(frames_by_source, identity_columns):
+    """
+    Empilha os arquivos de churn (na ordem informada, do mais antigo para o mais recente) e
+    remove as OS repetidas em uma única passada: cada linha recebe um hash das colunas de
+    identificação da OS e a tabela hash de pandas marca as repetições, sem comparação par a par.
+    Fica a última versão de cada OS, ou seja, a do arquivo mais recente (e, dentro do mesmo
+    arquivo, a última linha), que traz o status mais atual.
+    Retorna o DataFrame sem duplicatas e um resumo das remoções por arquivo de origem.
+    """
+    sources = list(frames_by_source.keys())
+    row_counts = [len(frame) for frame in frames_by_source.values()]
+    df_stacked = pd.concat(list(frames_by_source.values()), ignore_index=True)
+    source_codes = np.repeat(np.arange(len(sources)), row_counts)
+
+    key_columns = [column for column in identity_columns if column in df_stacked.columns]
+    if key_columns and not df_stacked.empty:
+        os_hash = pd.util.hash_pandas_object(df_stacked[key_columns], index=False)
+        duplicated = os_hash.duplicated(keep='last').to_numpy()
+    else:
+        duplicated = np.zeros(len(df_stacked), dtype=bool)
 
+    df_report = pd.DataFrame({
+        'Arquivo': sources,
+        'Linhas Lidas': row_counts,
+        'Duplicatas Removidas': np.bincount(source_codes[duplicated], minlength=len(sources))
+    })
+    return df_stacked.loc[~duplicated].reset_index(drop=True), df_report
 
 # Definição da função map_tipo_cliente
 def map_tipo_cliente(forma_juridica):
-    s = str(forma_juridica).strip().upper()
-    if pd.isna(forma_juridica) or s == '':
-        return 'PF'
-    elif s == 'P1':
-        return 'PME'
-    elif s == 'C1':
-        return 'Corporativo'
-    elif s == 'PF':
+    if pd.isna(forma_juridica):
         return 'PF'
-    elif s == 'PME':
-        return 'PME'
-    elif s == 'CORPORATIVO':
-        return 'Corporativo'
+    return legal_form_client_types.get(str(forma_juridica).strip().upper(), 'Outros')
+
+# --- Hierarquia Comercial (Filial → Regional → Diretoria) ---
+def load_hierarchy_mapping(filepath):
+    """
+    Lê o arquivo de hierarquia (colunas de hierarchy_levels) em um DataFrame com uma linha por
+    Filial. Retorna None sem arquivo. Colunas ausentes, níveis em branco e um nível ligado a mais
+    de um nível acima (Filial em duas Regionais, Regional em duas Diretorias) geram ValueError com
+    as linhas do Excel afetadas.
+    """
+    if not os.path.exists(filepath):
+        return None
+    try:
+        df_raw = pd.read_excel(filepath)
+    except (OSError, zipfile.BadZipFile) as e:
+        raise ValueError(f"não foi possível ler o arquivo: {e}") from e
+    df_raw.columns = [str(column).strip() for column in df_raw.columns]
+    missing_columns = [column for column in hierarchy_levels if column not in df_raw.columns]
+    if missing_columns:
+        raise ValueError(f"colunas ausentes: {', '.join(missing_columns)}. Esperado {', '.join(hierarchy_levels)}.")
+
+    df_hierarchy = pd.DataFrame({
+        level: df_raw[level].where(df_raw[level].notna(), '').astype(str).str.strip() for level in hierarchy_levels
+    })
+    excel_rows = df_raw.index.to_numpy() + 2 # Linha no Excel (cabeçalho na linha 1)
+    checks = [((df_hierarchy == '').any(axis=1), "nível em branco")]
+    for parent, child in zip(hierarchy_levels[:-1], hierarchy_levels[1:]):
+        checks.append((df_hierarchy.groupby(child)[parent].transform('nunique') > 1, f"{child} em mais de uma {parent}"))
+    problems = []
+    for invalid, description in checks:
+        if invalid.any():
+            rows = excel_rows[invalid.to_numpy()]
+            problems.append(f"{description}: linha(s) {', '.join(str(row) for row in rows[:10])}{' ...' if len(rows) > 10 else ''}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    return df_hierarchy.drop_duplicates('Filial').reset_index(drop=True)
+
+def join_hierarchy(df_churn, df_hierarchy):
+    """
+    Acrescenta às OS as colunas dos níveis acima de Filial, por mapeamento direto da Filial (sem
+    merge, que copiaria todas as colunas). Filiais fora de df_hierarchy ficam em hierarchy_unmapped_label.
+    """
+    df_mapping = df_hierarchy.set_index('Filial')
+    for level in hierarchy_levels[:-1]:
+        df_churn[level] = df_churn['Filial'].map(df_mapping[level]).fillna(hierarchy_unmapped_label)
+    return df_churn
+
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_hierarchy_rollups(_df_churn, dataset_version):
+    """
+    Volumes mensais de churn pré-calculados em todos os níveis da hierarquia: {nível: DataFrame},
+    de hierarchy_national_label a Filial, cada um com as colunas dos níveis acima e do próprio
+    nível, hierarchy_measure_keys e 'Volume'. Um único groupby nas OS, no nível de Filial; cada
+    nível acima soma o agregado do nível de baixo. {} se as OS não têm a hierarquia.
+    Em cache por versão do conjunto de dados.
+    """
+    if _df_churn.empty or any(level not in _df_churn.columns for level in hierarchy_levels):
+        return {}
+    rollups = {}
+    df_level = _df_churn.groupby(hierarchy_levels + hierarchy_measure_keys, dropna=False)['Volume'].sum().reset_index()
+    for depth in range(len(hierarchy_levels), 0, -1):
+        rollups[hierarchy_levels[depth - 1]] = df_level
+        df_level = df_level.groupby(hierarchy_levels[:depth - 1] + hierarchy_measure_keys, dropna=False)['Volume'].sum().reset_index()
+    rollups[hierarchy_national_label] = df_level
+    return {level: rollups[level] for level in [hierarchy_national_label] + hierarchy_levels}
+
+def hierarchy_children(rollups, path):
+    """Valores do nível abaixo de path (valores escolhidos a partir do nível mais alto), lidos do agregado desse nível."""
+    child_level = hierarchy_levels[len(path)]
+    df_level = rollups[child_level]
+    mask = np.ones(len(df_level), dtype=bool)
+    for level, value in zip(hierarchy_levels, path):
+        mask = mask & (df_level[level] == value).to_numpy()
+    return sorted(df_level.loc[mask, child_level].unique())
+
+def select_hierarchy_rows(rollups, path, selected_years, selected_months, selected_client_types, selected_churn_types):
+    """
+    Linhas do agregado do nível abaixo de path, dentro de path e dos filtros da barra lateral.
+    Retorna (nível, DataFrame): só seleção sobre o agregado pré-calculado, sem groupby nas OS.
+    """
+    child_level = hierarchy_levels[len(path)]
+    df_level = rollups[child_level]
+    mask = (
+        df_level['Ano Churn'].isin(selected_years) &
+        df_level['Mes Churn'].isin([month_order_num_pt.index(m)+1 for m in selected_months]) &
+        df_level['Tipo de Cliente'].isin(selected_client_types)
+    ).to_numpy()
+    if selected_churn_types:
+        mask = mask & df_level['Tipo de Churn'].isin(selected_churn_types).to_numpy()
+    for level, value in zip(hierarchy_levels, path):
+        mask = mask & (df_level[level] == value).to_numpy()
+    return child_level, df_level[mask]
+
+def compute_hierarchy_comparison_table(df_rows, child_level):
+    """Tabela 2025 vs 2024 dos valores de child_level, a partir das linhas de select_hierarchy_rows."""
+    if df_rows.empty:
+        return pd.DataFrame()
+    df_volumes = df_rows[df_rows['Ano Churn'].isin([2024, 2025])].pivot_table(
+        index=child_level, columns='Ano Churn', values='Volume', aggfunc='sum', fill_value=0
+    ).reindex(columns=[2025, 2024], fill_value=0)
+    df_volumes.columns = ['Volume_2025', 'Volume_2024']
+    return format_year_comparison_table(df_volumes.reset_index(), child_level, f"Nova {child_level}", child_level)
+
+# --- Séries Mensais de Churn (todas as séries de uma vez) ---
+def build_monthly_series(df_churn, dimensions):
+    """
+    Monta um array (séries x anos x 12 meses) com o volume de churn do total e de cada
+    valor de cada dimensão informada. A contagem é feita com um único np.bincount por
+    dimensão, sem groupby por segmento.
+    Retorna o array, a lista de rótulos (Dimensao, Segmento) e a lista de anos.
+    """
+    years = np.sort(df_churn['Ano Churn'].unique())
+    n_cells = len(years) * 12
+    year_idx = np.searchsorted(years, df_churn['Ano Churn'].to_numpy())
+    cell_idx = year_idx * 12 + (df_churn['Mes Churn'].to_numpy() - 1)
+    weights = df_churn['Volume'].to_numpy(dtype=float)
+
+    blocks = [np.bincount(cell_idx, weights=weights, minlength=n_cells).reshape(1, len(years), 12)]
+    labels = [('Total', 'Total')]
+    for dimension in dimensions:
+        if dimension not in df_churn.columns:
+            continue
+        codes, uniques = pd.factorize(df_churn[dimension].astype(str), sort=True)
+        valid = codes >= 0
+        counts = np.bincount(codes[valid] * n_cells + cell_idx[valid], weights=weights[valid], minlength=len(uniques) * n_cells)
+        blocks.append(counts.reshape(len(uniques), len(years), 12))
+        labels.extend((dimension, str(segment)) for segment in uniques)
+
+    return np.concatenate(blocks), labels, [int(year) for year in years]
+
+# --- Projeções Anuais de Churn (modelo sazonal vetorizado) ---
+@instrumented_cache(st.cache_data(show_spinner=False))
+def fit_churn_forecasts(_df_churn, dataset_version):
+    """
+    Projeta o churn anual de todas as séries mensais de uma vez (total, cada Tipo de Cliente,
+    cada Tipo de Churn e cada Filial) com um modelo sazonal ingênuo: os meses que faltam no ano
+    repetem o mesmo mês do ano anterior, escalado pela razão entre o acumulado do ano e o mesmo
+    período do ano anterior. Sem ano anterior completo, usa a média mensal (acumulado / meses * 12).
+    O intervalo vem da dispersão dos resíduos nos meses já observados.
+    Fica em cache por versão do conjunto de dados, então o KPI passa a ser uma simples consulta.
+    """
+    if _df_churn.empty:
+        return pd.DataFrame()
+
+    series, labels, years = build_monthly_series(_df_churn, forecast_dimensions)
+    n_series = series.shape[0]
+    years = np.array(years)
+
+    # Meses observados em cada ano (com base na série total), válidos para todas as séries
+    total = series[0]
+    last_month = np.where(total.any(axis=1), 12 - np.argmax(total[:, ::-1] > 0, axis=1), 0)
+    observed = np.arange(1, 13)[None, :] <= last_month[:, None]
+    n_observed = observed.sum(axis=1)
+    n_remaining = 12 - n_observed
+
+    accumulated = (series * observed).sum(axis=2)
+
+    # Mesmo mês do ano anterior, alinhado ao ano corrente
+    previous = np.zeros_like(series)
+    previous[:, 1:, :] = series[:, :-1, :]
+    has_previous = np.zeros(len(years), dtype=bool)
+    has_previous[1:] = (np.diff(years) == 1) & (last_month[:-1] == 12)
+    previous_observed = (previous * observed).sum(axis=2)
+    previous_remaining = (previous * ~observed).sum(axis=2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(previous_observed > 0, accumulated / previous_observed, np.nan)
+        monthly_mean = np.where(n_observed > 0, accumulated / n_observed, 0.0)
+    seasonal = has_previous[None, :] & np.isfinite(ratio)
+
+    fitted = np.where(seasonal[:, :, None], np.nan_to_num(ratio)[:, :, None] * previous, monthly_mean[:, :, None])
+    residuals = np.where(observed[None, :, :], series - fitted, 0.0)
+    sigma = np.sqrt((residuals ** 2).sum(axis=2) / np.maximum(n_observed - 1, 1))
+
+    remaining_forecast = np.where(seasonal, np.nan_to_num(ratio) * previous_remaining, monthly_mean * n_remaining)
+    projection = accumulated + remaining_forecast
+    half_width = forecast_interval_z * sigma * np.sqrt(n_remaining)
+
+    index = pd.MultiIndex.from_tuples(
+        [(dimension, segment, int(year)) for dimension, segment in labels for year in years],
+        names=['Dimensao', 'Segmento', 'Ano']
+    )
+    return pd.DataFrame({
+        'Acumulado': accumulated.ravel(),
+        'Meses Observados': np.tile(n_observed, n_series),
+        'Modelo': np.where(seasonal, 'Sazonal', 'Média Mensal').ravel(),
+        'Projecao': projection.ravel(),
+        'Limite Inferior': np.maximum(projection - half_width, accumulated).ravel(),
+        'Limite Superior': (projection + half_width).ravel()
+    }, index=index)
+
+def lookup_churn_forecast(df_forecasts, year, selected_months, all_months, selected_client_types, all_client_types, selected_churn_types, all_churn_types):
+    """
+    Retorna a linha da projeção pré-calculada que corresponde à seleção atual, ou None quando
+    a combinação de filtros não é uma das séries projetadas (subconjunto de meses, mais de um
+    valor no mesmo filtro ou mais de um filtro restrito ao mesmo tempo).
+    """
+    if df_forecasts.empty or set(selected_months) != set(all_months):
+        return None
+
+    restricted_filters = []
+    if set(selected_client_types) != set(all_client_types):
+        restricted_filters.append(('Tipo de Cliente', selected_client_types))
+    if selected_churn_types and set(selected_churn_types) != set(all_churn_types):
+        restricted_filters.append(('Tipo de Churn', selected_churn_types))
+
+    if not restricted_filters:
+        key = ('Total', 'Total', int(year))
+    elif len(restricted_filters) == 1 and len(restricted_filters[0][1]) == 1:
+        dimension, values = restricted_filters[0]
+        key = (dimension, str(values[0]), int(year))
+    else:
+        return None
+
+    if key not in df_forecasts.index:
+        return None
+    return df_forecasts.loc[key]
+
+# --- Tempo entre Criação da OS e Desinstalação (histogramas pré-calculados) ---
+lead_time_group_columns = ['Ano Churn', 'Mes Churn', 'Tipo de Cliente', 'Tipo de Churn', 'Filial']
+
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_lead_time_histograms(_df_churn, dataset_version):
+    """
+    Calcula, com aritmética de datas do NumPy, os dias entre 'Data de Criacao da OS' e
+    'Data de Desinstalacao' e já os agrupa em histogramas diários por
+    (Ano, Mês, Tipo de Cliente, Tipo de Churn, Filial).
+    Retorna a tabela de grupos e a matriz de contagens (grupos x faixas). A faixa 0 guarda
+    valores negativos, as faixas 1..lead_time_max_days+1 os dias 0..lead_time_max_days e a
+    última os valores acima do limite. Nenhum trabalho por linha é necessário depois disso.
+    """
+    n_bins = lead_time_max_days + 3
+    required_columns = ['Data de Criacao da OS', 'Data de Desinstalacao'] + lead_time_group_columns
+    if _df_churn.empty or not all(column in _df_churn.columns for column in required_columns):
+        return pd.DataFrame(columns=lead_time_group_columns), np.zeros((0, n_bins), dtype=np.int64)
+
+    created = _df_churn['Data de Criacao da OS'].to_numpy(dtype='datetime64[D]')
+    uninstalled = _df_churn['Data de Desinstalacao'].to_numpy(dtype='datetime64[D]')
+    valid = ~(np.isnat(created) | np.isnat(uninstalled))
+    lead_days = (uninstalled[valid] - created[valid]).astype(np.int64)
+    bins = np.clip(lead_days, -1, lead_time_max_days + 1) + 1
+
+    # Código único por grupo, combinando os códigos de cada coluna
+    group_codes = []
+    group_uniques = []
+    for column in lead_time_group_columns:
+        codes, uniques = pd.factorize(_df_churn[column].to_numpy()[valid], sort=True, use_na_sentinel=False)
+        group_codes.append(codes)
+        group_uniques.append(uniques)
+    flat_codes = np.ravel_multi_index(group_codes, [max(len(u), 1) for u in group_uniques])
+    present_groups, group_idx = np.unique(flat_codes, return_inverse=True)
+
+    counts = np.bincount(group_idx * n_bins + bins, minlength=len(present_groups) * n_bins)
+    counts = counts.reshape(len(present_groups), n_bins)
+
+    unraveled = np.unravel_index(present_groups, [max(len(u), 1) for u in group_uniques])
+    df_groups = pd.DataFrame({
+        column: uniques[codes] for column, uniques, codes in zip(lead_time_group_columns, group_uniques, unraveled)
+    })
+    return df_groups, counts
+
+def lead_time_percentiles_from_counts(counts, quantiles):
+    """
+    Calcula percentis (em dias) a partir de histogramas diários, uma linha por histograma.
+    -1 indica valores negativos e lead_time_max_days + 1 indica valores acima do limite.
+    Linhas sem contagens retornam NaN.
+    """
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1]
+    result = np.full((counts.shape[0], len(quantiles)), np.nan)
+    for i, quantile in enumerate(quantiles):
+        targets = np.ceil(quantile * totals)
+        positions = (cumulative >= np.maximum(targets, 1)[:, None]).argmax(axis=1)
+        result[:, i] = np.where(totals > 0, positions - 1, np.nan)
+    return result
+
+def format_lead_time_days(days):
+    """Formata um percentil em dias para exibição."""
+    if pd.isna(days):
+        return "N/A"
+    if days < 0:
+        return "< 0"
+    if days > lead_time_max_days:
+        return f"> {lead_time_max_days}"
+    return f"{int(days)}"
+
+def lead_time_display_labels():
+    """Rótulos das faixas de exibição do histograma, na ordem."""
+    edges = lead_time_display_edges
+    labels = ["< 0"]
+    for low, high in zip(edges[:-1], edges[1:]):
+        labels.append(f"{low}" if high - low == 1 else f"{low}-{high - 1}")
+    labels.append(f"{edges[-1]}+")
+    return labels
+
+def aggregate_lead_time_display_bins(counts):
+    """Agrupa os histogramas diários nas faixas de exibição (lead_time_display_edges)."""
+    # Posições das faixas na matriz: 0 = negativos, dia d = coluna d + 1
+    starts = [0] + [edge + 1 for edge in lead_time_display_edges]
+    return np.add.reduceat(counts, starts, axis=1)
+
+# --- Detalhamento de OS (índice ordenado e paginação no servidor) ---
+@instrumented_cache(st.cache_resource(show_spinner=False), storage='cache_resource')
+def build_drilldown_index(_df_churn, dataset_version):
+    """
+    Ordena as OS pela chave composta (AnoMes, Filial, Tipo de Churn) e guarda a chave
+    ordenada como um array de inteiros, para que as linhas de qualquer célula sejam
+    encontradas por busca binária. Fica em cache_resource (um único objeto, somente
+    leitura, compartilhado entre sessões) para não copiar o DataFrame a cada rerun.
+    Retorna um dicionário com 'frame' (OS ordenadas), 'keys' e 'levels' (valores de cada coluna).
+    """
+    if _df_churn.empty or not all(column in _df_churn.columns for column in drilldown_index_columns):
+        return {'frame': pd.DataFrame(), 'keys': np.zeros(0, dtype=np.int64), 'levels': [[] for _ in drilldown_index_columns]}
+
+    codes_by_column = []
+    levels = []
+    for column in drilldown_index_columns:
+        codes, uniques = pd.factorize(_df_churn[column], sort=True, use_na_sentinel=False)
+        codes_by_column.append(codes)
+        levels.append(list(uniques))
+
+    keys = np.ravel_multi_index(codes_by_column, [len(level) for level in levels]).astype(np.int64)
+    order = np.argsort(keys, kind='stable')
+    return {
+        'frame': _df_churn.iloc[order].reset_index(drop=True),
+        'keys': keys[order],
+        'levels': levels
+    }
+
+def query_drilldown_rows(drilldown_index, level_codes):
+    """
+    Retorna as posições (no frame ordenado) das OS da célula informada. level_codes traz,
+    para cada coluna da chave, o código do valor escolhido ou None para "Todos".
+    Cada combinação dos níveis fixados vira um intervalo contíguo da chave ordenada,
+    localizado com np.searchsorted.
+    """
+    keys = drilldown_index['keys']
+    sizes = [len(level) for level in drilldown_index['levels']]
+    fixed = [i for i, code in enumerate(level_codes) if code is not None]
+    if not fixed:
+        return np.arange(len(keys))
+
+    # Níveis até o último fixado: valor escolhido ou todos os códigos; os seguintes ficam livres
+    last_fixed = fixed[-1]
+    grids = np.meshgrid(*[
+        np.array([level_codes[i]]) if level_codes[i] is not None else np.arange(sizes[i])
+        for i in range(last_fixed + 1)
+    ], indexing='ij')
+    prefixes = np.ravel_multi_index([grid.ravel() for grid in grids], sizes[:last_fixed + 1])
+    span = int(np.prod(sizes[last_fixed + 1:], dtype=np.int64))
+
+    starts = np.searchsorted(keys, prefixes * span, side='left')
+    ends = np.searchsorted(keys, (prefixes + 1) * span, side='left')
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+def get_drilldown_page(drilldown_index, positions, columns, sort_column=None, ascending=True, page=1, page_size=50):
+    """
+    Ordena apenas as linhas da célula (quando pedido), seleciona as colunas e devolve somente
+    a página solicitada, de modo que apenas ela é enviada ao navegador.
+    """
+    df_frame = drilldown_index['frame']
+    if sort_column is not None and len(positions) > 0:
+        cell_values = df_frame[sort_column].iloc[positions].reset_index(drop=True)
+        positions = positions[cell_values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()]
+
+    start = (page - 1) * page_size
+    return df_frame.iloc[positions[start:start + page_size]][columns]
+
+# --- Consultas por Período (somas acumuladas diárias por segmento) ---
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_daily_prefix_index(_df_churn, dataset_version):
+    """
+    Conta as desinstalações por dia e por segmento (combinações de date_range_segment_columns
+    presentes nos dados, não o produto de todos os valores) e guarda as somas acumuladas, com um
+    zero à esquerda. O volume de qualquer intervalo de datas sai então de duas leituras por
+    segmento, sem reagregar as linhas.
+    Retorna um dicionário com 'start' (primeiro dia), 'segments' (DataFrame dos segmentos)
+    e 'cumulative' (segmentos x dias+1).
+    """
+    segment_columns = [column for column in date_range_segment_columns if column in _df_churn.columns]
+    if _df_churn.empty or 'Data de Desinstalacao' not in _df_churn.columns:
+        return {'start': None, 'segments': pd.DataFrame(columns=segment_columns), 'cumulative': np.zeros((0, 1), dtype=np.int64)}
+
+    days = _df_churn['Data de Desinstalacao'].to_numpy(dtype='datetime64[D]')
+    start = days.min()
+    day_idx = (days - start).astype(np.int64)
+    n_days = int(day_idx.max()) + 1
+
+    codes_by_column = []
+    uniques_by_column = []
+    for column in segment_columns:
+        codes, uniques = pd.factorize(_df_churn[column], sort=True, use_na_sentinel=False)
+        codes_by_column.append(codes)
+        uniques_by_column.append(uniques)
+    shape = [len(uniques) for uniques in uniques_by_column]
+    combined_idx = np.ravel_multi_index(codes_by_column, shape) if segment_columns else np.zeros(len(day_idx), dtype=np.int64)
+    # Só as combinações que aparecem nas OS: com Filial, o produto completo seria quase todo zeros
+    observed_segments, segment_idx = np.unique(combined_idx, return_inverse=True)
+    n_segments = len(observed_segments)
+
+    daily = np.bincount(segment_idx * n_days + day_idx, weights=_df_churn['Volume'].to_numpy(dtype=float), minlength=n_segments * n_days)
+    cumulative = np.zeros((n_segments, n_days + 1), dtype=np.int64)
+    cumulative[:, 1:] = np.cumsum(daily.reshape(n_segments, n_days), axis=1).astype(np.int64)
+
+    segment_values = np.unravel_index(observed_segments, shape)
+    df_segments = pd.DataFrame({
+        column: np.asarray(uniques)[codes] for column, uniques, codes in zip(segment_columns, uniques_by_column, segment_values)
+    })
+    return {'start': start, 'segments': df_segments, 'cumulative': cumulative}
+
+def query_date_range(prefix_index, start_date, end_date):
+    """
+    Volume de churn de cada segmento entre start_date e end_date (inclusive), em O(1)
+    por segmento: diferença entre duas posições das somas acumuladas.
+    """
+    cumulative = prefix_index['cumulative']
+    if prefix_index['start'] is None:
+        return np.zeros(cumulative.shape[0], dtype=np.int64)
+    n_days = cumulative.shape[1] - 1
+    first = int((np.datetime64(start_date, 'D') - prefix_index['start']).astype(np.int64))
+    last = int((np.datetime64(end_date, 'D') - prefix_index['start']).astype(np.int64))
+    first = min(max(first, 0), n_days)
+    last = min(max(last + 1, first), n_days)
+    return cumulative[:, last] - cumulative[:, first]
+
+def summarize_date_range(prefix_index, range_counts, segment_mask, dimension):
+    """Volume do período por valor de dimension (uma das colunas dos segmentos), com a participação no total."""
+    df_segments = prefix_index['segments']
+    df_range = pd.DataFrame({dimension: df_segments[dimension].to_numpy()[segment_mask], 'Volume': range_counts[segment_mask]})
+    df_range = df_range.groupby(dimension, as_index=False)['Volume'].sum()
+    df_range = df_range[df_range['Volume'] > 0].sort_values('Volume', ascending=False, kind='stable').reset_index(drop=True)
+    total = df_range['Volume'].sum()
+    df_range['Participação (%)'] = (df_range['Volume'] / total * 100).round(2) if total > 0 else 0.0
+    return df_range
+
+def resolve_date_range_preset(preset, first_day, last_day):
+    """Converte um período pré-definido em (início, fim), ancorado no último dia com dados."""
+    if preset == "Semana até a data":
+        start_day = last_day - timedelta(days=last_day.weekday())
+    elif preset == "Últimos 30 dias":
+        start_day = last_day - timedelta(days=29)
+    elif preset == "Últimos 90 dias":
+        start_day = last_day - timedelta(days=89)
+    elif preset == "Ano fiscal até a data":
+        fiscal_year = last_day.year if last_day.month >= fiscal_year_start_month else last_day.year - 1
+        start_day = date(fiscal_year, fiscal_year_start_month, 1)
+    else:
+        start_day = first_day
+    return max(start_day, first_day), last_day
+
+# --- Alertas de Churn (z-score robusto de todas as séries de uma vez) ---
+@instrumented_cache(st.cache_data(show_spinner=False))
+def detect_churn_anomalies(_df_churn, dataset_version):
+    """
+    Avalia todas as séries mensais de anomaly_dimensions de uma vez: o volume de cada série em
+    cada mês é comparado com a mediana dos anomaly_baseline_months meses anteriores, na escala do
+    MAD (z = (x - mediana) / (1,4826 * MAD)). Contagem por np.bincount e janelas com
+    sliding_window_view, sem laço por série. Retorna os meses acima de anomaly_z_threshold,
+    do maior para o menor z, em cache por versão do conjunto de dados.
+    """
+    alert_columns = ['AnoMes'] + anomaly_dimensions + ['Volume', 'Mediana', 'MAD', 'Z Robusto', 'Variação (%)']
+    if _df_churn.empty or any(column not in _df_churn.columns for column in anomaly_dimensions):
+        return pd.DataFrame(columns=alert_columns)
+
+    # Índice do mês numa linha do tempo contínua, do primeiro ao último mês com churn
+    month_number = _df_churn['Ano Churn'].to_numpy(dtype=np.int64) * 12 + _df_churn['Mes Churn'].to_numpy(dtype=np.int64) - 1
+    first_month = month_number.min()
+    n_months = int(month_number.max() - first_month + 1)
+    time_idx = month_number - first_month
+
+    # Uma série por combinação existente das dimensões
+    dimension_codes = []
+    dimension_levels = []
+    for column in anomaly_dimensions:
+        codes, uniques = pd.factorize(_df_churn[column].astype(str), sort=True, use_na_sentinel=False)
+        dimension_codes.append(codes)
+        dimension_levels.append(uniques)
+    combined = np.ravel_multi_index(dimension_codes, [len(levels) for levels in dimension_levels])
+    series_keys, series_idx = np.unique(combined, return_inverse=True)
+    n_series = len(series_keys)
+
+    volume = np.bincount(
+        series_idx * n_months + time_idx,
+        weights=_df_churn['Volume'].to_numpy(dtype=float),
+        minlength=n_series * n_months
+    ).reshape(n_series, n_months)
+
+    # Janela dos meses anteriores a cada mês (NaN antes do início da série temporal)
+    padded = np.concatenate([np.full((n_series, anomaly_baseline_months), np.nan), volume], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, anomaly_baseline_months, axis=1)[:, :n_months, :]
+    history = (~np.isnan(windows[0])).sum(axis=1) # Igual para todas as séries
+    evaluated = history >= anomaly_min_history
+    if not evaluated.any():
+        return pd.DataFrame(columns=alert_columns)
+
+    windows = windows[:, evaluated, :]
+    current = volume[:, evaluated]
+    median = np.nanmedian(windows, axis=2)
+    mad = np.nanmedian(np.abs(windows - median[:, :, None]), axis=2)
+    scale = np.maximum(1.4826 * mad, 1.0) # Piso para séries quase constantes
+    z_scores = (current - median) / scale
+
+    alert_series, alert_months = np.nonzero((z_scores >= anomaly_z_threshold) & (current >= anomaly_min_volume))
+    if len(alert_series) == 0:
+        return pd.DataFrame(columns=alert_columns)
+
+    evaluated_months = np.flatnonzero(evaluated) + first_month
+    alert_month_numbers = evaluated_months[alert_months]
+    df_alerts = pd.DataFrame({
+        'AnoMes': [f"{number // 12}-{number % 12 + 1:02d}" for number in alert_month_numbers]
+    })
+    level_codes = np.unravel_index(series_keys[alert_series], [len(levels) for levels in dimension_levels])
+    for column, levels, codes in zip(anomaly_dimensions, dimension_levels, level_codes):
+        df_alerts[column] = np.asarray(levels, dtype=object)[codes]
+    alert_median = median[alert_series, alert_months]
+    df_alerts['Volume'] = current[alert_series, alert_months].astype(int)
+    df_alerts['Mediana'] = alert_median
+    df_alerts['MAD'] = mad[alert_series, alert_months]
+    df_alerts['Z Robusto'] = z_scores[alert_series, alert_months].round(2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_alerts['Variação (%)'] = np.where(alert_median > 0, (df_alerts['Volume'] / alert_median - 1) * 100, np.nan).round(1)
+    return df_alerts.sort_values(['Z Robusto', 'Volume'], ascending=False, ignore_index=True)
+
+# --- Tabela Mensal de Fatos (churn, base ativa, backlog e metas OTL alinhados) ---
+def assemble_monthly_fact_table(df_churn, df_active_raw, df_backlog_raw, otl_projections=None):
+    """
+    Tabela com uma linha por (Ano, Mes, Tipo de Cliente) em todos os meses dos anos presentes em
+    qualquer fonte, com:
+      - 'Churn Total' e uma coluna 'Churn: <tipo>' por Tipo de Churn (zero quando não há OS);
+      - 'Base Ativa' do tipo de cliente no mês (NaN quando o arquivo não traz o mês);
+      - 'Backlog' do mês (valor geral, repetido em cada tipo de cliente: não se soma entre tipos);
+      - as metas OTL (também gerais) no mês corrente, o último mês com churn.
+    Churn rate, churn operacional e rótulos do gráfico mensal passam a ser operações de colunas
+    sobre esta tabela, sempre com o mesmo ano para churn e base ativa.
+    """
+    df_churn_monthly = aggregate_monthly_churn(df_churn)
+
+    active_base = pd.Series(dtype=float, name='Base Ativa')
+    if df_active_raw is not None and not df_active_raw.empty:
+        active_base = df_active_raw.groupby(['Ano Base Ativa', 'Mes Base Ativa', 'Tipo de Cliente Base Ativa'], dropna=False)['Volume Base Ativa'].sum().rename('Base Ativa')
+        active_base.index.names = fact_table_keys
+
+    backlog = pd.Series(dtype=float, name='Backlog')
+    if df_backlog_raw is not None and not df_backlog_raw.empty:
+        backlog = df_backlog_raw.groupby(['Ano Backlog', 'Mes Backlog'])['Volume Backlog'].sum().rename('Backlog')
+        backlog.index.names = ['Ano', 'Mes']
+
+    # Grade completa: todos os meses dos anos e todos os tipos de cliente de qualquer fonte
+    years = sorted({int(year) for year in df_churn_monthly.index.get_level_values('Ano')} |
+                   {int(year) for year in active_base.index.get_level_values(0)} |
+                   {int(year) for year in backlog.index.get_level_values(0)})
+    client_types = list(pd.unique(pd.concat([
+        df_churn_monthly.index.get_level_values('Tipo de Cliente').to_series(),
+        active_base.index.get_level_values(-1).to_series() if not active_base.empty else pd.Series(dtype=object)
+    ])))
+    grid = pd.MultiIndex.from_product([years, range(1, 13), client_types], names=fact_table_keys)
+
+    churn_columns = list(df_churn_monthly.columns)
+    df_facts = df_churn_monthly.reindex(grid)
+    df_facts[churn_columns] = df_facts[churn_columns].fillna(0).astype('int64')
+    df_facts['Base Ativa'] = active_base.reindex(grid) if not active_base.empty else np.nan
+    df_facts = df_facts.reset_index()
+    df_facts['Backlog'] = backlog.reindex(pd.MultiIndex.from_frame(df_facts[['Ano', 'Mes']])).to_numpy() if not backlog.empty else np.nan
+
+    assign_current_month_otl(df_facts, otl_projections)
+    return df_facts
+
+def aggregate_monthly_churn(df_churn):
+    """Volume de churn por (Ano, Mes, Tipo de Cliente): 'Churn Total' e uma coluna 'Churn: <tipo>' por Tipo de Churn."""
+    df_churn_keys = df_churn.rename(columns={'Ano Churn': 'Ano', 'Mes Churn': 'Mes'})
+    churn_parts = [df_churn_keys.groupby(fact_table_keys, dropna=False)['Volume'].sum().rename('Churn Total')]
+    if 'Tipo de Churn' in df_churn_keys.columns and not df_churn_keys['Tipo de Churn'].isnull().all():
+        df_churn_by_type = df_churn_keys.dropna(subset=['Tipo de Churn']).groupby(fact_table_keys + ['Tipo de Churn'], dropna=False)['Volume'].sum().unstack(fill_value=0)
+        df_churn_by_type.columns = [f"{fact_churn_prefix}{churn_type}" for churn_type in df_churn_by_type.columns]
+        churn_parts.append(df_churn_by_type)
+    return pd.concat(churn_parts, axis=1)
+
+def assign_current_month_otl(df_facts, otl_projections):
+    """Grava as metas OTL (no lugar) nas linhas do mês corrente, o último mês com churn."""
+    for column in fact_otl_columns:
+        df_facts[column] = np.nan
+    current_month = current_fact_month(df_facts)
+    if otl_projections and current_month is not None:
+        current_year, current_month = current_month
+        current_rows = (df_facts['Ano'] == current_year) & (df_facts['Mes'] == current_month)
+        for column in fact_otl_columns:
+            df_facts.loc[current_rows, column] = otl_projections.get(column, np.nan)
+
+def current_fact_month(df_facts):
+    """(Ano, Mes) do mês corrente da tabela de fatos, o último mês com churn, ou None sem churn."""
+    churn_by_month = df_facts.groupby(['Ano', 'Mes'])['Churn Total'].sum()
+    months_with_churn = churn_by_month[churn_by_month > 0]
+    if months_with_churn.empty:
+        return None
+    current_year, current_month = months_with_churn.index[-1]
+    return int(current_year), int(current_month)
+
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_monthly_fact_table(_df_churn, dataset_version, _df_active_raw, _df_backlog_raw, _otl_projections):
+    """Tabela mensal de fatos (ver assemble_monthly_fact_table), em cache por versão do conjunto de dados."""
+    return assemble_monthly_fact_table(_df_churn, _df_active_raw, _df_backlog_raw, _otl_projections)
+
+def fact_churn_columns(df_facts, selected_churn_types):
+    """Colunas de churn da tabela de fatos que correspondem aos tipos de churn selecionados."""
+    if not selected_churn_types:
+        return ['Churn Total']
+    return [f"{fact_churn_prefix}{churn_type}" for churn_type in selected_churn_types if f"{fact_churn_prefix}{churn_type}" in df_facts.columns]
+
+def select_fact_rows(df_facts, selected_years=None, selected_months=None, selected_client_types=None):
+    """Linhas da tabela de fatos nos anos, meses (nomes) e tipos de cliente informados (None = todos)."""
+    mask = pd.Series(True, index=df_facts.index)
+    if selected_years is not None:
+        mask &= df_facts['Ano'].isin([int(year) for year in selected_years])
+    if selected_months is not None:
+        mask &= df_facts['Mes'].isin([month_order_num_pt.index(m)+1 for m in selected_months])
+    if selected_client_types is not None:
+        mask &= df_facts['Tipo de Cliente'].isin(selected_client_types)
+    return df_facts[mask]
+
+# --- Acompanhamento das Metas OTL (realizado x meta e saldo anual de todas as metas de uma vez) ---
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_otl_tracking(_df_facts, dataset_version, _df_otl_targets):
+    """
+    Realizado contra meta de todas as metas OTL (métrica x segmento x mês) em uma única passada
+    vetorizada sobre arrays (métricas x segmentos x meses). Realizado de cada métrica:
+      - OTL Churn: churn executado do tipo de cliente (ou de todos, no segmento 'Geral');
+      - OTL Churn Operacional: churn executado + variação do backlog sobre o mês anterior do
+        calendário (só 'Geral', o backlog não é aberto por tipo de cliente);
+      - OTL Backlog: backlog do mês (só 'Geral').
+    Para cada ano com meta, todos os meses entram com Meta, Realizado, Gap e Gap (%); nas métricas
+    de fluxo dos anos com meta em todos os meses, também os acumulados no ano e o saldo da meta
+    anual (meta do ano - realizado acumulado, a queima da meta) ao lado do saldo planejado (meta
+    do ano - meta acumulada). Com meta em só parte dos meses, os acumulados não se comparam e
+    ficam vazios.
+    Meses depois do corrente ficam sem realizado. Em cache por versão do conjunto de dados.
+    """
+    columns = ['Metrica', 'Segmento', 'Ano', 'Mes', 'AnoMes', 'Meta', 'Realizado', 'Gap', 'Gap (%)',
+               'Meta Acumulada', 'Realizado Acumulado', 'Saldo Planejado', 'Saldo da Meta Anual']
+    current_month = current_fact_month(_df_facts)
+    if _df_otl_targets.empty or current_month is None:
+        return pd.DataFrame(columns=columns)
+    df_targets = resolve_otl_targets(_df_otl_targets, *current_month)
+
+    years = np.array(sorted(set(_df_facts['Ano'].astype(int)) | set(df_targets['Ano'])))
+    client_types = list(pd.unique(_df_facts['Tipo de Cliente']))
+    segments = [otl_total_segment] + client_types
+    # Segmentos das metas sem churn nos dados continuam na tabela, sem realizado
+    segments += [segment for segment in pd.unique(df_targets['Segmento']) if segment not in segments]
+    n_months = len(years) * 12
+    metric_index = {metric: i for i, metric in enumerate(fact_otl_columns)}
+
+    fact_positions = np.searchsorted(years, _df_facts['Ano'].to_numpy()) * 12 + _df_facts['Mes'].to_numpy() - 1
+    type_codes = pd.Index(client_types).get_indexer(_df_facts['Tipo de Cliente'])
+    churn = np.bincount(type_codes * n_months + fact_positions, weights=_df_facts['Churn Total'].to_numpy(dtype=float),
+                        minlength=len(client_types) * n_months).reshape(len(client_types), n_months)
+    backlog = np.full(n_months, np.nan)
+    backlog[fact_positions] = _df_facts['Backlog'].to_numpy(dtype=float)
+
+    actual = np.full((len(fact_otl_columns), len(segments), n_months), np.nan)
+    actual[metric_index['OTL Churn'], 1:len(client_types) + 1] = churn
+    actual[metric_index['OTL Churn'], 0] = churn.sum(axis=0)
+    actual[metric_index['OTL Churn Operacional'], 0] = churn.sum(axis=0) + np.diff(backlog, prepend=np.nan)
+    actual[metric_index['OTL Backlog'], 0] = backlog
+    current_position = np.searchsorted(years, current_month[0]) * 12 + current_month[1] - 1
+    actual[:, :, current_position + 1:] = np.nan
+
+    target = np.full_like(actual, np.nan)
+    target_positions = np.searchsorted(years, df_targets['Ano'].to_numpy()) * 12 + df_targets['Mes'].to_numpy() - 1
+    target[pd.Index(fact_otl_columns).get_indexer(df_targets['Metrica']), pd.Index(segments).get_indexer(df_targets['Segmento']), target_positions] = df_targets['Valor'].to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gap_percent = np.where(target > 0, (actual / target - 1) * 100, np.nan)
+
+    # Acumulados no ano: eixo dos meses separado por ano (métricas x segmentos x anos x 12)
+    year_shape = (len(fact_otl_columns), len(segments), len(years), 12)
+    target_by_year = target.reshape(year_shape)
+    actual_by_year = actual.reshape(year_shape)
+    has_target = ~np.isnan(target_by_year).all(axis=3, keepdims=True)
+    # Meta anual e acumulados só nos anos com meta em todos os meses (no formato antigo, só o mês
+    # corrente tem meta): senão a meta acumulada somaria poucos meses contra o realizado do ano todo
+    full_year_target = ~np.isnan(target_by_year).any(axis=3, keepdims=True)
+    annual_target = np.where(full_year_target, np.nansum(target_by_year, axis=3, keepdims=True), np.nan)
+    cumulative_target = np.where(full_year_target, np.nancumsum(target_by_year, axis=3), np.nan)
+    cumulative_actual = np.where(full_year_target & ~np.isnan(actual_by_year), np.nancumsum(actual_by_year, axis=3), np.nan)
+    stock_metrics = np.isin(fact_otl_columns, otl_stock_metrics)
+    cumulative_target[stock_metrics] = np.nan
+    cumulative_actual[stock_metrics] = np.nan
+    annual_target[stock_metrics] = np.nan
+
+    metric_codes, segment_codes, year_codes, month_codes = np.nonzero(np.broadcast_to(has_target, year_shape))
+    cells = (metric_codes, segment_codes, year_codes * 12 + month_codes)
+    cells_by_year = (metric_codes, segment_codes, year_codes, month_codes)
+    df_tracking = pd.DataFrame({
+        'Metrica': np.asarray(fact_otl_columns, dtype=object)[metric_codes],
+        'Segmento': np.asarray(segments, dtype=object)[segment_codes],
+        'Ano': years[year_codes],
+        'Mes': month_codes + 1,
+        'Meta': target[cells],
+        'Realizado': actual[cells],
+        'Gap': actual[cells] - target[cells],
+        'Gap (%)': gap_percent[cells].round(1),
+        'Meta Acumulada': cumulative_target[cells_by_year],
+        'Realizado Acumulado': cumulative_actual[cells_by_year],
+        'Saldo Planejado': annual_target[metric_codes, segment_codes, year_codes, 0] - cumulative_target[cells_by_year],
+        'Saldo da Meta Anual': annual_target[metric_codes, segment_codes, year_codes, 0] - cumulative_actual[cells_by_year]
+    })
+    df_tracking.insert(4, 'AnoMes', df_tracking['Ano'].astype(str) + '-' + df_tracking['Mes'].astype(str).str.zfill(2))
+    return df_tracking
+
+# --- Eventos de Churn do Dia (arquivo só de acréscimos, somado aos agregados mensais) ---
+def hash_service_orders(df):
+    """Hash de cada OS pelas colunas de identificação, como texto (para .xlsx, JSON e CSV coincidirem)."""
+    return pd.util.hash_pandas_object(df[os_identity_columns].astype(str), index=False).to_numpy()
+
+def apply_churn_event_deltas(df_facts, df_deltas):
+    """
+    Tabela mensal de fatos com os volumes dos eventos do dia somados às colunas de churn. Um ano ou
+    tipo de cliente novo ganha a grade completa de meses (sem base ativa nem backlog) e as metas
+    OTL passam para o último mês com churn, como em assemble_monthly_fact_table.
+    """
+    df_live = df_facts.set_index(fact_table_keys)
+    years = sorted(set(df_live.index.get_level_values('Ano')) | set(df_deltas.index.get_level_values('Ano')))
+    client_types = list(pd.unique(np.concatenate([
+        df_live.index.get_level_values('Tipo de Cliente').to_numpy(), df_deltas.index.get_level_values('Tipo de Cliente').to_numpy()
+    ])))
+    grid = pd.MultiIndex.from_product([years, range(1, 13), client_types], names=fact_table_keys)
+    df_live = df_live.reindex(grid)
+
+    for column in df_deltas.columns:
+        if column not in df_live.columns:
+            df_live[column] = 0
+    churn_columns = ['Churn Total'] + [column for column in df_live.columns if str(column).startswith(fact_churn_prefix)]
+    df_event_volumes = df_deltas.reindex(index=grid, columns=churn_columns).fillna(0)
+    df_live[churn_columns] = (df_live[churn_columns].fillna(0) + df_event_volumes).astype('int64')
+
+    otl_projections = {column: df_live[column].dropna().iloc[0] for column in fact_otl_columns if df_live[column].notna().any()}
+    df_live = df_live.reset_index()
+    assign_current_month_otl(df_live, otl_projections)
+    return df_live
+
+class ChurnEventStream:
+    """
+    Acompanha um arquivo de eventos de churn (JSON Lines ou CSV, com as colunas originais dos
+    arquivos .xlsx) ao qual só se acrescentam linhas. A cada leitura só os bytes novos são lidos,
+    em micro-lotes de até churn_event_batch_max_bytes e até a última linha completa. Cada lote
+    passa por transform_churn_rows (status "Concluído", exclusão de "desconsiderar", Tipo de
+    Cliente e a validação de churn_row_schema) e o seu volume por (Ano, Mes, Tipo de Cliente, Tipo de Churn) é somado aos deltas
+    acumulados. OS que já constam da carga completa ou de um evento anterior são ignoradas.
+    Um leitor por arquivo no servidor (ver get_churn_event_stream), protegido por lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+        self.base_version = None
+        self.base_hashes = np.empty(0, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.header = b''
+        self.sequence = 0 # Lotes com OS novas; entra na versão dos resultados do painel
+        self.df_events = pd.DataFrame()
+        self.event_hashes = np.empty(0, dtype=np.uint64)
+        self.df_deltas = pd.DataFrame()
+        self.counters = {'Linhas Lidas': 0, 'OS Somadas': 0, 'Linhas Ignoradas': 0, 'Linhas em Quarentena': 0, 'Lotes': 0, 'Lotes com Erro': 0}
+        self.last_error = None
+        self._live = None
+
+    def pending_bytes(self):
+        """Bytes acrescentados ao arquivo desde a última leitura."""
+        try:
+            return os.path.getsize(self.path) - self.offset
+        except OSError:
+            return 0
+
+    def _rebase(self, df_churn, dataset_version):
+        # Nova carga completa: os eventos que ela já traz deixam de ser somados
+        self.base_version = dataset_version
+        self.base_hashes = hash_service_orders(df_churn) if not df_churn.empty else np.empty(0, dtype=np.uint64)
+        if not self.df_events.empty:
+            keep = ~np.isin(self.event_hashes, self.base_hashes)
+            self.df_events = self.df_events[keep].reset_index(drop=True)
+            self.event_hashes = self.event_hashes[keep]
+            self.df_deltas = aggregate_monthly_churn(self.df_events) if not self.df_events.empty else pd.DataFrame()
+
+    def _read_batches(self):
+        if os.path.getsize(self.path) < self.offset:
+            # Arquivo truncado ou trocado (rotação diária): recomeça do início
+            self._reset()
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while True:
+                chunk = f.read(churn_event_batch_max_bytes)
+                end = chunk.rfind(b'\n')
+                if end < 0:
+                    return # Nada novo, ou a última linha ainda está sendo gravada
+                chunk = chunk[:end + 1]
+                self.offset += len(chunk)
+                f.seek(self.offset)
+                yield chunk
+
+    def _parse(self, chunk):
+        if self.is_csv:
+            if not self.header:
+                header_end = chunk.index(b'\n') + 1
+                self.header, chunk = chunk[:header_end], chunk[header_end:]
+            if not chunk.strip():
+                return pd.DataFrame()
+            return pd.read_csv(io.BytesIO(self.header + chunk))
+        lines = [line for line in chunk.splitlines() if line.strip()]
+        if not lines:
+            return pd.DataFrame()
+        return pd.read_json(io.BytesIO(b"\n".join(lines)), lines=True, dtype=False, convert_dates=False)
+
+    def _apply_batch(self, df_raw):
+        self.counters['Lotes'] += 1
+        self.counters['Linhas Lidas'] += len(df_raw)
+        df_batch, df_quarantine = transform_churn_rows(df_raw) if not df_raw.empty else (pd.DataFrame(), pd.DataFrame())
+        self.counters['Linhas em Quarentena'] += len(df_quarantine)
+        if not df_batch.empty:
+            hashes = hash_service_orders(df_batch)
+            seen = np.isin(hashes, self.base_hashes) | np.isin(hashes, self.event_hashes) | pd.Series(hashes).duplicated().to_numpy()
+            df_batch, hashes = df_batch[~seen], hashes[~seen]
+        self.counters['Linhas Ignoradas'] += len(df_raw) - len(df_batch) - len(df_quarantine)
+        if df_batch.empty:
+            return
+        self.df_events = pd.concat([self.df_events, df_batch], ignore_index=True)
+        self.event_hashes = np.concatenate([self.event_hashes, hashes])
+        df_batch_deltas = aggregate_monthly_churn(df_batch)
+        self.df_deltas = df_batch_deltas if self.df_deltas.empty else self.df_deltas.add(df_batch_deltas, fill_value=0)
+        self.counters['OS Somadas'] += len(df_batch)
+        self.sequence += 1
+
+    def live_frames(self, df_churn, df_facts, dataset_version):
+        """
+        Lê os eventos novos e retorna (df_churn, df_facts, versão dos resultados, resumo da leitura)
+        com os eventos do dia somados. Sem eventos, devolve os próprios DataFrames e dataset_version.
+        """
+        with self._lock:
+            if dataset_version != self.base_version:
+                self._rebase(df_churn, dataset_version)
+            for chunk in self._read_batches():
+                try:
+                    self._apply_batch(self._parse(chunk))
+                except (ValueError, KeyError) as e:
+                    # Lote malformado (JSON/CSV inválido ou sem as colunas da OS): segue para o próximo
+                    self.counters['Lotes com Erro'] += 1
+                    self.last_error = str(e)
+            df_report = pd.DataFrame([self.counters])
+            if self.df_events.empty:
+                return df_churn, df_facts, dataset_version, df_report
+
+            live_key = (dataset_version, self.sequence)
+            if self._live is None or self._live[0] != live_key:
+                df_events = self.df_events.reindex(columns=df_churn.columns)
+                if all(level in df_churn.columns for level in hierarchy_levels):
+                    df_events = join_hierarchy(df_events, df_churn[hierarchy_levels].drop_duplicates('Filial'))
+                for column in df_churn.columns:
+                    if df_events[column].dtype != df_churn[column].dtype and not pd.api.types.is_numeric_dtype(df_churn[column]):
+                        df_events[column] = df_events[column].astype(str)
+                self._live = (live_key, pd.concat([df_churn, df_events], ignore_index=True), apply_churn_event_deltas(df_facts, self.df_deltas))
+            return self._live[1], self._live[2], f"{dataset_version}+e{self.sequence}", df_report
+
+@st.cache_resource(show_spinner=False)
+def load_churn_event_stream(path):
+    """Leitor único por arquivo de eventos, compartilhado por todas as sessões do servidor."""
+    return ChurnEventStream(path)
+
+def get_churn_event_stream(data_folder):
+    """Leitor dos eventos do dia do conjunto de dados, ou None se a pasta não tem arquivo de eventos."""
+    for file_name in churn_event_files:
+        path = os.path.abspath(os.path.join(data_folder, file_name))
+        if os.path.exists(path):
+            return load_churn_event_stream(path)
+    return None
+
+# --- Churn LTM (janela móvel de 12 meses de todos os segmentos de uma vez) ---
+@instrumented_cache(st.cache_data(show_spinner=False))
+def build_ltm_churn_series(_df_churn, dataset_version, _df_facts):
+    """
+    Séries mensais de churn dos últimos ltm_window_months meses (LTM) para o total e para cada
+    valor de ltm_dimensions: volume LTM, média da base ativa nos meses da janela que constam do
+    arquivo e churn rate LTM (volume / base média). As contagens de todos os segmentos saem de um
+    único np.bincount e as janelas de somas acumuladas (cumsum), sem laço por segmento. Total e
+    Tipo de Churn usam a base ativa de todos os tipos de cliente; Filial não tem base ativa,
+    então só o volume. Em cache por versão do conjunto de dados.
+    """
+    ltm_columns = ['Dimensão', 'Segmento', 'AnoMes', 'Ano', 'Mes', 'Churn LTM', 'Base Ativa Média LTM', 'Meses com Base Ativa', 'Churn Rate LTM (%)']
+    if _df_churn.empty:
+        return pd.DataFrame(columns=ltm_columns)
+
+    # Índice do mês numa linha do tempo contínua, do primeiro ao último mês com churn
+    month_number = _df_churn['Ano Churn'].to_numpy(dtype=np.int64) * 12 + _df_churn['Mes Churn'].to_numpy(dtype=np.int64) - 1
+    first_month = month_number.min()
+    n_months = int(month_number.max() - first_month + 1)
+    if n_months < ltm_window_months:
+        return pd.DataFrame(columns=ltm_columns)
+    time_idx = month_number - first_month
+
+    # Segmentos empilhados: o total e, em seguida, os valores de cada dimensão
+    segment_dimensions = ['Total']
+    segment_labels = ['Total']
+    segment_idx = [np.zeros(len(_df_churn), dtype=np.int64)]
+    for column in [column for column in ltm_dimensions if column in _df_churn.columns]:
+        codes, uniques = pd.factorize(_df_churn[column].astype(str), sort=True, use_na_sentinel=False)
+        segment_idx.append(codes + len(segment_labels))
+        segment_dimensions += [column] * len(uniques)
+        segment_labels += list(uniques)
+    n_segments = len(segment_labels)
+
+    volume = np.bincount(
+        np.concatenate(segment_idx) * n_months + np.tile(time_idx, len(segment_idx)),
+        weights=np.tile(_df_churn['Volume'].to_numpy(dtype=float), len(segment_idx)),
+        minlength=n_segments * n_months
+    ).reshape(n_segments, n_months)
+
+    # Base ativa na mesma linha do tempo (NaN nos meses que não constam do arquivo)
+    active = np.full((n_segments, n_months), np.nan)
+    df_active = _df_facts[_df_facts['Base Ativa'].notna()]
+    active_time_idx = df_active['Ano'].to_numpy(dtype=np.int64) * 12 + df_active['Mes'].to_numpy(dtype=np.int64) - 1 - first_month
+    in_range = (active_time_idx >= 0) & (active_time_idx < n_months)
+    if in_range.any():
+        df_active_by_type = df_active[in_range].assign(Indice=active_time_idx[in_range]).pivot_table(
+            index='Tipo de Cliente', columns='Indice', values='Base Ativa', aggfunc='sum'
+        ).reindex(columns=range(n_months))
+        df_active_by_type.index = df_active_by_type.index.astype(str)
+        active_total = df_active_by_type.sum(min_count=1).to_numpy()
+        segment_dimensions_array = np.asarray(segment_dimensions)
+        active[np.isin(segment_dimensions_array, ['Total', 'Tipo de Churn'])] = active_total
+        client_type_rows = np.flatnonzero(segment_dimensions_array == 'Tipo de Cliente')
+        active[client_type_rows] = df_active_by_type.reindex([segment_labels[row] for row in client_type_rows]).to_numpy()
+
+    def rolling_sum(values):
+        cumulative = np.concatenate([np.zeros((n_segments, 1)), np.cumsum(values, axis=1)], axis=1)
+        return cumulative[:, ltm_window_months:] - cumulative[:, :-ltm_window_months]
+
+    churn_ltm = rolling_sum(volume)
+    active_months = rolling_sum((~np.isnan(active)).astype(float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        active_average = np.where(active_months > 0, rolling_sum(np.nan_to_num(active)) / active_months, np.nan)
+        churn_rate_ltm = np.where(active_average > 0, churn_ltm / active_average * 100, np.nan)
+
+    n_windows = churn_ltm.shape[1]
+    window_end = np.arange(ltm_window_months - 1, n_months) + first_month
+    return pd.DataFrame({
+        'Dimensão': np.repeat(segment_dimensions, n_windows),
+        'Segmento': np.repeat(np.asarray(segment_labels, dtype=object), n_windows),
+        'AnoMes': np.tile([f"{number // 12}-{number % 12 + 1:02d}" for number in window_end], n_segments),
+        'Ano': np.tile(window_end // 12, n_segments),
+        'Mes': np.tile(window_end % 12 + 1, n_segments),
+        'Churn LTM': churn_ltm.ravel().astype('int64'),
+        'Base Ativa Média LTM': active_average.ravel(),
+        'Meses com Base Ativa': active_months.ravel().astype('int64'),
+        'Churn Rate LTM (%)': churn_rate_ltm.ravel()
+    }, columns=ltm_columns)
+
+# --- Simulador de Cenários (reduções de churn contra a meta OTL) ---
+@instrumented_cache(st.cache_data(show_spinner=False, max_entries=result_cache_max_entries), max_entries=result_cache_max_entries)
+def build_scenario_cube(_df_churn, dataset_version, _df_facts, year, months, client_types, churn_types):
+    """
+    Agregados mensais que os cenários reduzem: volume de churn por mês x motivo x Tipo de Churn
+    no ano, meses e tipos informados (só meses com churn, como na projeção do churn rate), a
+    média mensal da base ativa do mesmo ano e a meta OTL Churn do mês corrente.
+    """
+    month_nums = [month_order_num_pt.index(month) + 1 for month in months]
+    df_year = _df_churn[
+        (_df_churn['Ano Churn'] == year) &
+        (_df_churn['Mes Churn'].isin(month_nums)) &
+        (_df_churn['Tipo de Cliente'].isin(client_types))
+    ]
+    if churn_types:
+        df_year = df_year[df_year['Tipo de Churn'].isin(churn_types)]
+
+    month_codes, cube_months = pd.factorize(df_year['Mes Churn'], sort=True)
+    reason_codes, reasons = pd.factorize(df_year['Categoria4_Motivo'].astype(str), sort=True, use_na_sentinel=False)
+    type_codes, types = pd.factorize(df_year['Tipo de Churn'].astype(str), sort=True, use_na_sentinel=False)
+    shape = (len(cube_months), len(reasons), len(types))
+    cells = np.bincount(
+        np.ravel_multi_index((month_codes, reason_codes, type_codes), shape),
+        weights=df_year['Volume'].to_numpy(dtype=float),
+        minlength=int(np.prod(shape))
+    ).reshape(shape)
+
+    active_by_month = select_fact_rows(_df_facts, [year], months, client_types).groupby('Mes')['Base Ativa'].sum(min_count=1).dropna()
+    otl_churn = _df_facts['OTL Churn'].dropna()
+    return {
+        'cells': cells,
+        'months': [int(month) for month in cube_months],
+        'reasons': [str(reason) for reason in reasons],
+        'churn_types': [str(churn_type) for churn_type in types],
+        'avg_monthly_active': float(active_by_month.mean()) if not active_by_month.empty else 0.0,
+        'otl_churn': float(otl_churn.iloc[0]) if not otl_churn.empty and otl_churn.iloc[0] > 0 else None
+    }
+
+def simulate_churn_scenarios(cube, reason_reductions, churn_type_reductions, n_simulations=scenario_simulations, seed=scenario_seed):
+    """
+    Avalia vários cenários de uma vez. reason_reductions (cenários x motivos) e
+    churn_type_reductions (cenários x tipos) são frações de 0 a 1 aplicadas de forma
+    multiplicativa em cada célula mês x motivo x tipo. Para cada cenário: churn anual projetado
+    (média mensal x 12), churn rate anual sobre a média da base ativa e, por Monte Carlo (12
+    meses reamostrados dos meses observados e efeito realizado sorteado em torno do planejado),
+    os percentis scenario_band_percentiles do churn rate e a probabilidade de ficar na meta OTL
+    anualizada. Tudo por broadcasting/einsum, sem laço por cenário ou simulação.
+    """
+    reason_reductions = np.atleast_2d(np.asarray(reason_reductions, dtype=float))
+    churn_type_reductions = np.atleast_2d(np.asarray(churn_type_reductions, dtype=float))
+    n_scenarios = max(len(reason_reductions), len(churn_type_reductions))
+    cells = cube['cells']
+    avg_active = cube['avg_monthly_active']
+    target_rate = cube['otl_churn'] * 12 / avg_active * 100 if cube['otl_churn'] and avg_active > 0 else np.nan
+
+    def to_rate(annual_churn):
+        return annual_churn / avg_active * 100 if avg_active > 0 else np.full_like(annual_churn, np.nan)
+
+    # Estimativa pontual: cada célula vezes (1 - redução do motivo) x (1 - redução do tipo)
+    monthly = np.einsum('mrt,sr,st->sm', cells, 1 - reason_reductions, 1 - churn_type_reductions) # (cenários, meses)
+    n_months = monthly.shape[1]
+    annual_churn = monthly.mean(axis=1) * 12 if n_months else np.zeros(n_scenarios)
+
+    # Monte Carlo: efeito realizado de cada alavanca e ano formado por 12 meses reamostrados
+    rng = np.random.default_rng(seed)
+    spread = 1 + scenario_effect_spread * rng.uniform(-1, 1, size=(n_simulations, cells.shape[1] + cells.shape[2]))
+    reason_factors = 1 - np.clip(reason_reductions[:, None, :] * spread[None, :, :cells.shape[1]], 0, 1) # (cenários, sim, motivos)
+    type_factors = 1 - np.clip(churn_type_reductions[:, None, :] * spread[None, :, cells.shape[1]:], 0, 1)
+    simulated_annual = np.zeros((n_scenarios, n_simulations))
+    if n_months:
+        sampled_months = rng.integers(0, n_months, size=(n_simulations, 12))
+        month_counts = np.bincount(
+            (sampled_months + n_months * np.arange(n_simulations)[:, None]).ravel(), minlength=n_simulations * n_months
+        ).reshape(n_simulations, n_months) # Quantas vezes cada mês entrou em cada simulação
+        simulated_annual = np.einsum('mrt,skr,skt,km->sk', cells, reason_factors, type_factors, month_counts, optimize=True)
+    simulated_rate = to_rate(simulated_annual)
+
+    df_scenarios = pd.DataFrame({
+        'Churn Anual Projetado': annual_churn,
+        'Churn Rate Anual (%)': to_rate(annual_churn),
+        'Meta OTL (%)': target_rate
+    })
+    for percentile, values in zip(scenario_band_percentiles, np.percentile(simulated_rate, scenario_band_percentiles, axis=1)):
+        df_scenarios[f"P{percentile} (%)"] = values
+    df_scenarios['Prob. na Meta (%)'] = (simulated_rate <= target_rate).mean(axis=1) * 100 if not np.isnan(target_rate) else np.nan
+    return df_scenarios
+
+# --- Cálculo dos KPIs e Agregados do Painel (sem chamadas ao Streamlit) ---
+def get_filter_options(df_churn):
+    """Valores disponíveis em cada filtro da barra lateral, na ordem exibida."""
+    all_churn_types = []
+    if 'Tipo de Churn' in df_churn.columns and not df_churn['Tipo de Churn'].isnull().all():
+        all_churn_types = list(df_churn['Tipo de Churn'].unique())
+    return {
+        'years': sorted(df_churn['Ano Churn'].unique()),
+        'months': sorted(df_churn['Nome Mes Churn'].unique(), key=lambda x: month_order_num_pt.index(x)),
+        'client_types': list(df_churn['Tipo de Cliente'].unique()),
+        'churn_types': all_churn_types
+    }
+
+def build_selection(filter_options, selected_years, selected_months, selected_client_types, selected_churn_types):
+    """Agrupa a seleção dos filtros (já com "Todos" expandido) e as opções disponíveis em um dicionário."""
+    return {
+        'years': list(selected_years),
+        'months': list(selected_months),
+        'client_types': list(selected_client_types),
+        'churn_types': list(selected_churn_types),
+        'all_months': list(filter_options['months']),
+        'all_client_types': list(filter_options['client_types']),
+        'all_churn_types': list(filter_options['churn_types'])
+    }
+
+def selection_key(selection):
+    """Chave canônica da seleção: a mesma para "Todos" e para todos os valores marcados um a um."""
+    return (
+        tuple(sorted(int(year) for year in selection['years'])),
+        tuple(sorted(selection['months'], key=month_order_num_pt.index)),
+        tuple(sorted(str(value) for value in selection['client_types'])),
+        tuple(sorted(str(value) for value in selection['churn_types']))
+    )
+
+def filter_churn_data(df_churn, selection):
+    """Aplica os filtros de ano, mês, tipo de cliente e tipo de churn."""
+    df_filtered = df_churn[
+        (df_churn['Ano Churn'].isin(selection['years'])) &
+        (df_churn['Nome Mes Churn'].isin(selection['months'])) &
+        (df_churn['Tipo de Cliente'].isin(selection['client_types']))
+    ]
+    if 'Tipo de Churn' in df_filtered.columns and selection['churn_types']:
+        df_filtered = df_filtered[df_filtered['Tipo de Churn'].isin(selection['churn_types'])]
+    return df_filtered
+
+def compute_operational_backlog_terms(df_facts, selected_years, selected_months, selected_client_types):
+    """
+    Parte do churn operacional que não depende do churn filtrado: para cada mês selecionado do
+    último ano selecionado, a variação do backlog e a base ativa dos tipos de cliente escolhidos.
+    Retorna (ano, [(mês, variação do backlog, base ativa), ...]) ou None sem dados suficientes.
+    """
+    backlog_by_month = df_facts.groupby(['Ano', 'Mes'])['Backlog'].first().dropna()
+    if backlog_by_month.empty or not selected_years or not selected_months or df_facts['Base Ativa'].isna().all():
+        return None
+
+    current_year_for_backlog = max(selected_years)
+    sorted_selected_month_nums = sorted([month_order_num_pt.index(m) + 1 for m in selected_months])
+    df_active_year = select_fact_rows(df_facts, [current_year_for_backlog], None, selected_client_types)
+    active_base_by_month = df_active_year.groupby('Mes')['Base Ativa'].sum()
+
+    def backlog_volume(year, month_num):
+        return int(backlog_by_month.get((year, month_num), 0))
+
+    terms = []
+    for i, current_month_num in enumerate(sorted_selected_month_nums):
+        backlog_previous_month = 0
+        if len(sorted_selected_month_nums) == 1:
+            # Um único mês: compara com o mês anterior do calendário (dezembro de 2024 para janeiro de 2025)
+            if current_month_num == 1 and current_year_for_backlog == 2025:
+                backlog_previous_month = backlog_volume(2024, 12)
+            elif current_month_num > 1:
+                backlog_previous_month = backlog_volume(current_year_for_backlog, current_month_num - 1)
+        elif i > 0:
+            # Vários meses: compara com o mês selecionado anterior
+            backlog_previous_month = backlog_volume(current_year_for_backlog, sorted_selected_month_nums[i-1])
+        elif current_month_num == 1 and current_year_for_backlog > backlog_by_month.index.get_level_values('Ano').min():
+            backlog_previous_month = backlog_volume(current_year_for_backlog - 1, 12)
+
+        delta_backlog = backlog_volume(current_year_for_backlog, current_month_num) - backlog_previous_month
+        active_base_current_month = int(active_base_by_month.get(current_month_num, 0))
+        terms.append((current_month_num, delta_backlog, active_base_current_month))
+
+    return current_year_for_backlog, terms
+
+def combine_operational_churn(df_facts, backlog_terms, selected_client_types, selected_churn_types):
+    """
+    Soma a variação do backlog e o churn executado de cada mês (ver
+    compute_operational_backlog_terms) e calcula o percentual sobre a base ativa do período.
+    """
+    if backlog_terms is None:
+        return "N/A", "N/A"
+
+    current_year_for_backlog, terms = backlog_terms
+    df_facts_year = select_fact_rows(df_facts, [current_year_for_backlog], None, selected_client_types)
+    churn_by_month = df_facts_year.groupby('Mes')[fact_churn_columns(df_facts, selected_churn_types)].sum().sum(axis=1)
+
+    churn_operacional_value = 0
+    total_active_base_period = 0
+    for current_month_num, delta_backlog, active_base_current_month in terms:
+        churn_volume_current_month = int(churn_by_month.get(current_month_num, 0))
+        churn_operacional_value += (delta_backlog + churn_volume_current_month)
+        total_active_base_period += active_base_current_month
+
+    if total_active_base_period > 0:
+        churn_operacional_percentage = (churn_operacional_value / total_active_base_period) * 100
+    else:
+        churn_operacional_percentage = "N/A"
+    return churn_operacional_value, churn_operacional_percentage
+
+def compute_operational_churn(df_facts, selected_years, selected_months, selected_client_types, selected_churn_types):
+    """
+    Churn operacional (variação do backlog + churn executado) e seu percentual sobre a base ativa,
+    para o último ano selecionado. Retorna "N/A" quando não há dados suficientes.
+    """
+    backlog_terms = compute_operational_backlog_terms(df_facts, selected_years, selected_months, selected_client_types)
+    return combine_operational_churn(df_facts, backlog_terms, selected_client_types, selected_churn_types)
+
+def compute_annual_projection(df_filtered, selection, df_forecasts):
+    """
+    Projeção anual de churn do último ano selecionado. Usa a projeção sazonal pré-calculada
+    quando a seleção corresponde a uma das séries projetadas; caso contrário, a média mensal
+    (acumulado / meses * 12). Retorna o valor e, no primeiro caso, o modelo e o intervalo.
+    """
+    projected_annual_churn = 0
+    forecast_info = None
+    selected_years = selection['years']
+    if selected_years:
+        current_year_churn_proj = max(selected_years)
+        forecast_row = lookup_churn_forecast(
+            df_forecasts, current_year_churn_proj, selection['months'], selection['all_months'],
+            selection['client_types'], selection['all_client_types'], selection['churn_types'], selection['all_churn_types']
+        )
+
+        if forecast_row is not None:
+            projected_annual_churn = forecast_row['Projecao']
+            forecast_info = {
+                'model': forecast_row['Modelo'],
+                'lower': forecast_row['Limite Inferior'],
+                'upper': forecast_row['Limite Superior']
+            }
+        else:
+            df_current_year_churn = df_filtered[df_filtered['Ano Churn'] == current_year_churn_proj]
+
+            if not df_current_year_churn.empty:
+                max_month_data_churn = df_current_year_churn['Mes Churn'].max()
+                churn_accumulated = df_current_year_churn[df_current_year_churn['Mes Churn'] <= max_month_data_churn]['Volume'].sum()
+                num_months_data_churn = df_current_year_churn['Mes Churn'].nunique()
+
+                if num_months_data_churn > 0:
+                    projected_annual_churn = (churn_accumulated / num_months_data_churn) * 12
+
+    return projected_annual_churn, forecast_info
+
+def compute_churn_rate_projection(df_facts, selected_years, selected_months, selected_client_types, selected_churn_types, forecast_projection=None):
+    """
+    Projeção do churn rate anual (%) e média mensal da base ativa usada como denominador, ambas
+    no último ano selecionado. O numerador é forecast_projection (a projeção sazonal do KPI
+    "Projeção Anual Churn") quando informado; sem projeção sazonal, a média mensal dos meses com
+    churn projetada para 12 meses. Retorna ("N/A" ou o percentual, média mensal da base ativa).
+    """
+    churn_rate_value = "N/A"
+    projected_annual_churn_calc = 0
+    avg_monthly_active_calc = 0
+
+    if selected_years:
+        current_year_churn_proj_calc = max(selected_years)
+        df_facts_year = select_fact_rows(df_facts, [current_year_churn_proj_calc], selected_months, selected_client_types)
+        grouped_by_month = df_facts_year.groupby('Mes')
+        churn_by_month = grouped_by_month[fact_churn_columns(df_facts, selected_churn_types)].sum().sum(axis=1)
+        active_by_month = grouped_by_month['Base Ativa'].sum(min_count=1)
+
+        if forecast_projection is not None:
+            # Mesma projeção sazonal exibida em "Projeção Anual Churn"
+            projected_annual_churn_calc = forecast_projection
+        else:
+            # Média mensal dos meses com churn, projetada para 12 meses
+            months_with_churn = churn_by_month[churn_by_month > 0]
+            if not months_with_churn.empty:
+                projected_annual_churn_calc = (months_with_churn.sum() / len(months_with_churn)) * 12
+
+        # Média mensal da base ativa nos meses que constam do arquivo
+        months_with_active = active_by_month.dropna()
+        if not months_with_active.empty:
+            avg_monthly_active_calc = months_with_active.sum() / len(months_with_active)
+
+    if avg_monthly_active_calc > 0:
+        churn_rate_value = (projected_annual_churn_calc / avg_monthly_active_calc) * 100
+
+    return churn_rate_value, avg_monthly_active_calc
+
+def compute_yoy_variation(df_churn, selected_months, selected_client_types, selected_churn_types):
+    """
+    Variação do churn executado 2025 vs 2024 nos meses selecionados: diferença absoluta e
+    média das variações percentuais mensais.
+    """
+    df_churn_for_kpi_comparison = df_churn
+    if selected_client_types:
+        df_churn_for_kpi_comparison = df_churn_for_kpi_comparison[df_churn_for_kpi_comparison['Tipo de Cliente'].isin(selected_client_types)]
+    if selected_churn_types:
+        df_churn_for_kpi_comparison = df_churn_for_kpi_comparison[df_churn_for_kpi_comparison['Tipo de Churn'].isin(selected_churn_types)]
+
+    # Lógica para obter a variação anual (média das variações mensais)
+    df_monthly_volumes_kpi = df_churn_for_kpi_comparison[
+        df_churn_for_kpi_comparison['Ano Churn'].isin([2024, 2025])
+    ].groupby(['Ano Churn', 'Mes Churn']).agg(
+            Volume_Churn=('Volume', 'sum')
+    ).reset_index()
+
+    df_comparison = df_monthly_volumes_kpi.pivot_table(
+        index='Mes Churn',
+        columns='Ano Churn',
+        values='Volume_Churn'
+    ).reset_index()
+
+    selected_month_nums = [month_order_num_pt.index(m)+1 for m in selected_months]
+    df_comparison_filtered_months = df_comparison[df_comparison['Mes Churn'].isin(selected_month_nums)].copy()
+
+    df_comparison_filtered_months[2024] = df_comparison_filtered_months.get(2024, pd.Series(0, index=df_comparison_filtered_months.index)).fillna(0)
+    df_comparison_filtered_months[2025] = df_comparison_filtered_months.get(2025, pd.Series(0, index=df_comparison_filtered_months.index)).fillna(0)
+
+    # Calcular a diferença absoluta total para os meses selecionados
+    absolute_diff_yoy = df_comparison_filtered_months[2025].sum() - df_comparison_filtered_months[2024].sum()
+
+    # Calcular a variação percentual média mensal
+    df_comparison_filtered_months['Monthly_Variation'] = pd.NA
+    valid_comparison_rows = df_comparison_filtered_months[df_comparison_filtered_months[2024] > 0]
+    if not valid_comparison_rows.empty:
+        df_comparison_filtered_months.loc[valid_comparison_rows.index, 'Monthly_Variation'] = \
+            (valid_comparison_rows[2025] - valid_comparison_rows[2024]) / valid_comparison_rows[2024]
+    average_monthly_percentage_variation = df_comparison_filtered_months['Monthly_Variation'].mean()
+
+    return absolute_diff_yoy, average_monthly_percentage_variation
+
+def compute_total_churn_2025(df_churn, selected_months, selected_client_types, selected_churn_types):
+    """Total de churn executado em 2025 nos meses e tipos selecionados (independe do filtro de ano)."""
+    df_churn_2025_kpi = df_churn[df_churn['Ano Churn'] == 2025]
+    df_churn_2025_kpi = df_churn_2025_kpi[
+        (df_churn_2025_kpi['Nome Mes Churn'].isin(selected_months)) &
+        (df_churn_2025_kpi['Tipo de Cliente'].isin(selected_client_types))
+    ]
+    if selected_churn_types:
+        df_churn_2025_kpi = df_churn_2025_kpi[df_churn_2025_kpi['Tipo de Churn'].isin(selected_churn_types)]
+    return df_churn_2025_kpi['Volume'].sum()
+
+def compute_kpis(df_churn, df_filtered, df_facts, selection, df_forecasts):
+    """Valores de todos os KPIs do topo do painel para a seleção informada."""
+    selected_years = selection['years']
+    selected_months = selection['months']
+    selected_client_types = selection['client_types']
+    selected_churn_types = selection['churn_types']
+
+    churn_operacional_value, churn_operacional_percentage = compute_operational_churn(
+        df_facts, selected_years, selected_months, selected_client_types, selected_churn_types
+    )
+    projected_annual_churn, forecast_info = compute_annual_projection(df_filtered, selection, df_forecasts)
+    churn_rate_value, avg_monthly_active = compute_churn_rate_projection(
+        df_facts, selected_years, selected_months, selected_client_types, selected_churn_types,
+        forecast_projection=projected_annual_churn if forecast_info is not None else None
+    )
+    absolute_diff_yoy, average_monthly_percentage_variation = compute_yoy_variation(
+        df_churn, selected_months, selected_client_types, selected_churn_types
+    )
+
+    return {
+        'total_churn_2025': compute_total_churn_2025(df_churn, selected_months, selected_client_types, selected_churn_types),
+        'churn_operacional_value': churn_operacional_value,
+        'churn_operacional_percentage': churn_operacional_percentage,
+        'projected_annual_churn': projected_annual_churn,
+        'forecast_info': forecast_info,
+        'churn_rate_value': churn_rate_value,
+        'avg_monthly_active': avg_monthly_active,
+        'absolute_diff_yoy': absolute_diff_yoy,
+        'average_monthly_percentage_variation': average_monthly_percentage_variation
+    }
+
+def compute_active_monthly_volumes(df_facts, selected_months, selected_client_types):
+    """Base ativa por ano e mês para os meses e tipos de cliente selecionados, com os nomes de coluna do churn."""
+    df_facts_selected = select_fact_rows(df_facts, None, selected_months, selected_client_types)
+    active_by_month = df_facts_selected.groupby(['Ano', 'Mes'])['Base Ativa'].sum(min_count=1).dropna()
+    df_active_monthly_volumes = pd.DataFrame({
+        'Ano Churn': active_by_month.index.get_level_values('Ano').astype(int),
+        'Mes Churn': active_by_month.index.get_level_values('Mes').astype(int),
+        'Nome Mes Churn': [month_order_num_pt[month - 1] for month in active_by_month.index.get_level_values('Mes')],
+        'Volume_Base_Ativa': active_by_month.to_numpy().astype('int64')
+    })
+    return df_active_monthly_volumes
+
+def compute_monthly_volume_chart(df_filtered, df_active_monthly_volumes=None):
+    """
+    Dados do gráfico de volume mensal (aba 1): volume por ano e mês, churn rate sobre a base
+    ativa do mesmo ano e mês, rótulos das barras e variação YoY no eixo X. Retorna o DataFrame
+    e a ordem do eixo. Sem base ativa (ver compute_active_monthly_volumes), só o volume.
+    """
+    if df_active_monthly_volumes is None:
+        df_active_monthly_volumes = pd.DataFrame(columns=['Ano Churn', 'Mes Churn', 'Nome Mes Churn', 'Volume_Base_Ativa'])
+
+    df_plot_monthly_volume = df_filtered.groupby(['Ano Churn', 'Mes Churn', 'Nome Mes Churn']).agg(
+        Volume_Churn=('Volume', 'sum')
+    ).reset_index().sort_values(by=['Ano Churn', 'Mes Churn'])
+
+    df_plot_monthly_volume = pd.merge(
+        df_plot_monthly_volume,
+        df_active_monthly_volumes,
+        on=['Ano Churn', 'Mes Churn', 'Nome Mes Churn'],
+        how='left'
+    )
+    
+    df_plot_monthly_volume['Churn_Rate'] = df_plot_monthly_volume.apply(
+        lambda row: (row['Volume_Churn'] / row['Volume_Base_Ativa'] * 100) if row['Volume_Base_Ativa'] > 0 else float('nan'),
+        axis=1
+    )
+    
+    df_plot_monthly_volume['Bar_Text_Label'] = df_plot_monthly_volume.apply(
+        lambda row: (
+            f"{row['Volume_Churn']:,.0f}".replace(",", ".") +
+            (f"<br>{row['Churn_Rate']:.2f}%".replace(".", ",") if pd.notna(row['Churn_Rate']) else "")
+        ),
+        axis=1
+    )
+
+    df_yoy_comparison = df_plot_monthly_volume.pivot_table(
+        index=['Mes Churn', 'Nome Mes Churn'],
+        columns='Ano Churn',
+        values='Volume_Churn'
+    ).reset_index()
+
+    if 2024 in df_yoy_comparison.columns and 2025 in df_yoy_comparison.columns:
+        df_yoy_comparison['YoY_Variation'] = (
+            (df_yoy_comparison[2025] - df_yoy_comparison[2024]) /
+            df_yoy_comparison[2024].replace(0, pd.NA)
+        ).fillna(pd.NA)
+    else:
+        df_yoy_comparison['YoY_Variation'] = pd.NA
+
+    df_yoy_pivot_for_label = df_yoy_comparison.copy()
+    df_yoy_pivot_for_label['X_Axis_Month_Label'] = df_yoy_pivot_for_label.apply(
+        lambda row: (
+            f"{row['Nome Mes Churn']}" +
+            (f"<br>({row['YoY_Variation']:.1%})".replace(".", ",") if pd.notna(row['YoY_Variation']) else "")
+        ),
+        axis=1
+    )
+
+    df_plot_monthly = pd.merge(
+        df_plot_monthly_volume,
+        df_yoy_pivot_for_label[['Mes Churn', 'X_Axis_Month_Label', 'YoY_Variation']],
+        on='Mes Churn',
+        how='left'
+    )
+    category_order = sorted(df_yoy_pivot_for_label['X_Axis_Month_Label'].unique(), key=lambda x: month_order_num_pt.index(x.split('<br>')[0]) if '<br>' in x else month_order_num_pt.index(x))
+    return df_plot_monthly, category_order
+
+def compute_client_type_comparison(df_churn, selection):
+    """
+    Volumes por Tipo de Cliente em 2024 e 2025 (aba 2) e as diferenças absoluta e percentual.
+    Retorna (volumes 2024, volumes 2025, comparação).
+    """
+    plots = {}
+    for year in [2024, 2025]:
+        df_churn_year = df_churn[
+            (df_churn['Ano Churn'] == year) &
+            (df_churn['Nome Mes Churn'].isin(selection['months'])) &
+            (df_churn['Tipo de Cliente'].isin(selection['client_types']))
+        ]
+        if selection['churn_types']:
+            df_churn_year = df_churn_year[df_churn_year['Tipo de Churn'].isin(selection['churn_types'])]
+
+        plots[year] = df_churn_year.groupby('Tipo de Cliente').agg(
+            Volume_Churn=('Volume', 'sum')
+        ).reset_index().sort_values(by='Volume_Churn', ascending=False)
+
+    df_comparison_client_type = pd.merge(
+        plots[2024].rename(columns={'Volume_Churn': 'Volume_2024'}),
+        plots[2025].rename(columns={'Volume_Churn': 'Volume_2025'}),
+        on='Tipo de Cliente',
+        how='outer'
+    ).fillna(0)
+
+    df_comparison_client_type['Diferenca_Absoluta'] = df_comparison_client_type['Volume_2025'] - df_comparison_client_type['Volume_2024']
+    
+    df_comparison_client_type['Diferenca_Percentual'] = df_comparison_client_type.apply(
+        lambda row: ((row['Volume_2025'] - row['Volume_2024']) / row['Volume_2024']) * 100 if row['Volume_2024'] != 0 else (100 if row['Volume_2025'] > 0 else 0),
+        axis=1
+    )
+    return plots[2024], plots[2025], df_comparison_client_type
+
+def compute_churn_type_monthly(df_filtered):
+    """Volume mensal por Tipo de Churn (aba 3), ou None se não houver a coluna."""
+    if 'Tipo de Churn' not in df_filtered.columns or df_filtered['Tipo de Churn'].isnull().all():
+        return None
+    df_plot_churn_type_monthly = df_filtered.groupby(['Ano Churn', 'Mes Churn', 'Nome Mes Churn', 'Tipo de Churn']).agg(
+        Volume_Churn=('Volume', 'sum')
+    ).reset_index()
+
+    df_plot_churn_type_monthly['Nome Mes Abreviado'] = df_plot_churn_type_monthly['Nome Mes Churn'].map(month_to_abbr_map)
+    return df_plot_churn_type_monthly
+
+def compute_year_comparison_table(df_filtered, column, excluded_values, new_item_label, display_column):
+    """
+    Tabela 2025 vs 2024 por categoria (motivo ou filial): volumes, participação em cada ano e
+    variação. Ignora valores vazios e os excluídos. Retorna um DataFrame vazio se não houver dados.
+    """
+    summaries = {}
+    for year in [2025, 2024]:
+        summaries[year] = pd.DataFrame(columns=[column, f'Volume_{year}'])
+        df_year = df_filtered[df_filtered['Ano Churn'] == year]
+        if column in df_year.columns and not df_year[column].isnull().all():
+            df_year_clean = df_year.copy()
+            df_year_clean['Valor_Lower'] = df_year_clean[column].astype(str).str.strip().str.lower()
+            df_year_clean = df_year_clean[~df_year_clean['Valor_Lower'].isin(['', 'nan'] + excluded_values)]
+
+            if not df_year_clean.empty:
+                summaries[year] = df_year_clean.groupby(column).agg(**{f'Volume_{year}': ('Volume', 'sum')}).reset_index()
+
+    if summaries[2025].empty and summaries[2024].empty:
+        return pd.DataFrame()
+
+    df_combined = pd.merge(summaries[2025], summaries[2024], on=column, how='outer').fillna(0)
+    return format_year_comparison_table(df_combined, column, new_item_label, display_column)
+
+def format_year_comparison_table(df_combined, column, new_item_label, display_column):
+    """
+    Participações, variação e formatação da tabela 2025 vs 2024 a partir dos volumes por categoria
+    (colunas column, Volume_2025 e Volume_2024). Também refaz a tabela depois do Top-N.
+    """
+    df_combined = df_combined.copy()
+    df_combined['Volume_2025_Total'] = df_combined['Volume_2025'].sum()
+    df_combined['Volume_2024_Total'] = df_combined['Volume_2024'].sum()
+
+    df_combined['Percentual_2025'] = df_combined.apply(
+        lambda row: (row['Volume_2025'] / row['Volume_2025_Total']) * 100 if row['Volume_2025_Total'] > 0 else 0, axis=1
+    )
+    
+    df_combined['Percentual_2024'] = df_combined.apply(
+        lambda row: (row['Volume_2024'] / row['Volume_2024_Total']) * 100 if row['Volume_2024_Total'] > 0 else 0, axis=1
+    )
+
+    df_combined['Variação 2025 vs 2024'] = df_combined.apply(
+        lambda row: (
+            ((row['Volume_2025'] / row['Volume_2024']) - 1) * 100
+            if row['Volume_2024'] > 0 else (
+                float('inf') if row['Volume_2025'] > 0 else 0
+            )
+        ),
+        axis=1
+    )
+    
+    df_display = df_combined.copy()
+    df_display['Volume_2025'] = df_display['Volume_2025'].astype(int)
+    df_display['Volume_2024'] = df_display['Volume_2024'].astype(int)
+    df_display['Percentual_2025'] = df_display['Percentual_2025'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
+    df_display['Percentual_2024'] = df_display['Percentual_2024'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
+    
+    df_display['Variação 2025 vs 2024'] = df_display['Variação 2025 vs 2024'].apply(
+        lambda x: f"{x:.2f}%".replace('.', ',') if pd.notna(x) and x != float('inf') else (new_item_label if x == float('inf') else "0,00%")
+    )
+    
+    df_display.rename(columns={
+        column: display_column,
+        'Volume_2025': 'Volume 2025',
+        'Percentual_2025': '% 2025',
+        'Volume_2024': 'Volume 2024',
+        'Percentual_2024': '% 2024'
+    }, inplace=True)
+
+    return df_display[[
+        display_column, 'Volume 2025', '% 2025',
+        'Volume 2024', '% 2024', 'Variação 2025 vs 2024'
+    ]]
+
+def compute_dashboard_results(df_churn, df_facts, selection, df_forecasts):
+    """
+    Calcula tudo o que o painel exibe para uma seleção (KPIs, agregados dos gráficos e tabelas
+    de motivos e filiais) sem chamar o Streamlit. É o que o main() usa ao vivo e o que o job de
+    snapshot materializa.
+    """
+    df_filtered = filter_churn_data(df_churn, selection)
+    if df_filtered.empty:
+        return {'has_data': False}
+
+    df_active_monthly_volumes = compute_active_monthly_volumes(df_facts, selection['months'], selection['client_types'])
+    df_plot_monthly, monthly_category_order = compute_monthly_volume_chart(df_filtered, df_active_monthly_volumes)
+    df_client_type_2024, df_client_type_2025, df_client_type_comparison = compute_client_type_comparison(df_churn, selection)
+    return {
+        'has_data': True,
+        'kpis': compute_kpis(df_churn, df_filtered, df_facts, selection, df_forecasts),
+        'monthly_chart': df_plot_monthly,
+        'monthly_category_order': monthly_category_order,
+        'client_type_2024': df_client_type_2024,
+        'client_type_2025': df_client_type_2025,
+        'client_type_comparison': df_client_type_comparison,
+        'churn_type_monthly': compute_churn_type_monthly(df_filtered),
+        'reasons_table': compute_year_comparison_table(df_filtered, 'Categoria4_Motivo', ['desconsiderar'], "Novo Motivo", 'Motivo de Cancelamento'),
+        'franchises_table': compute_year_comparison_table(df_filtered, 'Filial', [], "Nova Filial", 'Filial')
+    }
+
+# --- Recálculo Incremental (grafo de dependências dos valores do painel) ---
+class ComputeGraph:
+    """
+    Grafo de dependências dos valores derivados do painel. Cada nó declara de quais entradas
+    (filtros e quadros do conjunto de dados) ou outros nós depende; evaluate() recalcula apenas
+    os nós cujas dependências mudaram desde a execução anterior e reaproveita o valor memorizado
+    dos demais. A memória fica com quem chama (no painel, o st.session_state de cada sessão) e
+    guarda os últimos memo_entries_per_node valores de cada nó, para idas e vindas entre filtros.
+    """
+
+    def __init__(self, memo_entries_per_node=8):
+        self.nodes = {} # nome -> (função, dependências)
+        self.memo_entries_per_node = memo_entries_per_node
+
+    def node(self, name, dependencies):
+        """Registra a função como o nó `name`; ela recebe os valores das dependências, na ordem."""
+        def decorator(func):
+            self.nodes[name] = (func, list(dependencies))
+            return func
+        return decorator
+
+    def evaluate(self, outputs, inputs, input_keys, memo, resolved_keys=None):
+        """
+        Calcula os nós de `outputs`. `inputs` traz o valor de cada entrada e `input_keys` uma chave
+        comparável de cada uma (os quadros entram pela versão do conjunto de dados). `memo` guarda
+        {nó: OrderedDict(chave das dependências -> valor)} entre execuções. Retorna {nó: valor};
+        se `resolved_keys` for informado, recebe também a chave de cada nó resolvido.
+        """
+        cache_metrics = get_cache_metrics()
+        values = dict(inputs)
+        keys = dict(input_keys)
+
+        def resolve(name):
+            if name in keys:
+                return
+            func, dependencies = self.nodes[name]
+            for dependency in dependencies:
+                resolve(dependency)
+            node_key = tuple(keys[dependency] for dependency in dependencies)
+            cache_name = f"Grafo: {name}"
+            node_memo = memo.setdefault(name, OrderedDict())
+            if node_key in node_memo:
+                node_memo.move_to_end(node_key)
+                values[name] = node_memo[node_key]
+                cache_metrics.record_call(cache_name, 'session_state')
+            else:
+                start = time.perf_counter()
+                values[name] = func(*(values[dependency] for dependency in dependencies))
+                node_memo[node_key] = values[name]
+                while len(node_memo) > self.memo_entries_per_node:
+                    node_memo.popitem(last=False)
+                cache_metrics.record_load(cache_name, name, time.perf_counter() - start, estimate_object_size(values[name]))
+                cache_metrics.record_call(cache_name, 'session_state', missed=True)
+            keys[name] = node_key
+
+        for name in outputs:
+            resolve(name)
+        if resolved_keys is not None:
+            resolved_keys.update((name, key) for name, key in keys.items() if name in self.nodes)
+        return {name: values[name] for name in outputs}
+
+dashboard_graph = ComputeGraph()
+dashboard_frame_inputs = ['df_churn', 'df_facts', 'df_forecasts']
+dashboard_filter_inputs = ['years', 'months', 'client_types', 'churn_types', 'all_months', 'all_client_types', 'all_churn_types']
+
+@dashboard_graph.node('selection', dashboard_filter_inputs)
+def _node_selection(*filter_values):
+    return dict(zip(dashboard_filter_inputs, (list(values) for values in filter_values)))
+
+@dashboard_graph.node('df_filtered', ['df_churn', 'selection'])
+def _node_df_filtered(df_churn, selection):
+    return filter_churn_data(df_churn, selection)
+
+@dashboard_graph.node('total_churn_2025', ['df_churn', 'months', 'client_types', 'churn_types'])
+def _node_total_churn_2025(df_churn, months, client_types, churn_types):
+    return compute_total_churn_2025(df_churn, months, client_types, churn_types)
+
+@dashboard_graph.node('operational_backlog_terms', ['df_facts', 'years', 'months', 'client_types'])
+def _node_operational_backlog_terms(df_facts, years, months, client_types):
+    return compute_operational_backlog_terms(df_facts, years, months, client_types)
+
+@dashboard_graph.node('operational_churn', ['df_facts', 'operational_backlog_terms', 'client_types', 'churn_types'])
+def _node_operational_churn(df_facts, backlog_terms, client_types, churn_types):
+    return combine_operational_churn(df_facts, backlog_terms, client_types, churn_types)
+
+@dashboard_graph.node('annual_projection', ['df_filtered', 'selection', 'df_forecasts'])
+def _node_annual_projection(df_filtered, selection, df_forecasts):
+    return compute_annual_projection(df_filtered, selection, df_forecasts)
+
+@dashboard_graph.node('churn_rate_projection', ['df_facts', 'years', 'months', 'client_types', 'churn_types', 'annual_projection'])
+def _node_churn_rate_projection(df_facts, years, months, client_types, churn_types, annual_projection):
+    projected_annual_churn, forecast_info = annual_projection
+    return compute_churn_rate_projection(
+        df_facts, years, months, client_types, churn_types,
+        forecast_projection=projected_annual_churn if forecast_info is not None else None
+    )
+
+@dashboard_graph.node('yoy_variation', ['df_churn', 'months', 'client_types', 'churn_types'])
+def _node_yoy_variation(df_churn, months, client_types, churn_types):
+    return compute_yoy_variation(df_churn, months, client_types, churn_types)
+
+@dashboard_graph.node('kpis', ['total_churn_2025', 'operational_churn', 'annual_projection', 'churn_rate_projection', 'yoy_variation'])
+def _node_kpis(total_churn_2025, operational_churn, annual_projection, churn_rate_projection, yoy_variation):
+    return {
+        'total_churn_2025': total_churn_2025,
+        'churn_operacional_value': operational_churn[0],
+        'churn_operacional_percentage': operational_churn[1],
+        'projected_annual_churn': annual_projection[0],
+        'forecast_info': annual_projection[1],
+        'churn_rate_value': churn_rate_projection[0],
+        'avg_monthly_active': churn_rate_projection[1],
+        'absolute_diff_yoy': yoy_variation[0],
+        'average_monthly_percentage_variation': yoy_variation[1]
+    }
+
+@dashboard_graph.node('active_monthly_volumes', ['df_facts', 'months', 'client_types'])
+def _node_active_monthly_volumes(df_facts, months, client_types):
+    return compute_active_monthly_volumes(df_facts, months, client_types)
+
+@dashboard_graph.node('monthly_chart', ['df_filtered', 'active_monthly_volumes'])
+def _node_monthly_chart(df_filtered, df_active_monthly_volumes):
+    return compute_monthly_volume_chart(df_filtered, df_active_monthly_volumes)
+
+@dashboard_graph.node('client_type_comparison', ['df_churn', 'months', 'client_types', 'churn_types'])
+def _node_client_type_comparison(df_churn, months, client_types, churn_types):
+    return compute_client_type_comparison(df_churn, {'months': months, 'client_types': client_types, 'churn_types': churn_types})
+
+@dashboard_graph.node('churn_type_monthly', ['df_filtered'])
+def _node_churn_type_monthly(df_filtered):
+    return compute_churn_type_monthly(df_filtered)
+
+@dashboard_graph.node('reasons_table', ['df_filtered'])
+def _node_reasons_table(df_filtered):
+    return compute_year_comparison_table(df_filtered, 'Categoria4_Motivo', ['desconsiderar'], "Novo Motivo", 'Motivo de Cancelamento')
+
+@dashboard_graph.node('franchises_table', ['df_filtered'])
+def _node_franchises_table(df_filtered):
+    return compute_year_comparison_table(df_filtered, 'Filial', [], "Nova Filial", 'Filial')
+
+def compute_dashboard_results_incremental(df_churn, df_facts, selection, df_forecasts, dataset_version, memo):
+    """
+    Mesmo resultado de compute_dashboard_results, avaliado sobre dashboard_graph: numa nova
+    seleção só são recalculados os nós cujos filtros ou dados mudaram (por exemplo, trocar o
+    Tipo de Churn não refaz a base ativa mensal nem a variação do backlog).
+    """
+    inputs = dict(zip(dashboard_frame_inputs, [df_churn, df_facts, df_forecasts]))
+    input_keys = {name: dataset_version for name in dashboard_frame_inputs}
+    for name in dashboard_filter_inputs:
+        inputs[name] = selection[name]
+        input_keys[name] = tuple(selection[name])
+
+    resolved_keys = {}
+    df_filtered = dashboard_graph.evaluate(['df_filtered'], inputs, input_keys, memo, resolved_keys)['df_filtered']
+    if df_filtered.empty:
+        return {'has_data': False}
+    # Os nós já resolvidos entram como entradas, com as mesmas chaves usadas na memória
+    for name, key in resolved_keys.items():
+        inputs[name] = memo[name][key]
+        input_keys[name] = key
+
+    values = dashboard_graph.evaluate(
+        ['kpis', 'monthly_chart', 'client_type_comparison', 'churn_type_monthly', 'reasons_table', 'franchises_table'],
+        inputs, input_keys, memo
+    )
+    df_plot_monthly, monthly_category_order = values['monthly_chart']
+    df_client_type_2024, df_client_type_2025, df_client_type_comparison = values['client_type_comparison']
+    return {
+        'has_data': True,
+        'kpis': values['kpis'],
+        'monthly_chart': df_plot_monthly,
+        'monthly_category_order': monthly_category_order,
+        'client_type_2024': df_client_type_2024,
+        'client_type_2025': df_client_type_2025,
+        'client_type_comparison': df_client_type_comparison,
+        'churn_type_monthly': values['churn_type_monthly'],
+        'reasons_table': values['reasons_table'],
+        'franchises_table': values['franchises_table']
+    }
+
+# --- Cache de Resultados por Seleção e Pré-cálculo Especulativo ---
+class SelectionResultCache:
+    """
+    LRU com os resultados de compute_dashboard_results por (versão do conjunto, seleção),
+    compartilhado entre as sessões. Nas métricas, acertos são seleções servidas prontas e
+    falhas são cálculos (ao vivo ou pré-calculados) que entraram no cache.
+    """
+    cache_name = 'Resultados por Seleção'
+
+    def __init__(self, max_entries, cache_metrics):
+        self.max_entries = max_entries
+        self.cache_metrics = cache_metrics
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, version_key):
+        with self._lock:
+            return version_key in self._entries
+
+    def get(self, version, key):
+        with self._lock:
+            results = self._entries.get((version, key))
+            if results is not None:
+                self._entries.move_to_end((version, key))
+        self.cache_metrics.record_call(self.cache_name, 'cache_resource', missed=results is None)
+        return results
+
+    def put(self, version, key, results, seconds, prefetched=False):
+        if prefetched:
+            # Sem um get() correspondente: o pré-cálculo conta como uma chamada que falhou
+            self.cache_metrics.record_call(self.cache_name, 'cache_resource', missed=True)
+        self.cache_metrics.record_load(self.cache_name, f"{version}: {key}", seconds, estimate_object_size(results))
+        with self._lock:
+            self._entries[(version, key)] = results
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                (old_version, old_key), _ = self._entries.popitem(last=False)
+                self.cache_metrics.record_eviction(self.cache_name, f"{old_version}: {old_key}")
+
+    def discard_version(self, version):
+        """Descarta os resultados de um conjunto de dados removido da memória (com e sem eventos do dia)."""
+        with self._lock:
+            stale = [version_key for version_key in self._entries if version_key[0] == version or version_key[0].startswith(f"{version}+")]
+            for version_key in stale:
+                del self._entries[version_key]
+        for old_version, old_key in stale:
+            self.cache_metrics.record_eviction(self.cache_name, f"{old_version}: {old_key}")
+
+class SelectionPrefetcher:
+    """
+    Pool pequeno de threads que calcula seleções prováveis antes do próximo clique e guarda o
+    resultado no SelectionResultCache. Uma seleção pedida enquanto ainda está sendo pré-calculada
+    espera pelo cálculo em andamento em vez de repeti-lo.
+    """
+
+    def __init__(self, result_cache, max_workers):
+        self.result_cache = result_cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='churn-prefetch')
+        self._pending = {} # (versão, chave) -> Future
+        self._lock = threading.Lock()
+
+    def wait_pending(self, version, key):
+        """Resultado de um pré-cálculo em andamento para a seleção, ou None se não houver."""
+        with self._lock:
+            future = self._pending.get((version, key))
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def submit(self, version, selections, compute):
+        """Agenda o cálculo das seleções que ainda não estão no cache nem em andamento."""
+        for selection in selections:
+            version_key = (version, selection_key(selection))
+            with self._lock:
+                if version_key in self._pending or version_key in self.result_cache:
+                    continue
+                self._pending[version_key] = self._executor.submit(self._run, version_key, selection, compute)
+
+    def _run(self, version_key, selection, compute):
+        try:
+            start = time.perf_counter()
+            results = compute(selection)
+            self.result_cache.put(*version_key, results, time.perf_counter() - start, prefetched=True)
+            return results
+        finally:
+            with self._lock:
+                self._pending.pop(version_key, None)
+
+@st.cache_resource(show_spinner=False)
+def get_selection_result_cache():
+    """Cache de resultados por seleção único por servidor."""
+    return SelectionResultCache(result_cache_max_entries, get_cache_metrics())
+
+@st.cache_resource(show_spinner=False)
+def get_selection_prefetcher():
+    """Pré-calculador único por servidor, com prefetch_workers threads."""
+    return SelectionPrefetcher(get_selection_result_cache(), prefetch_workers)
+
+def neighbouring_selections(selection, filter_options, max_selections=prefetch_max_selections):
+    """
+    Seleções vizinhas da atual, na ordem em que costumam ser visitadas: mês seguinte e anterior
+    (quando há um único mês selecionado), cada Tipo de Cliente isolado e a volta para todos.
+    """
+    candidates = []
+    all_months = list(filter_options['months'])
+    if len(selection['months']) == 1 and selection['months'][0] in all_months:
+        position = all_months.index(selection['months'][0])
+        for offset in (1, -1):
+            if 0 <= position + offset < len(all_months):
+                candidates.append(dict(selection, months=[all_months[position + offset]]))
+    for client_type in filter_options['client_types']:
+        candidates.append(dict(selection, client_types=[client_type]))
+    candidates.append(dict(selection, client_types=list(filter_options['client_types'])))
+
+    seen = {selection_key(selection)}
+    neighbours = []
+    for candidate in candidates:
+        key = selection_key(candidate)
+        if key not in seen:
+            seen.add(key)
+            neighbours.append(candidate)
+    return neighbours[:max_selections]
+
+# --- Exportação em Lotes (CSV / Parquet / XLSX) ---
+def iter_row_batches(df, chunk_rows=export_chunk_rows):
+    """Percorre o DataFrame em lotes de linhas (fatias, sem copiar o DataFrame inteiro)."""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+def write_export_file(df, export_format, chunk_rows=export_chunk_rows):
+    """
+    Grava o DataFrame no formato pedido lote a lote, em um arquivo temporário que só vai para o
+    disco quando passa de export_spool_max_bytes. Assim a exportação nunca monta uma segunda
+    cópia inteira dos dados em memória. Retorna o arquivo posicionado no início.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=export_spool_max_bytes, mode='w+b')
+
+    if export_format == 'CSV':
+        # Separador ';' e vírgula decimal, com BOM, para abrir direto no Excel em português
+        text_output = io.TextIOWrapper(output, encoding='utf-8-sig', newline='')
+        for i, batch in enumerate(iter_row_batches(df, chunk_rows)):
+            batch.to_csv(text_output, sep=';', decimal=',', index=False, header=(i == 0))
+        if df.empty:
+            df.to_csv(text_output, sep=';', decimal=',', index=False)
+        text_output.flush()
+        text_output.detach()
+
+    elif export_format == 'Parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Esquema a partir dos tipos das colunas; colunas sem tipo definido viram texto
+        schema = pa.Schema.from_pandas(df.head(0), preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                schema = schema.set(i, pa.field(field.name, pa.string()))
+        with pq.ParquetWriter(output, schema, compression='snappy') as writer:
+            for batch in iter_row_batches(df, chunk_rows):
+                writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+
+    elif export_format == 'XLSX':
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        worksheet = None
+        rows_in_sheet = 0
+        for batch in iter_row_batches(df, chunk_rows):
+            batch = batch.astype(object).where(batch.notna(), None)
+            for row in batch.itertuples(index=False, name=None):
+                if worksheet is None or rows_in_sheet >= xlsx_max_rows_per_sheet:
+                    worksheet = workbook.create_sheet(f"Dados {len(workbook.worksheets) + 1}")
+                    worksheet.append([str(column) for column in df.columns])
+                    rows_in_sheet = 0
+                worksheet.append(list(row))
+                rows_in_sheet += 1
+        if worksheet is None:
+            workbook.create_sheet("Dados 1").append([str(column) for column in df.columns])
+        workbook.save(output)
+
     else:
-        return 'Outros'
+        raise ValueError(f"Formato de exportação desconhecido: {export_format}")
+
+    output.seek(0)
+    return output
+
+def build_export_data(data_source, export_format):
+    """
+    Conteúdo do arquivo de download, em bytes. data_source é um DataFrame ou uma função que o
+    retorna. O st.download_button só aceita bytes, texto ou arquivos de tipos de io conhecidos
+    (não o SpooledTemporaryFile), e lê tudo para a memória de qualquer forma: o arquivo é gerado
+    em lotes por write_export_file e lido uma única vez no final.
+    """
+    df = data_source() if callable(data_source) else data_source
+    with write_export_file(df, export_format) as output:
+        return output.read()
+
+def render_download_button(label, data_source, base_file_name, export_format, key):
+    """
+    Botão de download com geração adiada: data_source (DataFrame ou função que o retorna) só é
+    convertido quando o usuário clica, em uma thread separada do rerun do script.
+    """
+    extension, mime = export_formats[export_format]
+    st.download_button(
+        label, data=lambda: build_export_data(data_source, export_format),
+        file_name=f"{base_file_name}.{extension}", mime=mime, key=key, on_click='ignore'
+    )
+
+# --- Categorias de Alta Cardinalidade (Top-N com "Outros" e tabelas paginadas) ---
+def top_n_positions(values, n):
+    """
+    Posições dos n maiores valores, em ordem decrescente. Seleção parcial (np.argpartition) e
+    ordenação só das n escolhidas, em vez de ordenar todas as categorias.
+    """
+    values = np.asarray(values, dtype=float)
+    if n >= len(values):
+        return np.argsort(-values, kind='stable')
+    top = np.argpartition(-values, n - 1)[:n]
+    return top[np.argsort(-values[top], kind='stable')]
+
+def bucket_top_n(df, category_column, value_columns, n, rank_column=None, group_columns=(), other_label=top_n_other_label):
+    """
+    Mantém as n categorias de maior volume (rank_column somado em todas as linhas, por padrão a
+    primeira coluna de valores) e soma as demais em other_label, dentro de cada grupo (group_columns,
+    ex.: ano e mês do gráfico empilhado). Os totais não mudam. Recebe agregados, não linhas de OS:
+    as linhas saem na ordem do ranking, com "Outros" por último.
+    """
+    rank_column = rank_column or value_columns[0]
+    totals = df.groupby(category_column, sort=False, observed=True)[rank_column].sum()
+    if len(totals) <= n:
+        return df
+    kept = totals.index[top_n_positions(totals.to_numpy(), n)]
+    rank = {category: position for position, category in enumerate(kept)}
+
+    categories = df[category_column].astype(object)
+    df_bucketed = df.assign(**{category_column: categories.where(categories.isin(kept), other_label)})
+    df_bucketed = df_bucketed.groupby(list(group_columns) + [category_column], sort=False, as_index=False)[value_columns].sum()
+    order = df_bucketed[category_column].map(rank).fillna(len(rank)).to_numpy()
+    return df_bucketed.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
+
+def bucket_year_comparison_table(df_display, display_column, new_item_label, n):
+    """Tabela 2025 vs 2024 (motivos ou filiais) com as n categorias de maior volume em 2025 e o resto em "Outros"."""
+    df_volumes = df_display[[display_column, 'Volume 2025', 'Volume 2024']].rename(
+        columns={'Volume 2025': 'Volume_2025', 'Volume 2024': 'Volume_2024'}
+    )
+    df_volumes = bucket_top_n(df_volumes, display_column, ['Volume_2025', 'Volume_2024'], n)
+    return format_year_comparison_table(df_volumes, display_column, new_item_label, display_column)
+
+def paginate_frame(df, page, page_size):
+    """Fatia de uma página do DataFrame (page começa em 1)."""
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size]
+
+def line_render_mode(n_points):
+    """Traços WebGL (Scattergl) a partir de webgl_min_points pontos; SVG abaixo disso."""
+    return 'webgl' if n_points >= webgl_min_points else 'svg'
+
+def render_paginated_table(df, key):
+    """Tabela paginada no servidor: só as linhas da página vão para o navegador."""
+    col_page_size, col_page, col_total = st.columns([1, 1, 2])
+    with col_page_size:
+        page_size = st.selectbox("Linhas por página", options=table_page_sizes, index=1, key=f"{key}_page_size")
+    total_pages = max(1, -(-len(df) // page_size))
+    with col_page:
+        page = st.number_input("Página", min_value=1, max_value=total_pages, value=1, step=1, key=f"{key}_page")
+    with col_total:
+        st.markdown(f"**{len(df):,.0f} linhas** — página {int(page)} de {total_pages}".replace(",", "."))
+    st.dataframe(paginate_frame(df, min(int(page), total_pages), page_size), use_container_width=True, hide_index=True)
+
+def render_category_table(df_display, display_column, new_item_label, key):
+    """
+    Tabela 2025 vs 2024 por categoria (abas de motivos e filiais): Top-N com "Outros" ou a tabela
+    completa, paginada. O download continua com todas as categorias.
+    """
+    col_mode, col_top_n = st.columns([3, 1])
+    with col_mode:
+        table_mode = st.radio("Exibição", options=["Top N + Outros", "Tabela completa"], horizontal=True, key=f"{key}_mode")
+    if table_mode == "Top N + Outros":
+        with col_top_n:
+            top_n = st.number_input("N", min_value=1, value=top_n_default, step=1, key=f"{key}_top_n")
+        st.dataframe(bucket_year_comparison_table(df_display, display_column, new_item_label, int(top_n)),
+                     use_container_width=True, hide_index=True)
+    else:
+        render_paginated_table(df_display, key)
+
+# --- Gráficos (compartilhados entre o painel e os relatórios por filial) ---
+def build_monthly_volume_figure(df_plot_monthly, category_order):
+    """Gráfico de barras do volume mensal por ano, com a variação YoY no eixo X (aba 1)."""
+    import plotly.express as px
+
+    fig_monthly_bar_with_variation = px.bar(
+        df_plot_monthly,
+        x="X_Axis_Month_Label",
+        y="Volume_Churn",
+        color=df_plot_monthly['Ano Churn'].astype(str),
+        barmode="group",
+        labels={
+            "X_Axis_Month_Label": "Mês (Variação YoY)",
+            "color": "Ano"
+        },
+        category_orders={"X_Axis_Month_Label": category_order},
+        text='Bar_Text_Label'
+    )
+
+    fig_monthly_bar_with_variation.update_traces(
+        textposition='outside',
+        textfont=dict(color='black', weight='bold', size=10),
+        textangle=0
+    )
+
+    fig_monthly_bar_with_variation.update_traces(
+        hovertemplate="<b>Mês:</b> %{customdata[1]}<br><b>Ano:</b> %{fullData.name}<br><b>Volume:</b> %{y:,.0f}".replace(",", ".") + # Alteração aqui para formatar com ponto
+                      "<br><b>Variação (25 vs 24):</b> %{customdata[0]:.1%}<extra></extra>".replace(".", ",") + # Alteração aqui para formatar com vírgula
+                      "<br><b>Informação na barra:</b> %{text}<extra></extra>",
+        customdata=df_plot_monthly[['YoY_Variation', 'Nome Mes Churn']]
+    )
+
+    fig_monthly_bar_with_variation.update_layout(
+        hovermode="x unified",
+        yaxis_title="",
+        legend=dict(
+            font=dict(
+                size=12,
+                color="black",
+                family="Arial",
+                weight="bold"
+            ),
+            orientation="v",
+            yanchor="top",
+            y=1,
+            xanchor="right",
+            x=1.1
+        ),
+        xaxis_title="Mês (Variação YoY)",
+        xaxis=dict(tickangle=0)
+    )
+    return fig_monthly_bar_with_variation
+
+def build_client_type_pie(df_plot_client_type, legend_below=False, top_n=top_n_default):
+    """Gráfico de rosca da distribuição do churn por Tipo de Cliente (aba 2), com as top_n fatias e "Outros"."""
+    import plotly.express as px
+
+    df_plot_client_type = bucket_top_n(df_plot_client_type, 'Tipo de Cliente', ['Volume_Churn'], top_n)
+    fig_client_type = px.pie(
+        df_plot_client_type,
+        values="Volume_Churn",
+        names="Tipo de Cliente",
+        hole=0.4
+    )
+    fig_client_type.update_traces(textinfo="percent+label", pull=[0.05]*len(df_plot_client_type))
+    legend_font = dict(size=12, color="black", family="Arial", weight="bold")
+    if legend_below:
+        fig_client_type.update_layout(
+            showlegend=True,
+            legend=dict(orientation="h", yanchor="bottom", y=-0.2, xanchor="center", x=0.5, font=legend_font)
+        )
+    else:
+        fig_client_type.update_layout(legend=dict(font=legend_font))
+    return fig_client_type
+
+# --- Snapshot de KPIs Materializado ---
+@instrumented_cache(st.cache_resource(show_spinner=False), storage='cache_resource')
+def load_kpi_snapshot(snapshot_path, dataset_version, snapshot_mtime_ns):
+    """
+    Lê o snapshot gerado por materializar_snapshot.py: um dicionário selection_key -> resultados
+    de compute_dashboard_results. Só vale para a versão do conjunto de dados em que foi gerado e
+    para o formato atual (snapshot_format_version); fora disso (ou sem arquivo) retorna {} e o
+    painel calcula tudo ao vivo.
+    snapshot_mtime_ns faz o cache ser renovado quando o job grava um novo arquivo.
+    """
+    if snapshot_mtime_ns is None:
+        return {}
+    snapshot = pd.read_pickle(snapshot_path, compression='gzip')
+    if snapshot.get('dataset_version') != dataset_version or snapshot.get('format') != snapshot_format_version:
+        return {}
+    return snapshot['results']
+
+# Caches derivados, indexados por versão do conjunto de dados, descartados junto com ele (clear_version)
+dataset_derived_caches = [fit_churn_forecasts, build_lead_time_histograms, build_drilldown_index, build_daily_prefix_index, detect_churn_anomalies, build_monthly_fact_table, build_ltm_churn_series, load_otl_targets, build_otl_tracking, build_hierarchy_rollups, build_scenario_cube]
+
+# --- Vários Conjuntos de Dados com Orçamento de Memória Compartilhado ---
+def load_dataset_catalog(config_file):
+    """
+    Lê o catálogo de conjuntos de dados ({"nome": "pasta"}) do arquivo JSON informado.
+    Sem arquivo, retorna apenas o conjunto padrão apontando para data_dir.
+    """
+    if not os.path.exists(config_file):
+        return {default_dataset_name: data_dir}
+    with open(config_file, encoding='utf-8') as f:
+        catalog = json.load(f)
+    if not isinstance(catalog, dict) or not catalog:
+        raise ValueError(f"O arquivo '{config_file}' deve conter um objeto JSON {{\"nome\": \"pasta\"}} não vazio.")
+    return {str(name): str(folder) for name, folder in catalog.items()}
+
+def estimate_dataset_size(data):
+    """Memória ocupada (em bytes) pelos DataFrames de um conjunto de dados carregado."""
+    df_churn, df_active, df_backlog, load_report = data
+    frames = [df_churn, df_active, df_backlog] + [value for value in load_report.values() if isinstance(value, pd.DataFrame)]
+    return int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
+
+class DatasetRegistry:
+    """
+    Mantém em memória os conjuntos de dados em uso, dentro de um orçamento global.
+    Quando o orçamento é ultrapassado, os conjuntos usados há mais tempo (LRU) saem da memória,
+    junto com seus caches derivados, e ficam apenas no cache em disco da própria pasta, de onde
+    são recarregados sob demanda sem refazer a transformação dos arquivos .xlsx.
+    """
+
+    def __init__(self, catalog, memory_budget_bytes):
+        self.catalog = catalog
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries = OrderedDict() # nome -> {'version', 'data', 'size'}
+        # O lock global só protege _entries e a contabilidade da memória; a carga de cada conjunto
+        # usa o lock do próprio nome, para que uma carga a frio não bloqueie as sessões dos outros
+        self._lock = threading.Lock()
+        self._load_locks = {} # nome -> Lock
+
+    def _disk_cache_path(self, name, version):
+        return os.path.join(self.catalog[name], dataset_cache_subdir, f"dataset_{version}.pkl")
+
+    def _load(self, name, version):
+        disk_path = self._disk_cache_path(name, version)
+        if os.path.exists(disk_path):
+            return pd.read_pickle(disk_path)
+
+        data = load_and_transform_data(self.catalog[name], file_2024, file_2025, file_active_base, file_backlog_churn)
+        cache_folder = os.path.dirname(disk_path)
+        os.makedirs(cache_folder, exist_ok=True)
+        for stale_file in os.listdir(cache_folder):
+            if stale_file.startswith('dataset_') and stale_file.endswith('.pkl'):
+                os.remove(os.path.join(cache_folder, stale_file))
+        pd.to_pickle(data, disk_path)
+        return data
+
+    def _drop(self, name):
+        entry = self._entries.pop(name)
+        get_cache_metrics().record_eviction('DatasetRegistry', name)
+        for cached_function in dataset_derived_caches:
+            cached_function.clear_version(entry['version'])
+        get_selection_result_cache().discard_version(entry['version'])
+
+    def _evict(self, keep_name):
+        total = sum(entry['size'] for entry in self._entries.values())
+        for name in list(self._entries.keys()):
+            if total <= self.memory_budget_bytes:
+                break
+            if name == keep_name:
+                continue
+            total -= self._entries[name]['size']
+            self._drop(name)
+
+    def _current_entry(self, name, version):
+        # Chamado com self._lock: a entrada da versão pedida (a mais recente no LRU) ou None
+        entry = self._entries.get(name)
+        if entry is None or entry['version'] != version:
+            return None
+        self._entries.move_to_end(name)
+        return entry
+
+    def get(self, name):
+        """
+        Retorna (versão, (df_churn, df_active, df_backlog, load_report)) do conjunto informado,
+        carregando-o (do cache em disco ou dos arquivos de origem) se necessário. Sessões que pedem
+        o mesmo conjunto durante a carga esperam por ela; as dos outros conjuntos não.
+        """
+        if name not in self.catalog:
+            raise KeyError(name)
+        version = get_dataset_version(self.catalog[name], dataset_version_files)
+        metrics = get_cache_metrics()
+        with self._lock:
+            entry = self._current_entry(name, version)
+            if entry is not None:
+                metrics.record_call('DatasetRegistry', storage='DatasetRegistry')
+                return entry['version'], entry['data']
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            # Outra sessão pode ter carregado esta versão enquanto esta esperava
+            with self._lock:
+                entry = self._current_entry(name, version)
+                if entry is None and name in self._entries:
+                    self._drop(name) # Versão anterior do conjunto, com os seus caches derivados
+            if entry is not None:
+                metrics.record_call('DatasetRegistry', storage='DatasetRegistry')
+                return entry['version'], entry['data']
+
+            start = time.perf_counter()
+            data = self._load(name, version)
+            entry = {'version': version, 'data': data, 'size': estimate_dataset_size(data)}
+            metrics.record_load('DatasetRegistry', name, time.perf_counter() - start, entry['size'])
+            metrics.record_call('DatasetRegistry', storage='DatasetRegistry', missed=True)
+            with self._lock:
+                self._entries[name] = entry
+                self._evict(keep_name=name)
+                self._entries.move_to_end(name)
+            return entry['version'], entry['data']
+
+    def resident_summary(self):
+        """(bytes em memória, nomes dos conjuntos carregados, do uso mais antigo ao mais recente), lidos sob o lock."""
+        with self._lock:
+            return sum(entry['size'] for entry in self._entries.values()), list(self._entries)
+
+@st.cache_resource(show_spinner=False)
+def get_dataset_registry():
+    """Registro único de conjuntos de dados, compartilhado por todas as sessões do servidor."""
+    return DatasetRegistry(load_dataset_catalog(datasets_config_file), memory_budget_mb * 1024 * 1024)
+
+def render_cache_admin_panel(cache_metrics, dataset_registry):
+    """Painel de governança de cache e memória, exibido com o parâmetro de URL ?admin=1."""
+    st.header("Governança de Cache e Memória")
+    resident_bytes, loaded_names = dataset_registry.resident_summary()
+    col_resident, col_budget, col_datasets = st.columns(3)
+    col_resident.metric("Conjuntos em Memória (MB)", f"{resident_bytes / 1024 / 1024:,.1f}".replace(",", "X").replace(".", ",").replace("X", "."))
+    col_budget.metric("Orçamento (MB)", f"{dataset_registry.memory_budget_bytes / 1024 / 1024:,.0f}".replace(",", "."))
+    col_datasets.metric("Conjuntos Carregados", f"{len(loaded_names)} de {len(dataset_registry.catalog)}")
+
+    st.subheader("Caches")
+    st.dataframe(cache_metrics.summary(), use_container_width=True, hide_index=True)
+    st.subheader("Entradas Residentes")
+    st.dataframe(cache_metrics.entries(), use_container_width=True, hide_index=True)
+    st.subheader("Tempo de Renderização")
+    st.dataframe(cache_metrics.timing_summary(), use_container_width=True, hide_index=True)
+    st.caption(f"Métricas exportadas em '{metrics_file}'. Entradas de st.cache_data são copiadas a cada chamada; "
+               "as de st.cache_resource e do DatasetRegistry são compartilhadas entre as sessões.")
 
 # --- Função Principal do Aplicativo Streamlit ---
-def main():
+def render_dashboard(cache_metrics, dataset_registry):
+    """Monta a página inteira do painel; pode parar antes do fim com st.stop()."""
+    render_started = time.perf_counter()
     st.set_page_config(layout="wide", page_title="Dashboard de Churn")
 
     st.title("📊 Dashboard de Análise de Churn")
@@ -341,19 +3275,108 @@ def main():
         st.warning(f"Não foi possível determinar a data da última atualização: {e}")
     # --- FIM: Data da Última Atualização ---
 
-    df_churn, df_active_raw, df_backlog_raw = load_and_transform_data(data_dir, file_2024, file_2025, file_active_base, file_backlog_churn)
+    # Conjunto de dados escolhido pelo parâmetro de URL (?dataset=nome)
+    dataset_name = st.query_params.get("dataset", next(iter(dataset_registry.catalog)))
+    if dataset_name not in dataset_registry.catalog:
+        st.error(f"ERRO: Conjunto de dados '{dataset_name}' não encontrado. Disponíveis: {', '.join(dataset_registry.catalog)}.")
+        st.stop()
+    dataset_folder = dataset_registry.catalog[dataset_name]
+    if len(dataset_registry.catalog) > 1:
+        st.caption(f"Conjunto de dados: **{dataset_name}**")
 
-    # NOVO: Carrega as projeções OTL do arquivo Excel
-    otl_projections = load_otl_projections_from_excel(otl_projections_file)
+    dataset_version, (df_churn, df_active_raw, df_backlog_raw, load_report) = dataset_registry.get(dataset_name)
+    # Avisos guardados na carga: valem para todas as sessões, inclusive com o conjunto vindo do cache em disco
+    for load_warning in load_report.get('warnings', []):
+        st.warning(load_warning)
 
     st.sidebar.header("Filtros")
 
+    if 'duplicates' in load_report:
+        df_duplicates_report = load_report['duplicates']
+        with st.sidebar.expander(f"OS duplicadas removidas: {int(df_duplicates_report['Duplicatas Removidas'].sum())}"):
+            st.dataframe(df_duplicates_report, use_container_width=True, hide_index=True)
+    df_quarantine = load_report.get('quarantine', pd.DataFrame())
+    df_active_quarantine = load_report.get('active_quarantine', pd.DataFrame())
+    if not df_quarantine.empty or not df_active_quarantine.empty:
+        with st.sidebar.expander(f"Linhas em quarentena: {len(df_quarantine) + len(df_active_quarantine)}"):
+            if not df_quarantine.empty:
+                quarantine_reasons = df_quarantine['Motivo da Quarentena'].str.split('; ').explode().value_counts()
+                st.dataframe(quarantine_reasons.rename_axis('Motivo').reset_index(name='OS'), use_container_width=True, hide_index=True)
+                render_download_button("Baixar OS em quarentena", df_quarantine, f"quarentena_churn_{dataset_name}", "CSV", key="download_quarantine")
+            if not df_active_quarantine.empty:
+                st.caption(f"Base ativa: {len(df_active_quarantine)} linha(s) sem data ou volume válidos.")
+                render_download_button("Baixar linhas da base ativa", df_active_quarantine, f"quarentena_base_ativa_{dataset_name}", "CSV", key="download_active_quarantine")
+    if 'sql' in load_report:
+        sql_pull = load_report['sql'].iloc[0]
+        st.sidebar.caption(f"Fonte SQL: carga {sql_pull['Carga'].lower()}, {int(sql_pull['OS Buscadas'])} OS buscadas "
+                           f"em {int(sql_pull['Lotes'])} lote(s), {int(sql_pull['OS na Base'])} na base.")
+
     if df_churn.empty or 'Ano Churn' not in df_churn.columns:
         st.error("ERRO: Dados de CHURN vazios ou incompletos. Verifique os arquivos de origem ou filtros.")
         st.stop()
 
+    # Projeções sazonais de todas as séries (em cache por versão dos dados)
+    df_forecasts = fit_churn_forecasts(df_churn, dataset_version)
+    # Histogramas do tempo entre criação da OS e desinstalação (em cache por versão dos dados)
+    df_lead_groups, lead_time_counts = build_lead_time_histograms(df_churn, dataset_version)
+    # Índice ordenado para o detalhamento de OS (compartilhado entre sessões)
+    drilldown_index = build_drilldown_index(df_churn, dataset_version)
+    # Alertas de churn de todas as séries segmento x mês (em cache por versão dos dados)
+    df_churn_alerts = detect_churn_anomalies(df_churn, dataset_version)
+    # Metas OTL por mês, segmento e métrica (em cache por versão dos dados)
+    otl_path = os.path.join(dataset_folder, otl_projections_file)
+    if not os.path.exists(otl_path):
+        st.warning(f"AVISO: Arquivo '{otl_path}' não encontrado. As projeções OTL não serão exibidas.")
+    try:
+        df_otl_targets = load_otl_targets(otl_path, dataset_version)
+    except ValueError as e:
+        st.error(f"ERRO: Metas OTL fora do formato esperado em '{otl_path}'. As metas não serão exibidas. Detalhes: {e}")
+        df_otl_targets = empty_otl_targets()
+    current_year_month = pd.Period(df_churn['AnoMes'].max(), freq='M')
+    otl_projections = current_otl_projections(df_otl_targets, current_year_month.year, current_year_month.month)
+    # Churn, base ativa, backlog e metas OTL alinhados por (Ano, Mes, Tipo de Cliente)
+    df_facts = build_monthly_fact_table(df_churn, dataset_version, df_active_raw, df_backlog_raw, otl_projections)
+    # Realizado x meta e saldo anual de todas as metas OTL (em cache por versão dos dados)
+    df_otl_tracking = build_otl_tracking(df_facts, dataset_version, df_otl_targets)
+    # Churn dos últimos 12 meses de todos os segmentos (em cache por versão dos dados)
+    df_ltm = build_ltm_churn_series(df_churn, dataset_version, df_facts)
+    # Somas acumuladas diárias para as consultas por período (em cache por versão dos dados)
+    daily_prefix_index = build_daily_prefix_index(df_churn, dataset_version)
+    # Volumes mensais em todos os níveis da hierarquia comercial (em cache por versão dos dados)
+    hierarchy_rollups = build_hierarchy_rollups(df_churn, dataset_version)
+
+    # Eventos do dia: OS concluídas depois da última carga completa, somadas à tabela de fatos e às
+    # linhas usadas nos KPIs, gráficos e tabelas. Os caches acima só as incluem na próxima carga.
+    results_version = dataset_version
+    event_stream = get_churn_event_stream(dataset_folder)
+    if event_stream is not None:
+        df_churn, df_facts, results_version, df_event_report = event_stream.live_frames(df_churn, df_facts, dataset_version)
+        event_counts = df_event_report.iloc[0]
+        st.sidebar.caption(f"Eventos do dia: {int(event_counts['OS Somadas'])} OS somadas de {int(event_counts['Linhas Lidas'])} "
+                           f"linha(s) lida(s) em {int(event_counts['Lotes'])} lote(s).")
+        if event_stream.last_error:
+            st.sidebar.warning(f"AVISO: {int(event_counts['Lotes com Erro'])} lote(s) de eventos com erro. Último: {event_stream.last_error}")
+
+        if churn_event_refresh_seconds > 0:
+            @st.fragment(run_every=churn_event_refresh_seconds)
+            def watch_churn_events():
+                # Novas linhas no arquivo de eventos: executa o painel inteiro para somá-las
+                if event_stream.pending_bytes() > 0:
+                    st.rerun(scope="app")
+
+            with st.sidebar:
+                watch_churn_events()
+
+    # Snapshot de KPIs materializado para as combinações de filtros mais usadas (só vale sem eventos do dia)
+    snapshot_path = os.path.join(dataset_folder, dataset_cache_subdir, snapshot_file)
+    kpi_snapshot = {}
+    if results_version == dataset_version:
+        kpi_snapshot = load_kpi_snapshot(snapshot_path, dataset_version, os.stat(snapshot_path).st_mtime_ns if os.path.exists(snapshot_path) else None)
+
+    filter_options = get_filter_options(df_churn)
+
     # --- Filtro de Anos com "Selecionar Todos" ---
-    all_years = sorted(df_churn['Ano Churn'].unique())
+    all_years = filter_options['years']
     display_years = ["Todos"] + all_years
     selected_years_option = st.sidebar.multiselect(
         "Selecione o(s) Ano(s)",
@@ -365,15 +3388,8 @@ def main():
     else:
         selected_years = selected_years_option
 
-    month_order_num_pt = ["Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
-                          "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-    month_abbr_order_pt = ["Jan", "Fev", "Mar", "Abr", "Mai", "Jun",
-                           "Jul", "Ago", "Set", "Out", "Nov", "Dez"]
-    month_to_abbr_map = dict(zip(month_order_num_pt, month_abbr_order_pt))
-
-
     # --- Filtro de Meses com "Selecionar Todos" ---
-    all_months = sorted(df_churn['Nome Mes Churn'].unique(), key=lambda x: month_order_num_pt.index(x))
+    all_months = filter_options['months']
     display_months = ["Todos"] + all_months
     selected_months_option = st.sidebar.multiselect(
         "Selecione o(s) Mês(es)",
@@ -386,7 +3402,7 @@ def main():
         selected_months = selected_months_option
 
     # --- Filtro de Tipo de Cliente com "Selecionar Todos" ---
-    all_client_types = df_churn['Tipo de Cliente'].unique()
+    all_client_types = filter_options['client_types']
     display_client_types = ["Todos"] + list(all_client_types)
     selected_client_types_option = st.sidebar.multiselect(
         "Selecione o(s) Tipo(s) de Cliente",
@@ -399,9 +3415,9 @@ def main():
         selected_client_types = selected_client_types_option
 
 
-    if 'Tipo de Churn' in df_churn.columns and not df_churn['Tipo de Churn'].isnull().all():
+    if filter_options['churn_types']:
         # --- Filtro de Tipo de Churn com "Selecionar Todos" ---
-        all_churn_types = df_churn['Tipo de Churn'].unique()
+        all_churn_types = filter_options['churn_types']
         display_churn_types = ["Todos"] + list(all_churn_types)
         selected_churn_types_option = st.sidebar.multiselect(
             "Selecione o(s) Tipo(s) de Churn",
@@ -415,19 +3431,78 @@ def main():
     else:
         selected_churn_types = all_churn_types = []
 
+    # --- Período personalizado: consulta às somas acumuladas diárias ---
+    range_counts = None
+    if daily_prefix_index['start'] is not None:
+        st.sidebar.subheader("Período Personalizado")
+        first_day = daily_prefix_index['start'].astype(date)
+        last_day = first_day + timedelta(days=daily_prefix_index['cumulative'].shape[1] - 2)
+        date_range_preset = st.sidebar.selectbox("Período", options=date_range_presets, key="date_range_preset")
+        if date_range_preset == "Personalizado":
+            range_start, range_end = st.sidebar.slider(
+                "Selecione o período",
+                min_value=first_day,
+                max_value=last_day,
+                value=(first_day, last_day),
+                format="DD/MM/YYYY",
+                key="date_range_slider"
+            )
+        else:
+            range_start, range_end = resolve_date_range_preset(date_range_preset, first_day, last_day)
+
+        range_counts = query_date_range(daily_prefix_index, range_start, range_end)
+        df_range_segments = daily_prefix_index['segments']
+        range_segment_mask = np.ones(len(df_range_segments), dtype=bool)
+        if 'Tipo de Cliente' in df_range_segments.columns:
+            range_segment_mask = range_segment_mask & df_range_segments['Tipo de Cliente'].isin(selected_client_types).to_numpy()
+        if 'Tipo de Churn' in df_range_segments.columns and selected_churn_types:
+            range_segment_mask = range_segment_mask & df_range_segments['Tipo de Churn'].isin(selected_churn_types).to_numpy()
+
+        st.sidebar.metric(
+            f"Churn de {range_start:%d/%m/%Y} a {range_end:%d/%m/%Y}",
+            f"{int(range_counts[range_segment_mask].sum()):,.0f}".replace(",", "."),
+            help="Considera os filtros de Tipo de Cliente e Tipo de Churn. A divisão por segmento está na aba \"Churn no Período\"."
+        )
 
-    df_filtered = df_churn[
-        (df_churn['Ano Churn'].isin(selected_years)) &
-        (df_churn['Nome Mes Churn'].isin(selected_months)) &
-        (df_churn['Tipo de Cliente'].isin(selected_client_types))
-    ]
-    if 'Tipo de Churn' in df_filtered.columns and selected_churn_types:
-        df_filtered = df_filtered[df_filtered['Tipo de Churn'].isin(selected_churn_types)]
 
+    selection = build_selection(filter_options, selected_years, selected_months, selected_client_types, selected_churn_types)
 
-    if df_filtered.empty:
+    # --- Exportação: formato usado por todos os botões de download ---
+    st.sidebar.subheader("Exportar Dados")
+    export_format = st.sidebar.selectbox("Formato", options=list(export_formats.keys()), key="export_format")
+    with st.sidebar:
+        # Os dados linha a linha só são filtrados quando o botão é clicado
+        render_download_button(
+            "Baixar OS filtradas",
+            lambda: filter_churn_data(df_churn, selection),
+            f"churn_filtrado_{dataset_name}",
+            export_format,
+            key="download_filtered_rows"
+        )
+
+    # Resultados da seleção: direto do snapshot materializado quando disponível, senão calculados ao vivo
+    # (recalculando só as partes afetadas pela última mudança de filtros; ver dashboard_graph).
+    # Entre os dois, o cache compartilhado de resultados, abastecido também pelo pré-cálculo.
+    current_selection_key = selection_key(selection)
+    result_cache = get_selection_result_cache()
+    prefetcher = get_selection_prefetcher() if prefetch_enabled else None
+    dashboard_results = kpi_snapshot.get(current_selection_key)
+    if dashboard_results is None:
+        dashboard_results = result_cache.get(results_version, current_selection_key)
+    if dashboard_results is None and prefetcher is not None:
+        dashboard_results = prefetcher.wait_pending(results_version, current_selection_key)
+    if dashboard_results is None:
+        compute_started = time.perf_counter()
+        dashboard_results = compute_dashboard_results_incremental(
+            df_churn, df_facts, selection, df_forecasts, results_version,
+            st.session_state.setdefault('dashboard_graph_memo', {})
+        )
+        result_cache.put(results_version, current_selection_key, dashboard_results, time.perf_counter() - compute_started)
+
+    if not dashboard_results['has_data']:
         st.warning("Nenhum dado de CHURN encontrado com os filtros selecionados. Ajuste os filtros na barra lateral.")
         st.stop()
+    kpis = dashboard_results['kpis']
 
     # --- INÍCIO DA SEÇÃO DE KPIS (Sem caixas, com alinhamento manual) ---
     st.header("Indicadores de Performance")
@@ -508,14 +3583,7 @@ def main():
 
     with col1:
         # KPI: Total de Churn Executado (2025) - Lógica Original Mantida
-        df_churn_2025_kpi = df_churn[df_churn['Ano Churn'] == 2025].copy()
-        df_churn_2025_kpi = df_churn_2025_kpi[
-            (df_churn_2025_kpi['Nome Mes Churn'].isin(selected_months)) &
-            (df_churn_2025_kpi['Tipo de Cliente'].isin(selected_client_types))
-        ]
-        if selected_churn_types:
-            df_churn_2025_kpi = df_churn_2025_kpi[df_churn_2025_kpi['Tipo de Churn'].isin(selected_churn_types)]
-        total_churn_2025_only = df_churn_2025_kpi['Volume'].sum()
+        total_churn_2025_only = kpis['total_churn_2025']
         
         st.markdown(f"""
             <div class="kpi-container">
@@ -525,107 +3593,9 @@ def main():
         """.replace(",", "."), unsafe_allow_html=True) # Alteração aqui para formatar com ponto
 
     with col_churn_operacional:
-        # KPI: Total de Churn Operacional (2025) - Lógica Original Mantida
-        churn_operacional_value = "N/A"
-        churn_operacional_percentage = "N/A"
-
-        if not df_backlog_raw.empty and selected_years and selected_months and not df_active_raw.empty:
-            current_year_for_backlog = max(selected_years) if selected_years else 2025
-            
-            if len(selected_months) == 1:
-                current_month_num = month_order_num_pt.index(selected_months[0]) + 1
-
-                backlog_current_month_df = df_backlog_raw[
-                    (df_backlog_raw['Ano Backlog'] == current_year_for_backlog) &
-                    (df_backlog_raw['Mes Backlog'] == current_month_num)
-                ]
-                backlog_current_month = backlog_current_month_df['Volume Backlog'].sum()
-
-                backlog_previous_month = 0
-                if current_month_num == 1 and current_year_for_backlog == 2025:
-                    dez_2024_backlog_df = df_backlog_raw[
-                        (df_backlog_raw['Ano Backlog'] == 2024) & 
-                        (df_backlog_raw['Mes Backlog'] == 12)
-                    ]
-                    backlog_previous_month = dez_2024_backlog_df['Volume Backlog'].sum()
-                elif current_month_num > 1:
-                    backlog_previous_month_df = df_backlog_raw[
-                        (df_backlog_raw['Ano Backlog'] == current_year_for_backlog) &
-                        (df_backlog_raw['Mes Backlog'] == current_month_num - 1)
-                    ]
-                    backlog_previous_month = backlog_previous_month_df['Volume Backlog'].sum()
-
-
-                delta_backlog = backlog_current_month - backlog_previous_month
-
-                churn_volume_current_month = df_filtered[
-                    (df_filtered['Ano Churn'] == current_year_for_backlog) &
-                    (df_filtered['Mes Churn'] == current_month_num)
-                ]['Volume'].sum()
-
-                churn_operacional_value = delta_backlog + churn_volume_current_month
-
-                active_base_current_month_df = df_active_raw[
-                    (df_active_raw['Ano Base Ativa'] == current_year_for_backlog) &
-                    (df_active_raw['Mes Base Ativa'] == current_month_num) &
-                    (df_active_raw['Tipo de Cliente Base Ativa'].isin(selected_client_types))
-                ]
-                active_base_current_month = active_base_current_month_df['Volume Base Ativa'].sum()
-
-                if active_base_current_month > 0:
-                    churn_operacional_percentage = (churn_operacional_value / active_base_current_month) * 100
-
-
-            elif len(selected_months) > 1:
-                total_churn_operacional = 0
-                total_active_base_period = 0
-
-                sorted_selected_month_nums = sorted([month_order_num_pt.index(m) + 1 for m in selected_months])
-
-                for i, current_month_num in enumerate(sorted_selected_month_nums):
-                    backlog_current_month_df = df_backlog_raw[
-                        (df_backlog_raw['Ano Backlog'] == current_year_for_backlog) &
-                        (df_backlog_raw['Mes Backlog'] == current_month_num)
-                    ]
-                    backlog_current_month = backlog_current_month_df['Volume Backlog'].sum()
-
-                    backlog_previous_month = 0
-                    if i > 0:
-                        prev_month_num = sorted_selected_month_nums[i-1]
-                        backlog_previous_month_df = df_backlog_raw[
-                            (df_backlog_raw['Ano Backlog'] == current_year_for_backlog) &
-                            (df_backlog_raw['Mes Backlog'] == prev_month_num)
-                        ]
-                        backlog_previous_month = backlog_previous_month_df['Volume Backlog'].sum()
-                    elif current_month_num == 1 and current_year_for_backlog > (df_backlog_raw['Ano Backlog'].min() if not df_backlog_raw.empty else current_year_for_backlog):
-                        backlog_previous_month_df = df_backlog_raw[
-                            (df_backlog_raw['Ano Backlog'] == current_year_for_backlog - 1) &
-                            (df_backlog_raw['Mes Backlog'] == 12)
-                        ]
-                        backlog_previous_month = backlog_previous_month_df['Volume Backlog'].sum()
-                    
-                    delta_backlog = backlog_current_month - backlog_previous_month
-
-                    churn_volume_current_month = df_filtered[
-                        (df_filtered['Ano Churn'] == current_year_for_backlog) &
-                        (df_filtered['Mes Churn'] == current_month_num)
-                    ]['Volume'].sum()
-                    
-                    total_churn_operacional += (delta_backlog + churn_volume_current_month)
-
-                    active_base_current_month_df = df_active_raw[
-                        (df_active_raw['Ano Base Ativa'] == current_year_for_backlog) &
-                        (df_active_raw['Mes Base Ativa'] == current_month_num) &
-                        (df_active_raw['Tipo de Cliente Base Ativa'].isin(selected_client_types))
-                    ]
-                    total_active_base_period += active_base_current_month_df['Volume Base Ativa'].sum()
-                
-                churn_operacional_value = total_churn_operacional
-
-                if total_active_base_period > 0:
-                    churn_operacional_percentage = (churn_operacional_value / total_active_base_period) * 100
-                else:
-                    churn_operacional_percentage = "N/A"
+        # KPI: Total de Churn Operacional (2025) - Lógica Original Mantida (ver compute_operational_churn)
+        churn_operacional_value = kpis['churn_operacional_value']
+        churn_operacional_percentage = kpis['churn_operacional_percentage']
         
         display_value_co = f"{int(churn_operacional_value):,.0f}".replace(",", ".") if isinstance(churn_operacional_value, (int, float)) else str(churn_operacional_value)
         
@@ -645,72 +3615,36 @@ def main():
 
 
     with col3_proj: # Esta agora é a 3ª coluna visualmente
-        # KPI: Projeção Anual Churn - Lógica Original Mantida
-        projected_annual_churn = 0 
-        if selected_years:
-            current_year_churn_proj = max(selected_years)
-            df_current_year_churn = df_filtered[df_filtered['Ano Churn'] == current_year_churn_proj]
-
-            if not df_current_year_churn.empty:
-                max_month_data_churn = df_current_year_churn['Mes Churn'].max()
-                churn_accumulated = df_current_year_churn[df_current_year_churn['Mes Churn'] <= max_month_data_churn]['Volume'].sum()
-                num_months_data_churn = df_current_year_churn['Mes Churn'].nunique()
-
-                if num_months_data_churn > 0:
-                    projected_annual_churn = (churn_accumulated / num_months_data_churn) * 12
+        # KPI: Projeção Anual Churn - projeção sazonal pré-calculada ou média mensal (ver compute_annual_projection)
+        projected_annual_churn = kpis['projected_annual_churn']
+        forecast_info = kpis['forecast_info']
         
         display_value_proj = f"{int(projected_annual_churn):,.0f}".replace(",", ".") if projected_annual_churn > 0 else "N/A"
         help_text_proj = "Os dados neste KPI referem-se ao ano selecionado para projeção." if projected_annual_churn > 0 else "Sem dados para projeção."
+
+        interval_text_proj = ""
+        if forecast_info is not None and projected_annual_churn > 0:
+            lower_proj = f"{int(forecast_info['lower']):,.0f}".replace(",", ".")
+            upper_proj = f"{int(forecast_info['upper']):,.0f}".replace(",", ".")
+            interval_text_proj = f'<div class="kpi-delta">({lower_proj} a {upper_proj})</div>'
+            help_text_proj = (
+                f"Projeção pelo modelo '{forecast_info['model']}' para o ano selecionado, "
+                f"com intervalo de ~95% entre {lower_proj} e {upper_proj}."
+            )
         
         st.markdown(f"""
             <div class="kpi-container">
                 <div class="kpi-title">Projeção Anual Churn ({max(selected_years) if selected_years else 'N/A'})</div>
                 <div class="kpi-value">{display_value_proj}</div>
+                {interval_text_proj}
             </div>
         """, unsafe_allow_html=True, help=help_text_proj)
 
 
     with col6_churn_rate: # Esta agora é a 4ª coluna visualmente
-        # KPI: Projeção Churn Rate Anual (%) - Lógica Original Mantida
-        churn_rate_value = "N/A"
-        
-        projected_annual_churn_calc = 0
-        avg_monthly_active_calc = 0
-
-        if selected_years:
-            current_year_churn_proj_calc = max(selected_years)
-            df_current_year_churn_calc = df_churn[ 
-                (df_churn['Ano Churn'] == current_year_churn_proj_calc) &
-                (df_churn['Nome Mes Churn'].isin(selected_months)) &
-                (df_churn['Tipo de Cliente'].isin(selected_client_types))
-            ]
-            if selected_churn_types:
-                    df_current_year_churn_calc = df_current_year_churn_calc[df_current_year_churn_calc['Tipo de Churn'].isin(selected_churn_types)]
-
-            if not df_current_year_churn_calc.empty:
-                max_month_data_churn_calc = df_current_year_churn_calc['Mes Churn'].max()
-                churn_accumulated_calc = df_current_year_churn_calc[df_current_year_churn_calc['Mes Churn'] <= max_month_data_churn_calc]['Volume'].sum()
-                num_months_data_churn_calc = df_current_year_churn_calc['Mes Churn'].nunique()
-                if num_months_data_churn_calc > 0:
-                    projected_annual_churn_calc = (churn_accumulated_calc / num_months_data_churn_calc) * 12
-
-        if not df_active_raw.empty:
-            current_year_active_proj_calc = 2025 
-            df_current_year_active_filtered_calc = df_active_raw[
-                (df_active_raw['Mes Base Ativa'].isin([month_order_num_pt.index(m)+1 for m in selected_months])) &
-                (df_active_raw['Tipo de Cliente Base Ativa'].isin(selected_client_types))
-            ].copy()
-            if selected_client_types:
-                df_current_year_active_filtered_calc = df_current_year_active_filtered_calc[df_current_year_active_filtered_calc['Tipo de Cliente Base Ativa'].isin(selected_client_types)]
-            
-            if not df_current_year_active_filtered_calc.empty:
-                total_active_until_now_calc = df_current_year_active_filtered_calc['Volume Base Ativa'].sum()
-                num_months_active_data_calc = df_current_year_active_filtered_calc['Mes Base Ativa'].nunique()
-                if num_months_active_data_calc > 0:
-                    avg_monthly_active_calc = total_active_until_now_calc / num_months_active_data_calc
-
-        if projected_annual_churn_calc is not None and avg_monthly_active_calc is not None and avg_monthly_active_calc > 0:
-            churn_rate_value = (projected_annual_churn_calc / avg_monthly_active_calc) * 100 
+        # KPI: Projeção Churn Rate Anual (%) - mesma projeção anual do KPI anterior (ver compute_churn_rate_projection)
+        churn_rate_value = kpis['churn_rate_value']
+        avg_monthly_active_calc = kpis['avg_monthly_active']
         
         display_value_cr = f"{churn_rate_value:.2f}%".replace('.', ',') if isinstance(churn_rate_value, (int, float)) else "N/A"
         
@@ -723,7 +3657,7 @@ def main():
 
 
     with col4_base_ativa: # Esta agora é a 5ª coluna visualmente
-        # KPI: Média Mensal Base Ativa - Lógica Original Mantida
+        # KPI: Média Mensal Base Ativa (último ano selecionado, o mesmo do churn rate)
         if avg_monthly_active_calc > 0:
             display_value_b = f"{int(avg_monthly_active_calc):,.0f}".replace(",", ".")
             st.markdown(f"""
@@ -731,7 +3665,7 @@ def main():
                     <div class="kpi-title">Média Mensal Base Ativa</div>
                     <div class="kpi-value">{display_value_b}</div>
                 </div>
-            """, unsafe_allow_html=True, help="Os dados neste KPI referem-se ao ano de 2025.")
+            """, unsafe_allow_html=True, help=f"Os dados neste KPI referem-se ao ano de {max(selected_years)}.")
         else:
             st.markdown(f"""
                 <div class="kpi-container">
@@ -741,42 +3675,9 @@ def main():
             """, unsafe_allow_html=True, help="Arquivo de base ativa não carregado ou vazio.")
 
     with col5_media_var: # Esta agora é a 6ª coluna visualmente
-        # KPI: Variação de Churn Ex. 2025 vs 2024 - Lógica Ajustada para Absoluto + Porcentagem
-        df_churn_for_kpi_comparison = df_churn.copy()
-        if selected_client_types:
-            df_churn_for_kpi_comparison = df_churn_for_kpi_comparison[df_churn_for_kpi_comparison['Tipo de Cliente'].isin(selected_client_types)]
-        if selected_churn_types:
-            df_churn_for_kpi_comparison = df_churn_for_kpi_comparison[df_churn_for_kpi_comparison['Tipo de Churn'].isin(selected_churn_types)]
-
-        # Lógica para obter a variação anual (média das variações mensais)
-        df_monthly_volumes_kpi = df_churn_for_kpi_comparison[
-            df_churn_for_kpi_comparison['Ano Churn'].isin([2024, 2025])
-        ].groupby(['Ano Churn', 'Mes Churn']).agg(
-                Volume_Churn=('Volume', 'sum')
-        ).reset_index()
-
-        df_comparison = df_monthly_volumes_kpi.pivot_table(
-            index='Mes Churn',
-            columns='Ano Churn',
-            values='Volume_Churn'
-        ).reset_index()
-
-        selected_month_nums = [month_order_num_pt.index(m)+1 for m in selected_months]
-        df_comparison_filtered_months = df_comparison[df_comparison['Mes Churn'].isin(selected_month_nums)].copy()
-
-        df_comparison_filtered_months[2024] = df_comparison_filtered_months.get(2024, pd.Series(0, index=df_comparison_filtered_months.index)).fillna(0)
-        df_comparison_filtered_months[2025] = df_comparison_filtered_months.get(2025, pd.Series(0, index=df_comparison_filtered_months.index)).fillna(0)
-
-        # Calcular a diferença absoluta total para os meses selecionados
-        absolute_diff_yoy = df_comparison_filtered_months[2025].sum() - df_comparison_filtered_months[2024].sum()
-
-        # Calcular a variação percentual média mensal
-        df_comparison_filtered_months['Monthly_Variation'] = pd.NA
-        valid_comparison_rows = df_comparison_filtered_months[df_comparison_filtered_months[2024] > 0]
-        if not valid_comparison_rows.empty:
-            df_comparison_filtered_months.loc[valid_comparison_rows.index, 'Monthly_Variation'] = \
-                (valid_comparison_rows[2025] - valid_comparison_rows[2024]) / valid_comparison_rows[2024]
-        average_monthly_percentage_variation = df_comparison_filtered_months['Monthly_Variation'].mean()
+        # KPI: Variação de Churn Ex. 2025 vs 2024 - Absoluto + Porcentagem (ver compute_yoy_variation)
+        absolute_diff_yoy = kpis['absolute_diff_yoy']
+        average_monthly_percentage_variation = kpis['average_monthly_percentage_variation']
 
         # Formatação para exibição
         display_value_yoy = f"{int(absolute_diff_yoy):,.0f}".replace(",", ".") if isinstance(absolute_diff_yoy, (int, float)) else "N/A"
@@ -811,188 +3712,40 @@ def main():
         """.replace(",", "."), unsafe_allow_html=True) # Alteração aqui para formatar com ponto
     # --- FIM DA SEÇÃO DE KPIS ---
     st.markdown("---") # Separador após a seção de KPIs
+    cache_metrics.record_timing('kpis', time.perf_counter() - render_started)
+
+    # Importação adiada: os KPIs acima já foram enviados ao navegador antes do custo do plotly.express
+    import plotly.express as px
 
     # --- Abas para organizar o conteúdo ---
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Volume Mensal de Churn", "Churn por Tipo de Cliente", "Volume de Churn Mensal por Tipo", "Motivos de Cancelamento", "Churn por Filial"])
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8, tab9, tab10, tab11, tab12, tab13 = st.tabs(["Volume Mensal de Churn", "Churn por Tipo de Cliente", "Volume de Churn Mensal por Tipo", "Motivos de Cancelamento", "Churn por Filial", "Tempo até Desinstalação", "Detalhamento de OS", "Alertas de Churn", "Churn LTM", "Simulador de Cenários", "Metas OTL", "Hierarquia Regional", "Churn no Período"])
 
     with tab1:
         st.header("Churn Mensal por Ano e Variação")
-        df_active_monthly_volumes = pd.DataFrame()
-        if not df_active_raw.empty:
-            df_active_filtered_for_chart = df_active_raw[
-                (df_active_raw['Mes Base Ativa'].isin([month_order_num_pt.index(m)+1 for m in selected_months])) &
-                (df_active_raw['Tipo de Cliente Base Ativa'].isin(selected_client_types))
-            ].copy()
-            
-            df_active_monthly_volumes = df_active_filtered_for_chart.groupby(['Ano Base Ativa', 'Mes Base Ativa', 'Nome Mes Ativa']).agg(
-                Volume_Base_Ativa=('Volume Base Ativa', 'sum')
-            ).reset_index()
-            
-            df_active_monthly_volumes.rename(columns={
-                'Ano Base Ativa': 'Ano Churn',
-                'Mes Base Ativa': 'Mes Churn',
-                'Nome Mes Ativa': 'Nome Mes Churn'
-            }, inplace=True)
-
-        df_plot_monthly_volume = df_filtered.groupby(['Ano Churn', 'Mes Churn', 'Nome Mes Churn']).agg(
-            Volume_Churn=('Volume', 'sum')
-        ).reset_index().sort_values(by=['Ano Churn', 'Mes Churn'])
-
-        df_plot_monthly_volume = pd.merge(
-            df_plot_monthly_volume,
-            df_active_monthly_volumes,
-            on=['Ano Churn', 'Mes Churn', 'Nome Mes Churn'],
-            how='left'
-        )
-        
-        df_plot_monthly_volume['Churn_Rate'] = df_plot_monthly_volume.apply(
-            lambda row: (row['Volume_Churn'] / row['Volume_Base_Ativa'] * 100) if row['Volume_Base_Ativa'] > 0 else float('nan'),
-            axis=1
-        )
-        
-        df_plot_monthly_volume['Bar_Text_Label'] = df_plot_monthly_volume.apply(
-            lambda row: (
-                f"{row['Volume_Churn']:,.0f}".replace(",", ".") +
-                (f"<br>{row['Churn_Rate']:.2f}%".replace(".", ",") if pd.notna(row['Churn_Rate']) and row['Ano Churn'] == 2025 else "")
-            ),
-            axis=1
-        )
-
-        df_yoy_comparison = df_plot_monthly_volume.pivot_table(
-            index=['Mes Churn', 'Nome Mes Churn'],
-            columns='Ano Churn',
-            values='Volume_Churn'
-        ).reset_index()
-
-        if 2024 in df_yoy_comparison.columns and 2025 in df_yoy_comparison.columns:
-            df_yoy_comparison['YoY_Variation'] = (
-                (df_yoy_comparison[2025] - df_yoy_comparison[2024]) /
-                df_yoy_comparison[2024].replace(0, pd.NA)
-            ).fillna(pd.NA)
-        else:
-            df_yoy_comparison['YoY_Variation'] = pd.NA
-
-        df_yoy_pivot_for_label = df_yoy_comparison.copy()
-        df_yoy_pivot_for_label['X_Axis_Month_Label'] = df_yoy_pivot_for_label.apply(
-            lambda row: (
-                f"{row['Nome Mes Churn']}" +
-                (f"<br>({row['YoY_Variation']:.1%})".replace(".", ",") if pd.notna(row['YoY_Variation']) else "")
-            ),
-            axis=1
-        )
-
-        df_plot_monthly = pd.merge(
-            df_plot_monthly_volume,
-            df_yoy_pivot_for_label[['Mes Churn', 'X_Axis_Month_Label', 'YoY_Variation']],
-            on='Mes Churn',
-            how='left'
-        )
-
-        fig_monthly_bar_with_variation = px.bar(
-            df_plot_monthly,
-            x="X_Axis_Month_Label",
-            y="Volume_Churn",
-            color=df_plot_monthly['Ano Churn'].astype(str),
-            barmode="group",
-            labels={
-                "X_Axis_Month_Label": "Mês (Variação YoY)",
-                "color": "Ano"
-            },
-            category_orders={"X_Axis_Month_Label": sorted(df_yoy_pivot_for_label['X_Axis_Month_Label'].unique(), key=lambda x: month_order_num_pt.index(x.split('<br>')[0]) if '<br>' in x else month_order_num_pt.index(x))},
-            text='Bar_Text_Label'
-        )
-
-        fig_monthly_bar_with_variation.update_traces(
-            textposition='outside',
-            textfont=dict(color='black', weight='bold', size=10),
-            textangle=0
-        )
-
-        fig_monthly_bar_with_variation.update_traces(
-            hovertemplate="<b>Mês:</b> %{customdata[1]}<br><b>Ano:</b> %{fullData.name}<br><b>Volume:</b> %{y:,.0f}".replace(",", ".") + # Alteração aqui para formatar com ponto
-                          "<br><b>Variação (25 vs 24):</b> %{customdata[0]:.1%}<extra></extra>".replace(".", ",") + # Alteração aqui para formatar com vírgula
-                          "<br><b>Informação na barra:</b> %{text}<extra></extra>",
-            customdata=df_plot_monthly[['YoY_Variation', 'Nome Mes Churn']]
-        )
+        df_plot_monthly = dashboard_results['monthly_chart']
+        monthly_category_order = dashboard_results['monthly_category_order']
 
-        fig_monthly_bar_with_variation.update_layout(
-            hovermode="x unified",
-            yaxis_title="",
-            legend=dict(
-                font=dict(
-                    size=12,
-                    color="black",
-                    family="Arial",
-                    weight="bold"
-                ),
-                orientation="v",
-                yanchor="top",
-                y=1,
-                xanchor="right",
-                x=1.1
-            ),
-            xaxis_title="Mês (Variação YoY)",
-            xaxis=dict(tickangle=0)
-        )
+        fig_monthly_bar_with_variation = build_monthly_volume_figure(df_plot_monthly, monthly_category_order)
         st.plotly_chart(fig_monthly_bar_with_variation, use_container_width=True)
+        render_download_button(
+            "Baixar tabela",
+            df_plot_monthly[['Ano Churn', 'Mes Churn', 'Nome Mes Churn', 'Volume_Churn', 'Volume_Base_Ativa', 'Churn_Rate', 'YoY_Variation']],
+            "churn_mensal", export_format, key="download_monthly"
+        )
 
     with tab2:
         st.header("Distribuição de Churn por Tipo de Cliente")
 
-        df_churn_2024 = df_churn[
-            (df_churn['Ano Churn'] == 2024) &
-            (df_churn['Nome Mes Churn'].isin(selected_months)) &
-            (df_churn['Tipo de Cliente'].isin(selected_client_types))
-        ]
-        if selected_churn_types:
-            df_churn_2024 = df_churn_2024[df_churn_2024['Tipo de Churn'].isin(selected_churn_types)]
-
-
-        df_churn_2025 = df_churn[
-            (df_churn['Ano Churn'] == 2025) &
-            (df_churn['Nome Mes Churn'].isin(selected_months)) &
-            (df_churn['Tipo de Cliente'].isin(selected_client_types))
-        ]
-        if selected_churn_types:
-            df_churn_2025 = df_churn_2025[df_churn_2025['Tipo de Churn'].isin(selected_churn_types)]
-
-
-        df_plot_client_type_2024 = df_churn_2024.groupby('Tipo de Cliente').agg(
-            Volume_Churn=('Volume', 'sum')
-        ).reset_index().sort_values(by='Volume_Churn', ascending=False)
-
-        df_plot_client_type_2025 = df_churn_2025.groupby('Tipo de Cliente').agg(
-            Volume_Churn=('Volume', 'sum')
-        ).reset_index().sort_values(by='Volume_Churn', ascending=False)
+        df_plot_client_type_2024 = dashboard_results['client_type_2024']
+        df_plot_client_type_2025 = dashboard_results['client_type_2025']
+        df_comparison_client_type = dashboard_results['client_type_comparison']
 
         col_2024, col_2025, col_comparison = st.columns([1, 1, 1]) 
 
         with col_2024:
             st.markdown("<h3 style='text-align: center;'>Consolidado 2024</h3>", unsafe_allow_html=True)
             if not df_plot_client_type_2024.empty:
-                fig_client_type_2024 = px.pie(
-                    df_plot_client_type_2024,
-                    values="Volume_Churn",
-                    names="Tipo de Cliente",
-                    hole=0.4
-                )
-                fig_client_type_2024.update_traces(textinfo="percent+label", pull=[0.05]*len(df_plot_client_type_2024))
-                fig_client_type_2024.update_layout(
-                    showlegend=True,
-                    legend=dict(
-                        orientation="h",
-                        yanchor="bottom",
-                        y=-0.2,
-                        xanchor="center",
-                        x=0.5,
-                        font=dict(
-                            size=12,
-                            color="black",
-                            family="Arial",
-                            weight="bold"
-                        )
-                    )
-                )
+                fig_client_type_2024 = build_client_type_pie(df_plot_client_type_2024, legend_below=True)
                 st.plotly_chart(fig_client_type_2024, use_container_width=True)
             else:
                 st.info("Nenhum dado de churn para 2024 com os filtros selecionados.")
@@ -1000,43 +3753,13 @@ def main():
         with col_2025:
             st.markdown("<h3 style='text-align: center;'>Consolidado 2025</h3>", unsafe_allow_html=True)
             if not df_plot_client_type_2025.empty:
-                fig_client_type_2025 = px.pie(
-                    df_plot_client_type_2025,
-                    values="Volume_Churn",
-                    names="Tipo de Cliente",
-                    hole=0.4
-                )
-                fig_client_type_2025.update_traces(textinfo="percent+label", pull=[0.05]*len(df_plot_client_type_2025))
-                fig_client_type_2025.update_layout(
-                    legend=dict(
-                        font=dict(
-                            size=12,
-                            color="black",
-                            family="Arial",
-                            weight="bold"
-                        )
-                    )
-                )
+                fig_client_type_2025 = build_client_type_pie(df_plot_client_type_2025)
                 st.plotly_chart(fig_client_type_2025, use_container_width=True)
             else:
                 st.info("Nenhum dado de churn para 2025 com os filtros selecionados.")
 
         with col_comparison:
             st.subheader("Variação Anual (2025 vs 2024)")
-            df_comparison_client_type = pd.merge(
-                df_plot_client_type_2024.rename(columns={'Volume_Churn': 'Volume_2024'}),
-                df_plot_client_type_2025.rename(columns={'Volume_Churn': 'Volume_2025'}),
-                on='Tipo de Cliente',
-                how='outer'
-            ).fillna(0)
-
-            df_comparison_client_type['Diferenca_Absoluta'] = df_comparison_client_type['Volume_2025'] - df_comparison_client_type['Volume_2024']
-            
-            df_comparison_client_type['Diferenca_Percentual'] = df_comparison_client_type.apply(
-                lambda row: ((row['Volume_2025'] - row['Volume_2024']) / row['Volume_2024']) * 100 if row['Volume_2024'] != 0 else (100 if row['Volume_2025'] > 0 else 0),
-                axis=1
-            )
-            
             if not df_comparison_client_type.empty:
                 with st.container(border=True):
                     st.markdown("<h4 style='text-align: center; color: gray;'>Diferenças por Tipo de Cliente</h4>", unsafe_allow_html=True)
@@ -1059,21 +3782,21 @@ def main():
                             )
             else:
                 st.info("Nenhuma variação para exibir com os filtros selecionado.")
+        render_download_button("Baixar tabela", df_comparison_client_type, "churn_por_tipo_cliente", export_format, key="download_client_type")
         
     with tab3: # Nova aba para "Volume de Churn Mensal por Tipo"
         st.header("Volume de Churn Mensal por Tipo")
         
-        if 'Tipo de Churn' in df_filtered.columns and not df_filtered['Tipo de Churn'].isnull().all():
-            df_plot_churn_type_monthly = df_filtered.groupby(['Ano Churn', 'Mes Churn', 'Nome Mes Churn', 'Tipo de Churn']).agg(
-                Volume_Churn=('Volume', 'sum')
-            ).reset_index()
-
-            df_plot_churn_type_monthly['Nome Mes Abreviado'] = df_plot_churn_type_monthly['Nome Mes Churn'].map(month_to_abbr_map)
-
+        df_plot_churn_type_monthly = dashboard_results['churn_type_monthly']
+        if df_plot_churn_type_monthly is not None:
             ordered_abbr_months = month_abbr_order_pt
+            churn_type_top_n = st.number_input("Tipos de churn exibidos (demais em \"Outros\")", min_value=1, value=top_n_default, step=1, key="churn_type_top_n")
             
             fig_churn_type_monthly_stacked = px.bar(
-                df_plot_churn_type_monthly,
+                bucket_top_n(
+                    df_plot_churn_type_monthly, 'Tipo de Churn', ['Volume_Churn'], int(churn_type_top_n),
+                    group_columns=['Ano Churn', 'Mes Churn', 'Nome Mes Churn', 'Nome Mes Abreviado']
+                ),
                 x="Nome Mes Abreviado",
                 y="Volume_Churn",
                 color="Tipo de Churn",
@@ -1116,197 +3839,502 @@ def main():
             fig_churn_type_monthly_stacked.for_each_annotation(lambda a: a.update(text=a.text.replace("Ano Churn=", "")))
 
             st.plotly_chart(fig_churn_type_monthly_stacked, use_container_width=True)
+            render_download_button(
+                "Baixar tabela",
+                df_plot_churn_type_monthly.drop(columns=['Nome Mes Abreviado']),
+                "churn_mensal_por_tipo", export_format, key="download_churn_type"
+            )
         else:
             st.warning("Não há dados de 'Tipo de Churn' para exibir o gráfico mensal empilhado.")
 
     with tab4:
         st.header("Análise de Motivos de Cancelamento por Ano")
 
-        df_cancellation_analysis_2025_filtered = df_filtered[df_filtered['Ano Churn'] == 2025].copy()
-        
-        reasons_summary_2025 = pd.DataFrame()
-        if 'Categoria4_Motivo' in df_cancellation_analysis_2025_filtered.columns and not df_cancellation_analysis_2025_filtered['Categoria4_Motivo'].isnull().all():
-            df_cancellation_analysis_2025_clean = df_cancellation_analysis_2025_filtered.copy()
-            df_cancellation_analysis_2025_clean['Categoria4_Motivo_Lower'] = df_cancellation_analysis_2025_clean['Categoria4_Motivo'].astype(str).str.strip().str.lower()
-            df_cancellation_analysis_2025_clean = df_cancellation_analysis_2025_clean[
-                (df_cancellation_analysis_2025_clean['Categoria4_Motivo_Lower'] != '') &
-                (df_cancellation_analysis_2025_clean['Categoria4_Motivo_Lower'] != 'nan') &
-                (df_cancellation_analysis_2025_clean['Categoria4_Motivo_Lower'] != 'desconsiderar')
-            ].copy()
-
-            if not df_cancellation_analysis_2025_clean.empty:
-                reasons_summary_2025 = df_cancellation_analysis_2025_clean.groupby('Categoria4_Motivo').agg(
-                    Volume_2025=('Volume', 'sum')
-                ).reset_index()
-        
-        df_cancellation_analysis_2024_filtered = df_filtered[df_filtered['Ano Churn'] == 2024].copy()
-        
-        reasons_summary_2024 = pd.DataFrame()
-        if 'Categoria4_Motivo' in df_cancellation_analysis_2024_filtered.columns and not df_cancellation_analysis_2024_filtered['Categoria4_Motivo'].isnull().all():
-            df_cancellation_analysis_2024_clean = df_cancellation_analysis_2024_filtered.copy()
-            df_cancellation_analysis_2024_clean['Categoria4_Motivo_Lower'] = df_cancellation_analysis_2024_clean['Categoria4_Motivo'].astype(str).str.strip().str.lower()
-            df_cancellation_analysis_2024_clean = df_cancellation_analysis_2024_clean[
-                (df_cancellation_analysis_2024_clean['Categoria4_Motivo_Lower'] != '') &
-                (df_cancellation_analysis_2024_clean['Categoria4_Motivo_Lower'] != 'nan') &
-                (df_cancellation_analysis_2024_clean['Categoria4_Motivo_Lower'] != 'desconsiderar')
-            ].copy()
-
-            if not df_cancellation_analysis_2024_clean.empty:
-                reasons_summary_2024 = df_cancellation_analysis_2024_clean.groupby('Categoria4_Motivo').agg(
-                    Volume_2024=('Volume', 'sum')
-                ).reset_index()
-
-        if not reasons_summary_2025.empty or not reasons_summary_2024.empty:
-            df_combined_reasons = pd.merge(
-                reasons_summary_2025,
-                reasons_summary_2024,
-                on='Categoria4_Motivo',
-                how='outer'
-            ).fillna(0)
-
-            df_combined_reasons['Volume_2025_Total'] = df_combined_reasons['Volume_2025'].sum()
-            df_combined_reasons['Volume_2024_Total'] = df_combined_reasons['Volume_2024'].sum()
-
-            df_combined_reasons['Percentual_2025'] = df_combined_reasons.apply(
-                lambda row: (row['Volume_2025'] / row['Volume_2025_Total']) * 100 if row['Volume_2025_Total'] > 0 else 0, axis=1
-            )
-            
-            df_combined_reasons['Percentual_2024'] = df_combined_reasons.apply(
-                lambda row: (row['Volume_2024'] / row['Volume_2024_Total']) * 100 if row['Volume_2024_Total'] > 0 else 0, axis=1
-            )
-
-            df_combined_reasons['Variação 2025 vs 2024'] = df_combined_reasons.apply(
-                lambda row: (
-                    ((row['Volume_2025'] / row['Volume_2024']) - 1)
-                    if row['Volume_2024'] > 0 else (
-                        float('inf') if row['Volume_2025'] > 0 else 0
-                    )
-                ),
-                axis=1
-            )
-            
-            df_combined_reasons_display = df_combined_reasons.copy()
-            df_combined_reasons_display['Volume_2025'] = df_combined_reasons_display['Volume_2025'].astype(int)
-            df_combined_reasons_display['Volume_2024'] = df_combined_reasons_display['Volume_2024'].astype(int)
-            df_combined_reasons_display['Percentual_2025'] = df_combined_reasons_display['Percentual_2025'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
-            df_combined_reasons_display['Percentual_2024'] = df_combined_reasons_display['Percentual_2024'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
-            
-            df_combined_reasons_display['Variação 2025 vs 2024'] = df_combined_reasons_display['Variação 2025 vs 2024'].apply(
-                lambda x: f"{x:.2f}%".replace('.', ',') if pd.notna(x) and x != float('inf') else ("Novo Motivo" if x == float('inf') else "0,00%")
-            )
-            
-            df_combined_reasons_display.rename(columns={
-                'Categoria4_Motivo': 'Motivo de Cancelamento',
-                'Volume_2025': 'Volume 2025',
-                'Percentual_2025': '% 2025',
-                'Volume_2024': 'Volume 2024',
-                'Percentual_2024': '% 2024'
-            }, inplace=True)
-
-            df_combined_reasons_display = df_combined_reasons_display[[
-                'Motivo de Cancelamento', 'Volume 2025', '% 2025',
-                'Volume 2024', '% 2024', 'Variação 2025 vs 2024'
-            ]]
-
-            st.dataframe(df_combined_reasons_display, use_container_width=True, hide_index=True)
+        df_combined_reasons_display = dashboard_results['reasons_table']
+        if not df_combined_reasons_display.empty:
+            render_category_table(df_combined_reasons_display, 'Motivo de Cancelamento', "Novo Motivo", key="reasons_table")
+            render_download_button("Baixar tabela", df_combined_reasons_display, "motivos_cancelamento", export_format, key="download_reasons")
         else:
             st.info("Nenhum dado de motivos de cancelamento (da Categoria4) encontrado para 2024 ou 2025 com os filtros selecionados, ou todos foram 'Desconsiderar' / vazios.")
 
     with tab5:
         st.header("Análise de Churn por Filial por Ano")
 
-        df_franchise_analysis_2025_filtered = df_filtered[df_filtered['Ano Churn'] == 2025].copy()
-        
-        reasons_summary_franchise_2025 = pd.DataFrame()
-        if 'Filial' in df_franchise_analysis_2025_filtered.columns and not df_franchise_analysis_2025_filtered['Filial'].isnull().all():
-            df_franchise_analysis_2025_clean = df_franchise_analysis_2025_filtered.copy()
-            df_franchise_analysis_2025_clean['Filial_Lower'] = df_franchise_analysis_2025_clean['Filial'].astype(str).str.strip().str.lower()
-            
-            df_franchise_analysis_2025_clean = df_franchise_analysis_2025_clean[
-                (df_franchise_analysis_2025_clean['Filial_Lower'] != '') &
-                (df_franchise_analysis_2025_clean['Filial_Lower'] != 'nan')
-            ].copy()
-
-            if not df_franchise_analysis_2025_clean.empty:
-                reasons_summary_franchise_2025 = df_franchise_analysis_2025_clean.groupby('Filial').agg(
-                    Volume_2025=('Volume', 'sum')
-                ).reset_index()
-        
-        df_franchise_analysis_2024_filtered = df_filtered[df_filtered['Ano Churn'] == 2024].copy()
-        
-        reasons_summary_franchise_2024 = pd.DataFrame()
-        if 'Filial' in df_franchise_analysis_2024_filtered.columns and not df_franchise_analysis_2024_filtered['Filial'].isnull().all():
-            df_franchise_analysis_2024_clean = df_franchise_analysis_2024_filtered.copy()
-            df_franchise_analysis_2024_clean['Filial_Lower'] = df_franchise_analysis_2024_clean['Filial'].astype(str).str.strip().str.lower()
-
-            df_franchise_analysis_2024_clean = df_franchise_analysis_2024_clean[
-                (df_franchise_analysis_2024_clean['Filial_Lower'] != '') &
-                (df_franchise_analysis_2024_clean['Filial_Lower'] != 'nan')
-            ].copy()
-
-            if not df_cancellation_analysis_2024_clean.empty:
-                reasons_summary_franchise_2024 = df_franchise_analysis_2024_clean.groupby('Filial').agg(
-                    Volume_2024=('Volume', 'sum')
-                ).reset_index()
-
-        if not reasons_summary_franchise_2025.empty or not reasons_summary_franchise_2024.empty:
-            df_combined_franchises = pd.merge(
-                reasons_summary_franchise_2025,
-                reasons_summary_franchise_2024,
-                on='Filial',
-                how='outer'
-            ).fillna(0)
-
-            df_combined_franchises['Volume_2025_Total'] = df_combined_franchises['Volume_2025'].sum()
-            df_combined_franchises['Volume_2024_Total'] = df_combined_franchises['Volume_2024'].sum()
-
-            df_combined_franchises['Percentual_2025'] = df_combined_franchises.apply(
-                lambda row: (row['Volume_2025'] / row['Volume_2025_Total']) * 100 if row['Volume_2025_Total'] > 0 else 0, axis=1
+        df_combined_franchises_display = dashboard_results['franchises_table']
+        if not df_combined_franchises_display.empty:
+            render_category_table(df_combined_franchises_display, 'Filial', "Nova Filial", key="franchises_table")
+            render_download_button("Baixar tabela", df_combined_franchises_display, "churn_por_filial", export_format, key="download_franchises")
+        else:
+            st.info("Nenhum dado de Filial encontrado para 2024 ou 2025 com os filtros selecionado.")
+
+    with tab6:
+        st.header("Tempo entre Criação da OS e Desinstalação")
+
+        # Apenas seleção sobre os grupos pré-calculados: nenhuma operação por linha de OS
+        lead_mask = (
+            df_lead_groups['Ano Churn'].isin(selected_years) &
+            df_lead_groups['Mes Churn'].isin([month_order_num_pt.index(m)+1 for m in selected_months]) &
+            df_lead_groups['Tipo de Cliente'].isin(selected_client_types)
+        ).to_numpy()
+        if selected_churn_types:
+            lead_mask = lead_mask & df_lead_groups['Tipo de Churn'].isin(selected_churn_types).to_numpy()
+
+        df_lead_selected = df_lead_groups[lead_mask]
+        lead_counts_selected = lead_time_counts[lead_mask]
+
+        if lead_counts_selected.sum() == 0:
+            st.info("Nenhuma OS com datas de criação e desinstalação válidas para os filtros selecionados.")
+        else:
+            overall_percentiles = lead_time_percentiles_from_counts(lead_counts_selected.sum(axis=0, keepdims=True), lead_time_percentiles)[0]
+            lead_metric_cols = st.columns(len(lead_time_percentiles) + 1)
+            lead_metric_cols[0].metric("OS Analisadas", f"{int(lead_counts_selected.sum()):,.0f}".replace(",", "."))
+            for metric_col, quantile, value in zip(lead_metric_cols[1:], lead_time_percentiles, overall_percentiles):
+                metric_col.metric(f"P{int(quantile * 100)} (dias)", format_lead_time_days(value))
+
+            lead_breakdown_options = {
+                "Mês": None,
+                "Tipo de Cliente": 'Tipo de Cliente',
+                "Tipo de Churn": 'Tipo de Churn',
+                "Filial": 'Filial'
+            }
+            lead_breakdown = st.selectbox("Detalhar por", options=list(lead_breakdown_options.keys()), key="lead_time_breakdown")
+            if lead_breakdown_options[lead_breakdown] is None:
+                lead_labels = df_lead_selected['Ano Churn'].astype(str) + "-" + df_lead_selected['Mes Churn'].astype(str).str.zfill(2)
+            else:
+                lead_labels = df_lead_selected[lead_breakdown_options[lead_breakdown]].astype(str)
+
+            lead_label_codes, lead_label_values = pd.factorize(lead_labels, sort=True)
+            lead_counts_by_label = np.zeros((len(lead_label_values), lead_counts_selected.shape[1]), dtype=np.int64)
+            np.add.at(lead_counts_by_label, lead_label_codes, lead_counts_selected)
+
+            percentiles_by_label = lead_time_percentiles_from_counts(lead_counts_by_label, lead_time_percentiles)
+            df_lead_table = pd.DataFrame({lead_breakdown: lead_label_values, 'OS': lead_counts_by_label.sum(axis=1)})
+            for i, quantile in enumerate(lead_time_percentiles):
+                df_lead_table[f"P{int(quantile * 100)} (dias)"] = [format_lead_time_days(v) for v in percentiles_by_label[:, i]]
+
+            display_labels = lead_time_display_labels()
+            df_lead_histogram = pd.DataFrame(
+                aggregate_lead_time_display_bins(lead_counts_by_label),
+                index=lead_label_values,
+                columns=display_labels
+            ).rename_axis(lead_breakdown).reset_index().melt(id_vars=lead_breakdown, var_name='Faixa (dias)', value_name='OS')
+
+            fig_lead_time = px.bar(
+                df_lead_histogram,
+                x='Faixa (dias)',
+                y='OS',
+                color=lead_breakdown,
+                barmode='stack',
+                category_orders={'Faixa (dias)': display_labels}
             )
-            
-            df_combined_franchises['Percentual_2024'] = df_combined_franchises.apply(
-                lambda row: (row['Volume_2024'] / row['Volume_2024_Total']) * 100 if row['Volume_2024_Total'] > 0 else 0, axis=1
+            fig_lead_time.update_layout(
+                xaxis_title="Dias entre criação da OS e desinstalação",
+                yaxis_title="Volume de OS",
+                hovermode="x unified"
             )
+            st.plotly_chart(fig_lead_time, use_container_width=True)
+            st.dataframe(df_lead_table, use_container_width=True, hide_index=True)
+            render_download_button("Baixar tabela", df_lead_table, "tempo_ate_desinstalacao", export_format, key="download_lead_time")
+            st.caption(f"Percentis calculados a partir de histogramas diários pré-agregados (até {lead_time_max_days} dias). "
+                       "Valores negativos indicam desinstalação registrada antes da criação da OS.")
+
+    with tab7:
+        st.header("Detalhamento de OS")
 
-            df_combined_franchises['Variação 2025 vs 2024'] = df_combined_franchises.apply(
-                lambda row: (
-                    ((row['Volume_2025'] / row['Volume_2024']) - 1)
-                    if row['Volume_2024'] > 0 else (
-                        float('inf') if row['Volume_2025'] > 0 else 0
+        if drilldown_index['frame'].empty:
+            st.info("Índice de detalhamento indisponível: colunas AnoMes, Filial ou Tipo de Churn ausentes.")
+        else:
+            # Célula do detalhamento: cada filtro escolhe um valor da chave ou "Todos"
+            drill_level_codes = []
+            drill_filter_cols = st.columns(len(drilldown_index_columns))
+            for drill_col, column, level in zip(drill_filter_cols, drilldown_index_columns, drilldown_index['levels']):
+                options = ["Todos"] + [str(value) for value in level]
+                choice = drill_col.selectbox(column, options=range(len(options)), format_func=lambda i, options=options: options[i], key=f"drilldown_{column}")
+                drill_level_codes.append(choice - 1 if choice > 0 else None)
+
+            drill_positions = query_drilldown_rows(drilldown_index, drill_level_codes)
+            # Filtro lateral de Tipo de Cliente aplicado apenas às linhas da célula
+            drill_client_types = drilldown_index['frame']['Tipo de Cliente'].to_numpy()[drill_positions]
+            drill_positions = drill_positions[np.isin(drill_client_types, selected_client_types)]
+
+            available_columns = list(drilldown_index['frame'].columns)
+            col_drill_columns, col_drill_sort, col_drill_order = st.columns([2, 1, 1])
+            with col_drill_columns:
+                drill_columns = st.multiselect(
+                    "Colunas",
+                    options=available_columns,
+                    default=[column for column in drilldown_default_columns if column in available_columns],
+                    key="drilldown_columns"
+                )
+            with col_drill_sort:
+                drill_sort_column = st.selectbox("Ordenar por", options=["(sem ordenação)"] + available_columns, key="drilldown_sort")
+            with col_drill_order:
+                drill_ascending = st.radio("Ordem", options=["Crescente", "Decrescente"], horizontal=True, key="drilldown_order") == "Crescente"
+
+            col_drill_page_size, col_drill_page, col_drill_total = st.columns([1, 1, 2])
+            with col_drill_page_size:
+                drill_page_size = st.selectbox("Linhas por página", options=drilldown_page_sizes, index=1, key="drilldown_page_size")
+            total_pages = max(1, -(-len(drill_positions) // drill_page_size))
+            with col_drill_page:
+                drill_page = st.number_input("Página", min_value=1, max_value=total_pages, value=1, step=1, key="drilldown_page")
+            with col_drill_total:
+                st.markdown(f"**{len(drill_positions):,.0f} OS encontradas** — página {int(drill_page)} de {total_pages}".replace(",", "."))
+
+            if len(drill_positions) == 0 or not drill_columns:
+                st.info("Nenhuma OS para a célula selecionada (ou nenhuma coluna escolhida).")
+            else:
+                df_drill_page = get_drilldown_page(
+                    drilldown_index,
+                    drill_positions,
+                    drill_columns,
+                    sort_column=None if drill_sort_column == "(sem ordenação)" else drill_sort_column,
+                    ascending=drill_ascending,
+                    page=min(int(drill_page), total_pages),
+                    page_size=drill_page_size
+                )
+                st.dataframe(df_drill_page, use_container_width=True, hide_index=True)
+                # Download da célula inteira (não só da página), com as colunas e a ordenação escolhidas
+                render_download_button(
+                    "Baixar OS da célula",
+                    lambda: get_drilldown_page(
+                        drilldown_index, drill_positions, drill_columns,
+                        sort_column=None if drill_sort_column == "(sem ordenação)" else drill_sort_column,
+                        ascending=drill_ascending, page=1, page_size=max(len(drill_positions), 1)
+                    ),
+                    "detalhamento_os", export_format, key="download_drilldown"
+                )
+
+    with tab8:
+        st.header("Alertas de Churn")
+
+        # Alertas já calculados para todas as séries; aqui só se aplicam os filtros da barra lateral
+        selected_year_months = {f"{year}-{month_order_num_pt.index(month)+1:02d}" for year in selected_years for month in selected_months}
+        alerts_mask = df_churn_alerts['AnoMes'].isin(selected_year_months) & df_churn_alerts['Tipo de Cliente'].isin(selected_client_types)
+        if selected_churn_types:
+            alerts_mask &= df_churn_alerts['Tipo de Churn'].isin(selected_churn_types)
+        df_alerts_selected = df_churn_alerts[alerts_mask]
+
+        if df_alerts_selected.empty:
+            st.info("Nenhuma série com churn fora do padrão para os filtros selecionados.")
+        else:
+            alert_months = sorted(df_alerts_selected['AnoMes'].unique(), reverse=True)
+            alert_month = st.selectbox("Mês", options=["Todos"] + alert_months, key="alerts_month")
+            if alert_month != "Todos":
+                df_alerts_selected = df_alerts_selected[df_alerts_selected['AnoMes'] == alert_month]
+            st.metric("Alertas", f"{len(df_alerts_selected):,.0f}".replace(",", "."))
+            render_paginated_table(df_alerts_selected, key="alerts_table")
+            render_download_button("Baixar alertas", df_alerts_selected, "alertas_churn", export_format, key="download_alerts")
+        st.caption(f"Cada série (Filial x Motivo x Tipo de Cliente x Tipo de Churn) é comparada com a mediana dos "
+                   f"{anomaly_baseline_months} meses anteriores, na escala do MAD. Alertas com z robusto a partir de "
+                   f"{str(anomaly_z_threshold).replace('.', ',')} e pelo menos {anomaly_min_volume} OS no mês.")
+
+    with tab9:
+        st.header(f"Churn dos Últimos {ltm_window_months} Meses (LTM)")
+
+        # Séries já calculadas para todos os segmentos; aqui só se escolhe o que exibir
+        df_ltm_selected = df_ltm[df_ltm['Ano'].isin(selected_years)]
+        if df_ltm_selected.empty:
+            st.info(f"São necessários pelo menos {ltm_window_months} meses de churn nos anos selecionados para o cálculo LTM.")
+        else:
+            df_ltm_total = df_ltm_selected[df_ltm_selected['Dimensão'] == 'Total']
+            ltm_last = df_ltm_total.iloc[-1]
+            ltm_previous = df_ltm_total.iloc[-2] if len(df_ltm_total) > 1 else None
+            col_ltm_rate, col_ltm_volume, col_ltm_active = st.columns(3)
+            with col_ltm_rate:
+                if pd.notna(ltm_last['Churn Rate LTM (%)']):
+                    rate_delta = None
+                    if ltm_previous is not None and pd.notna(ltm_previous['Churn Rate LTM (%)']):
+                        rate_delta = f"{ltm_last['Churn Rate LTM (%)'] - ltm_previous['Churn Rate LTM (%)']:+.2f}".replace(".", ",") + " p.p."
+                    st.metric(f"Churn Rate LTM ({ltm_last['AnoMes']})", f"{ltm_last['Churn Rate LTM (%)']:.2f}%".replace(".", ","), rate_delta, delta_color="inverse")
+                else:
+                    st.metric(f"Churn Rate LTM ({ltm_last['AnoMes']})", "N/A")
+            with col_ltm_volume:
+                st.metric("Churn LTM", f"{ltm_last['Churn LTM']:,.0f}".replace(",", "."))
+            with col_ltm_active:
+                st.metric(
+                    "Base Ativa Média LTM",
+                    f"{ltm_last['Base Ativa Média LTM']:,.0f}".replace(",", ".") if pd.notna(ltm_last['Base Ativa Média LTM']) else "N/A",
+                    help=f"Média dos {int(ltm_last['Meses com Base Ativa'])} meses da janela que constam do arquivo de base ativa."
+                )
+
+            ltm_dimension = st.selectbox("Segmentar por", options=['Total'] + ltm_dimensions, key="ltm_dimension")
+            df_ltm_chart = df_ltm_selected[df_ltm_selected['Dimensão'] == ltm_dimension]
+            if ltm_dimension == 'Tipo de Cliente':
+                df_ltm_chart = df_ltm_chart[df_ltm_chart['Segmento'].isin([str(value) for value in selected_client_types])]
+            elif ltm_dimension == 'Tipo de Churn' and selected_churn_types:
+                df_ltm_chart = df_ltm_chart[df_ltm_chart['Segmento'].isin([str(value) for value in selected_churn_types])]
+
+            # Sem base ativa por Filial: o gráfico mostra o volume LTM
+            ltm_measure = 'Churn LTM' if df_ltm_chart['Churn Rate LTM (%)'].isna().all() else 'Churn Rate LTM (%)'
+            df_ltm_plot = df_ltm_chart
+            if ltm_measure == 'Churn LTM' and ltm_dimension != 'Total':
+                # Volumes somam entre segmentos; as taxas não (bases ativas diferentes), por isso só o volume vai para "Outros"
+                ltm_top_n = st.number_input("Segmentos exibidos (demais em \"Outros\")", min_value=1, value=top_n_default, step=1, key="ltm_top_n")
+                df_ltm_plot = bucket_top_n(df_ltm_chart, 'Segmento', [ltm_measure], int(ltm_top_n), group_columns=['AnoMes'])
+            fig_ltm = px.line(
+                df_ltm_plot,
+                x="AnoMes",
+                y=ltm_measure,
+                color="Segmento",
+                markers=True,
+                labels={"AnoMes": "Mês (fim da janela)", "Segmento": ""},
+                render_mode=line_render_mode(len(df_ltm_plot))
+            )
+            fig_ltm.update_layout(hovermode="x unified", xaxis=dict(type='category', categoryorder='category ascending'))
+            st.plotly_chart(fig_ltm, use_container_width=True)
+            render_download_button("Baixar séries LTM", df_ltm_chart, "churn_ltm", export_format, key="download_ltm")
+        st.caption(f"Cada ponto soma o churn dos {ltm_window_months} meses terminados no mês e divide pela média da base "
+                   f"ativa desses meses. Total e Tipo de Churn usam a base ativa de todos os tipos de cliente; "
+                   f"por Filial não há base ativa, então o gráfico mostra o volume.")
+
+    with tab10:
+        scenario_year = max(selected_years)
+        st.header(f"Simulador de Cenários ({scenario_year})")
+
+        scenario_cube = build_scenario_cube(
+            df_churn, results_version, df_facts, scenario_year,
+            tuple(selected_months), tuple(selected_client_types), tuple(selected_churn_types)
+        )
+        if scenario_cube['cells'].size == 0:
+            st.info(f"Nenhum churn em {scenario_year} para os filtros selecionados.")
+        else:
+            # Motivos do mais ao menos frequente, para facilitar a escolha das alavancas
+            reason_volumes = scenario_cube['cells'].sum(axis=(0, 2))
+            reason_options = [scenario_cube['reasons'][i] for i in np.argsort(-reason_volumes, kind='stable')]
+            col_scenario_reasons, col_scenario_types = st.columns(2)
+            with col_scenario_reasons:
+                scenario_reasons = st.multiselect("Motivos a reduzir (Categoria4)", options=reason_options, key="scenario_reasons")
+                reason_cut = st.slider("Redução nos motivos selecionados (%)", 0, 100, 20, 5, key="scenario_reason_cut")
+            with col_scenario_types:
+                type_cuts = [
+                    st.slider(f"Redução do churn {churn_type} (%)", 0, 100, 0, 5, key=f"scenario_type_cut_{churn_type}")
+                    for churn_type in scenario_cube['churn_types']
+                ]
+
+            # O cenário configurado e a curva de 0% a 100% dele, avaliados de uma só vez
+            sweep = np.linspace(0, 1, scenario_sweep_steps)
+            planned_reason_reductions = np.isin(scenario_cube['reasons'], scenario_reasons) * reason_cut / 100
+            planned_type_reductions = np.asarray(type_cuts) / 100
+            df_scenarios = simulate_churn_scenarios(
+                scenario_cube, sweep[:, None] * planned_reason_reductions, sweep[:, None] * planned_type_reductions
+            )
+            df_scenarios.insert(0, 'Aplicação do Cenário (%)', (sweep * 100).round().astype(int))
+            scenario_base, scenario_result = df_scenarios.iloc[0], df_scenarios.iloc[-1]
+
+            def format_rate(value):
+                return f"{value:.2f}%".replace(".", ",") if pd.notna(value) else "N/A"
+
+            col_rate, col_band, col_target, col_probability = st.columns(4)
+            with col_rate:
+                rate_delta = None
+                if pd.notna(scenario_result['Churn Rate Anual (%)']):
+                    rate_delta = f"{scenario_result['Churn Rate Anual (%)'] - scenario_base['Churn Rate Anual (%)']:+.2f}".replace(".", ",") + " p.p."
+                st.metric("Churn Rate Anual no Cenário", format_rate(scenario_result['Churn Rate Anual (%)']), rate_delta, delta_color="inverse")
+            with col_band:
+                st.metric(
+                    f"Faixa P{scenario_band_percentiles[0]}-P{scenario_band_percentiles[-1]}",
+                    f"{format_rate(scenario_result[f'P{scenario_band_percentiles[0]} (%)'])} a {format_rate(scenario_result[f'P{scenario_band_percentiles[-1]} (%)'])}"
+                )
+            with col_target:
+                st.metric("Meta OTL Anualizada", format_rate(scenario_result['Meta OTL (%)']),
+                          help="OTL Churn do mês atual x 12, sobre a média mensal da base ativa.")
+            with col_probability:
+                st.metric("Chance de Atingir a Meta",
+                          f"{scenario_result['Prob. na Meta (%)']:.0f}%" if pd.notna(scenario_result['Prob. na Meta (%)']) else "N/A")
+
+            band_columns = [f"P{percentile} (%)" for percentile in scenario_band_percentiles]
+            fig_scenarios = px.line(
+                df_scenarios,
+                x='Aplicação do Cenário (%)',
+                y=['Churn Rate Anual (%)'] + [band_columns[0], band_columns[-1]],
+                labels={'value': 'Churn Rate Anual (%)', 'variable': ''}
+            )
+            fig_scenarios.update_traces(line=dict(dash='dot'), selector=lambda trace: trace.name in band_columns)
+            if pd.notna(scenario_result['Meta OTL (%)']):
+                fig_scenarios.add_hline(y=scenario_result['Meta OTL (%)'], line_dash='dash', line_color='red', annotation_text="Meta OTL")
+            fig_scenarios.update_layout(hovermode="x unified")
+            st.plotly_chart(fig_scenarios, use_container_width=True)
+            render_download_button("Baixar cenários", df_scenarios, "cenarios_churn", export_format, key="download_scenarios")
+        simulations_label = f"{scenario_simulations:,}".replace(",", ".")
+        st.caption(f"Cada redução é aplicada ao volume mensal do motivo e do tipo de churn em {scenario_year}, nos meses e tipos "
+                   f"selecionados. As faixas vêm de {simulations_label} simulações: 12 meses sorteados entre os observados e efeito realizado entre {100 - scenario_effect_spread * 100:.0f}% e "
+                   f"{100 + scenario_effect_spread * 100:.0f}% da redução planejada.")
+
+    with tab11:
+        otl_year = max(selected_years)
+        st.header(f"Metas OTL ({otl_year})")
+
+        # Realizado x meta já calculado para todas as métricas e segmentos; aqui só se escolhe o que exibir
+        df_otl_year = df_otl_tracking[df_otl_tracking['Ano'] == otl_year]
+        if df_otl_year.empty:
+            st.info(f"Nenhuma meta OTL para {otl_year} em '{otl_projections_file}'.")
+        else:
+            col_otl_metric, col_otl_segment = st.columns(2)
+            with col_otl_metric:
+                otl_metric = st.selectbox("Métrica", options=list(pd.unique(df_otl_year['Metrica'])), key="otl_metric")
+            df_otl_metric = df_otl_year[df_otl_year['Metrica'] == otl_metric]
+            with col_otl_segment:
+                otl_segment = st.selectbox("Segmento", options=list(pd.unique(df_otl_metric['Segmento'])), key="otl_segment")
+            df_otl_chart = df_otl_metric[df_otl_metric['Segmento'] == otl_segment]
+            is_flow_metric = otl_metric not in otl_stock_metrics
+
+            df_otl_done = df_otl_chart.dropna(subset=['Realizado'])
+            col_otl_target, col_otl_actual, col_otl_balance = st.columns(3)
+            if df_otl_done.empty:
+                col_otl_actual.metric("Realizado", "N/A", help="Sem realizado para o segmento (ex.: backlog, que não é aberto por tipo de cliente).")
+            else:
+                otl_last = df_otl_done.iloc[-1]
+                col_otl_target.metric(f"Meta ({otl_last['AnoMes']})", f"{otl_last['Meta']:,.0f}".replace(",", ".") if pd.notna(otl_last['Meta']) else "N/A")
+                col_otl_actual.metric(
+                    f"Realizado ({otl_last['AnoMes']})",
+                    f"{otl_last['Realizado']:,.0f}".replace(",", "."),
+                    f"{otl_last['Gap']:+,.0f}".replace(",", ".") + " vs meta" if pd.notna(otl_last['Gap']) else None,
+                    delta_color="inverse"
+                )
+                if is_flow_metric and pd.notna(otl_last['Saldo da Meta Anual']):
+                    col_otl_balance.metric(
+                        "Saldo da Meta Anual",
+                        f"{otl_last['Saldo da Meta Anual']:,.0f}".replace(",", "."),
+                        f"{otl_last['Saldo da Meta Anual'] - otl_last['Saldo Planejado']:+,.0f}".replace(",", ".") + " vs planejado",
+                        help="Meta do ano menos o realizado acumulado até o mês corrente."
                     )
-                ),
-                axis=1
+
+            fig_otl = px.line(
+                df_otl_chart.melt(id_vars=['AnoMes'], value_vars=['Meta', 'Realizado'], var_name='Série', value_name='Volume'),
+                x="AnoMes",
+                y="Volume",
+                color="Série",
+                markers=True,
+                labels={"AnoMes": "Mês", "Série": ""}
             )
-            
-            df_combined_franchises_display = df_combined_franchises.copy()
-            df_combined_franchises_display['Volume_2025'] = df_combined_franchises_display['Volume_2025'].astype(int)
-            df_combined_franchises_display['Volume_2024'] = df_combined_franchises_display['Volume_2024'].astype(int)
-            df_combined_franchises_display['Percentual_2025'] = df_combined_franchises_display['Percentual_2025'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
-            df_combined_franchises_display['Percentual_2024'] = df_combined_franchises_display['Percentual_2024'].map('{:.2f}%'.format).str.replace(".", ",") # Alteração aqui para formatar com vírgula
-            
-            df_combined_franchises_display['Variação 2025 vs 2024'] = df_combined_franchises_display['Variação 2025 vs 2024'].apply(
-                lambda x: f"{x:.2f}%".replace('.', ',') if pd.notna(x) and x != float('inf') else ("Nova Filial" if x == float('inf') else "0,00%")
+            fig_otl.update_layout(hovermode="x unified", xaxis=dict(type='category'))
+            st.plotly_chart(fig_otl, use_container_width=True)
+            if is_flow_metric and df_otl_chart['Saldo Planejado'].notna().any():
+                st.subheader("Queima da Meta Anual")
+                fig_otl_burndown = px.line(
+                    df_otl_chart.melt(id_vars=['AnoMes'], value_vars=['Saldo Planejado', 'Saldo da Meta Anual'], var_name='Série', value_name='Saldo'),
+                    x="AnoMes",
+                    y="Saldo",
+                    color="Série",
+                    markers=True,
+                    labels={"AnoMes": "Mês", "Série": ""}
+                )
+                fig_otl_burndown.update_layout(hovermode="x unified", xaxis=dict(type='category'))
+                st.plotly_chart(fig_otl_burndown, use_container_width=True)
+            st.dataframe(df_otl_chart.drop(columns=['Metrica', 'Segmento', 'Ano', 'Mes']), use_container_width=True, hide_index=True)
+            render_download_button("Baixar acompanhamento das metas", df_otl_year, "metas_otl", export_format, key="download_otl")
+        st.caption("Metas por mês, segmento e métrica do arquivo OTL (mês em branco vale para o mês corrente). O realizado "
+                   "de OTL Churn Operacional soma ao churn executado a variação do backlog sobre o mês anterior, por isso, "
+                   "como o OTL Backlog, só existe no segmento Geral. Eventos do dia entram na próxima carga completa.")
+
+    with tab12:
+        st.header("Churn por Diretoria, Regional e Filial")
+
+        if not hierarchy_rollups:
+            st.info(f"Para a análise por hierarquia, inclua na pasta do conjunto de dados o arquivo '{hierarchy_file}', "
+                    f"com as colunas {', '.join(hierarchy_levels)} (uma linha por Filial).")
+        else:
+            # Cada nível escolhido abre o nível de baixo; "Todas" para a descida ali
+            hierarchy_path = []
+            drill_level_cols = st.columns(len(hierarchy_levels) - 1)
+            for drill_col, level in zip(drill_level_cols, hierarchy_levels[:-1]):
+                level_choice = drill_col.selectbox(level, options=["Todas"] + hierarchy_children(hierarchy_rollups, hierarchy_path), key=f"hierarchy_{level}")
+                if level_choice == "Todas":
+                    break
+                hierarchy_path.append(level_choice)
+            st.markdown(f"**{' › '.join([hierarchy_national_label] + hierarchy_path)}**")
+
+            # Apenas seleção sobre o agregado pré-calculado do nível exibido
+            child_level, df_hierarchy_rows = select_hierarchy_rows(
+                hierarchy_rollups, hierarchy_path, selected_years, selected_months, selected_client_types, selected_churn_types
             )
-            
-            df_combined_franchises_display.rename(columns={
-                'Filial': 'Filial',
-                'Volume_2025': 'Volume 2025',
-                'Percentual_2025': '% 2025',
-                'Volume_2024': 'Volume 2024',
-                'Percentual_2024': '% 2024'
-            }, inplace=True)
-
-            df_combined_franchises_display = df_combined_franchises_display[[
-                'Filial', 'Volume 2025', '% 2025',
-                'Volume 2024', '% 2024', 'Variação 2025 vs 2024'
-            ]]
-
-            st.dataframe(df_combined_franchises_display, use_container_width=True, hide_index=True)
+            if df_hierarchy_rows.empty:
+                st.info("Nenhum churn neste nível da hierarquia com os filtros selecionados.")
+            else:
+                col_hierarchy_volume, col_hierarchy_children = st.columns(2)
+                col_hierarchy_volume.metric("Churn no Período", f"{df_hierarchy_rows['Volume'].sum():,.0f}".replace(",", "."))
+                col_hierarchy_children.metric(f"{child_level} com Churn", f"{df_hierarchy_rows[child_level].nunique():,.0f}".replace(",", "."))
+
+                df_hierarchy_monthly = df_hierarchy_rows.groupby(['Ano Churn', 'Mes Churn', child_level], as_index=False)['Volume'].sum()
+                df_hierarchy_monthly['AnoMes'] = (df_hierarchy_monthly['Ano Churn'].astype(str) + '-' +
+                                                  df_hierarchy_monthly['Mes Churn'].astype(str).str.zfill(2))
+                fig_hierarchy = px.bar(
+                    bucket_top_n(df_hierarchy_monthly, child_level, ['Volume'], top_n_default, group_columns=['AnoMes']),
+                    x="AnoMes",
+                    y="Volume",
+                    color=child_level,
+                    barmode="stack",
+                    labels={"AnoMes": "Mês", "Volume": "Volume de Churn", child_level: ""}
+                )
+                fig_hierarchy.update_layout(hovermode="x unified", xaxis=dict(type='category', categoryorder='category ascending'))
+                st.plotly_chart(fig_hierarchy, use_container_width=True)
+
+                df_hierarchy_table = compute_hierarchy_comparison_table(df_hierarchy_rows, child_level)
+                if not df_hierarchy_table.empty:
+                    render_category_table(df_hierarchy_table, child_level, f"Nova {child_level}", key="hierarchy_table")
+                    render_download_button("Baixar tabela", df_hierarchy_table, "churn_por_hierarquia", export_format, key="download_hierarchy")
+        df_hierarchy_unmapped = load_report.get('hierarchy_unmapped', pd.DataFrame())
+        if not df_hierarchy_unmapped.empty:
+            st.caption(f"{len(df_hierarchy_unmapped)} filial(is) fora de '{hierarchy_file}' aparecem em '{hierarchy_unmapped_label}': "
+                       f"{', '.join(df_hierarchy_unmapped['Filial'].head(10))}{' ...' if len(df_hierarchy_unmapped) > 10 else ''}.")
+        st.caption("Volumes mensais pré-calculados por Diretoria, Regional e Filial na carga do conjunto de dados; "
+                   "eventos do dia entram na próxima carga completa.")
+
+    with tab13:
+        if range_counts is None:
+            st.header("Churn no Período")
+            st.info("Nenhuma data de desinstalação disponível para a consulta por período.")
         else:
-            st.info("Nenhum dado de Filial encontrado para 2024 ou 2025 com os filtros selecionado.")
+            st.header(f"Churn de {range_start:%d/%m/%Y} a {range_end:%d/%m/%Y}")
+            range_dimension = st.selectbox("Segmentar por", options=list(daily_prefix_index['segments'].columns), key="date_range_dimension")
+            # Somas acumuladas já consultadas na barra lateral: aqui só se agrupam os segmentos
+            df_range_summary = summarize_date_range(daily_prefix_index, range_counts, range_segment_mask, range_dimension)
+            if df_range_summary.empty:
+                st.info("Nenhum churn no período com os filtros selecionados.")
+            else:
+                fig_range = px.bar(
+                    bucket_top_n(df_range_summary, range_dimension, ['Volume', 'Participação (%)'], top_n_default),
+                    x=range_dimension,
+                    y="Volume",
+                    text="Volume",
+                    labels={range_dimension: "", "Volume": "Volume de Churn"}
+                )
+                st.plotly_chart(fig_range, use_container_width=True)
+                render_paginated_table(df_range_summary, key="date_range_table")
+                render_download_button("Baixar tabela", df_range_summary, "churn_no_periodo", export_format, key="download_date_range")
+        st.caption("Período escolhido na barra lateral (Período Personalizado), com os filtros de Tipo de Cliente e Tipo de Churn; "
+                   "os filtros de ano e mês não se aplicam. Cada segmento sai de duas leituras das somas diárias acumuladas.")
 
     st.markdown("---")
     st.markdown("Desenvolvido com Streamlit, Pandas e Plotly. Dados atualizados até a última execução do script.")
 
+    # Pré-cálculo das seleções vizinhas enquanto o usuário lê a página
+    if prefetcher is not None:
+        prefetcher.submit(
+            results_version,
+            [neighbour for neighbour in neighbouring_selections(selection, filter_options) if selection_key(neighbour) not in kpi_snapshot],
+            lambda neighbour: compute_dashboard_results(df_churn, df_facts, neighbour, df_forecasts)
+        )
+
+    # Painel de administração (?admin=1)
+    cache_metrics.record_timing('pagina', time.perf_counter() - render_started)
+    if st.query_params.get("admin") == "1":
+        render_cache_admin_panel(cache_metrics, dataset_registry)
+
+def main():
+    """
+    Executa o painel e grava o arquivo de métricas para o coletor do Prometheus ao final de toda
+    execução, inclusive as interrompidas por st.stop() (filtros vazios, erros de carga).
+    """
+    cache_metrics = get_cache_metrics()
+    dataset_registry = get_dataset_registry()
+    try:
+        render_dashboard(cache_metrics, dataset_registry)
+    finally:
+        try:
+            cache_metrics.write_prometheus_file(metrics_file, dataset_registry.memory_budget_bytes)
+        except OSError as e:
+            print(f"Erro ao gravar o arquivo de métricas '{metrics_file}': {e}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Relatórios estáticos em HTML por Filial.
+
+Carrega e transforma os dados de churn uma única vez (load_and_transform_data) e gera, para
+cada Filial, um arquivo HTML autocontido com o gráfico de volume mensal, a distribuição por
+Tipo de Cliente e os principais motivos de cancelamento, usando os mesmos cálculos e gráficos
+do painel. Os relatórios são gerados em paralelo num pool de processos: cada processo recebe
+os dados carregados uma vez, na inicialização, e depois só o nome das filiais.
+
+Uso:
+    python gerar_relatorios_filiais.py [--dataset NOME] [--saida PASTA] [--processos N] [--filial NOME ...] [--plotlyjs inline|cdn]
+"""
+import argparse
+import html
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import dashboard_churn as dc
+
+reports_subdir = 'relatorios_filiais'
+top_reasons = 15
+
+# Estado de cada processo do pool, preenchido uma vez por init_worker
+_worker_state = {}
+
+report_template = """<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+<meta charset="utf-8">
+<title>Relatório de Churn - {filial}</title>
+<style>
+    body {{ font-family: Arial, sans-serif; margin: 24px; color: #333; }}
+    h1 {{ margin-bottom: 4px; }}
+    .subtitle {{ color: gray; margin-bottom: 24px; }}
+    .kpis {{ display: flex; gap: 16px; margin-bottom: 24px; }}
+    .kpi {{ border: 1px solid #e0e0e0; border-radius: 5px; padding: 10px 20px; text-align: center; }}
+    .kpi-title {{ font-size: 0.9em; color: gray; }}
+    .kpi-value {{ font-size: 1.8em; font-weight: bold; }}
+    .pies {{ display: flex; gap: 16px; }}
+    .pies > div {{ flex: 1; }}
+    table {{ border-collapse: collapse; width: 100%; }}
+    th, td {{ border: 1px solid #e0e0e0; padding: 6px 10px; text-align: left; }}
+    th {{ background: #f5f5f5; }}
+</style>
+</head>
+<body>
+<h1>📊 Relatório de Churn - {filial}</h1>
+<div class="subtitle">Gerado em {generated_at}</div>
+<div class="kpis">{kpis}</div>
+<h2>Churn Mensal por Ano e Variação</h2>
+{monthly_chart}
+<h2>Distribuição de Churn por Tipo de Cliente</h2>
+<div class="pies">{client_type_charts}</div>
+<h2>Principais Motivos de Cancelamento</h2>
+{reasons_table}
+</body>
+</html>
+"""
+
+
+def report_file_name(filial):
+    """Nome de arquivo seguro para a filial."""
+    return re.sub(r'[^\w-]+', '_', str(filial)).strip('_') + '.html'
+
+
+def init_worker(df_churn, rows_by_filial, selection, output_dir, plotlyjs):
+    """Guarda no processo os dados carregados uma única vez pelo processo principal."""
+    _worker_state.update(
+        df_churn=df_churn, rows_by_filial=rows_by_filial, selection=selection,
+        output_dir=output_dir, plotlyjs=plotlyjs
+    )
+
+
+def render_filial_report(filial):
+    """Gera o HTML de uma filial e devolve (filial, caminho, OS, segundos)."""
+    start = time.perf_counter()
+    state = _worker_state
+    selection = state['selection']
+    df_filial = state['df_churn'].iloc[state['rows_by_filial'][filial]]
+
+    df_plot_monthly, category_order = dc.compute_monthly_volume_chart(df_filial)
+    df_client_type_2024, df_client_type_2025, _ = dc.compute_client_type_comparison(df_filial, selection)
+    df_reasons = dc.compute_year_comparison_table(df_filial, 'Categoria4_Motivo', ['desconsiderar'], "Novo Motivo", 'Motivo de Cancelamento')
+
+    # Só o primeiro gráfico embute o plotly.js; os demais reutilizam o mesmo script
+    include_plotlyjs = [state['plotlyjs']]
+
+    def figure_html(fig):
+        fig_html = fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs[0])
+        include_plotlyjs[0] = False
+        return fig_html
+
+    volume_by_year = df_filial.groupby('Ano Churn')['Volume'].sum()
+    kpis = "".join(
+        f'<div class="kpi"><div class="kpi-title">Churn {int(year)}</div>'
+        f'<div class="kpi-value">{f"{int(volume):,.0f}".replace(",", ".")}</div></div>'
+        for year, volume in volume_by_year.items()
+    )
+
+    client_type_charts = ""
+    for year, df_client_type, legend_below in [(2024, df_client_type_2024, True), (2025, df_client_type_2025, False)]:
+        chart = (figure_html(dc.build_client_type_pie(df_client_type, legend_below=legend_below)) if not df_client_type.empty
+                 else f"<p>Nenhum dado de churn para {year}.</p>")
+        client_type_charts += f"<div><h3 style='text-align: center;'>Consolidado {year}</h3>{chart}</div>"
+
+    if df_reasons.empty:
+        reasons_table = "<p>Nenhum motivo de cancelamento registrado.</p>"
+    else:
+        df_reasons = df_reasons.sort_values(['Volume 2025', 'Volume 2024'], ascending=False).head(top_reasons)
+        reasons_table = df_reasons.to_html(index=False, escape=True, border=0)
+
+    report = report_template.format(
+        filial=html.escape(str(filial)),
+        generated_at=datetime.now().strftime('%d/%m/%Y %H:%M'),
+        kpis=kpis,
+        monthly_chart=figure_html(dc.build_monthly_volume_figure(df_plot_monthly, category_order)),
+        client_type_charts=client_type_charts,
+        reasons_table=reasons_table
+    )
+
+    output_path = os.path.join(state['output_dir'], report_file_name(filial))
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(report)
+    return filial, output_path, int(df_filial['Volume'].sum()), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera um relatório HTML autocontido de churn para cada Filial.")
+    parser.add_argument('--dataset', default=None, help="Nome do conjunto de dados no catálogo (padrão: o primeiro).")
+    parser.add_argument('--saida', default=None, help=f"Pasta dos relatórios (padrão: '{reports_subdir}' dentro da pasta do conjunto).")
+    parser.add_argument('--processos', type=int, default=os.cpu_count(), help="Processos em paralelo.")
+    parser.add_argument('--filial', action='append', default=None, help="Gera apenas estas filiais (repetível).")
+    parser.add_argument('--plotlyjs', choices=['inline', 'cdn'], default='inline',
+                        help="'inline' embute o plotly.js em cada arquivo (funciona offline); 'cdn' gera arquivos menores.")
+    args = parser.parse_args()
+
+    catalog = dc.load_dataset_catalog(dc.datasets_config_file)
+    dataset_name = args.dataset or next(iter(catalog))
+    if dataset_name not in catalog:
+        raise SystemExit(f"Conjunto de dados '{dataset_name}' não encontrado. Disponíveis: {', '.join(catalog)}.")
+    data_folder = catalog[dataset_name]
+    output_dir = args.saida or os.path.join(data_folder, reports_subdir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    df_churn, _, _, _ = dc.load_and_transform_data(data_folder, dc.file_2024, dc.file_2025, dc.file_active_base, dc.file_backlog_churn)
+    if df_churn.empty or 'Filial' not in df_churn.columns:
+        raise SystemExit("Dados de CHURN vazios ou sem a coluna Filial: nada a gerar.")
+
+    filter_options = dc.get_filter_options(df_churn)
+    selection = dc.build_selection(
+        filter_options, filter_options['years'], filter_options['months'],
+        filter_options['client_types'], filter_options['churn_types']
+    )
+    rows_by_filial = df_churn.groupby('Filial', sort=True).indices
+    filiais = list(rows_by_filial)
+    if args.filial:
+        missing = sorted(set(args.filial) - set(filiais))
+        if missing:
+            raise SystemExit(f"Filiais sem dados: {', '.join(missing)}.")
+        filiais = [filial for filial in filiais if filial in args.filial]
+    print(f"Dados carregados em {time.perf_counter() - start:.1f}s: {len(filiais)} filiais.")
+
+    failures = 0
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(args.processos, len(filiais))),
+        initializer=init_worker,
+        initargs=(df_churn, rows_by_filial, selection, output_dir, args.plotlyjs)
+    ) as executor:
+        futures = {executor.submit(render_filial_report, filial): filial for filial in filiais}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                filial, output_path, volume, seconds = future.result()
+                print(f"[{done}/{len(filiais)}] {filial}: {volume} OS, {seconds:.1f}s -> {output_path}")
+            except Exception as e:
+                failures += 1
+                print(f"[{done}/{len(filiais)}] Erro ao gerar o relatório da filial {futures[future]}: {e}")
+
+    print(f"{len(filiais) - failures} relatórios gerados em '{output_dir}' em {time.perf_counter() - start:.1f}s.")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
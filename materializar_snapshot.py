@@ -0,0 +1,112 @@
+"""
+Job de materialização do snapshot de KPIs do Dashboard de Churn.
+
+Calcula, para um conjunto configurável de combinações de filtros, os KPIs, os agregados dos
+gráficos e as tabelas de motivos e filiais (compute_dashboard_results) e grava tudo em um
+arquivo compacto. O painel usa o snapshot sempre que a seleção atual estiver coberta e
+calcula ao vivo apenas os filtros fora dele.
+
+Uso:
+    python materializar_snapshot.py [--dataset NOME] [--combinacoes combinacoes.json]
+
+O arquivo de combinações é uma lista JSON de objetos com as chaves "anos", "meses",
+"tipos_cliente" e "tipos_churn", cada uma com "Todos" ou uma lista de valores, por exemplo:
+    [{"anos": "Todos", "meses": ["Janeiro"], "tipos_cliente": "Todos", "tipos_churn": "Todos"}]
+Sem arquivo, materializa a visão "Todos", cada ano e cada mês isoladamente.
+"""
+import argparse
+import json
+import os
+import time
+
+import pandas as pd
+
+import dashboard_churn as dc
+
+
+def expand_filter(value, options):
+    """Converte "Todos" (ou ausência) na lista completa de opções do filtro."""
+    if value is None or value == "Todos":
+        return list(options)
+    return list(value)
+
+
+def default_combinations(filter_options):
+    """Visão "Todos", cada ano isolado e cada mês isolado (em todos os anos)."""
+    combinations = [{}]
+    combinations += [{'anos': [int(year)]} for year in filter_options['years']]
+    combinations += [{'meses': [month]} for month in filter_options['months']]
+    return combinations
+
+
+def build_snapshot(df_churn, df_facts, df_forecasts, combinations):
+    """
+    Resultados de compute_dashboard_results para cada combinação de filtros, indexados pela
+    mesma chave que o painel procura no snapshot (selection_key da seleção equivalente).
+    """
+    filter_options = dc.get_filter_options(df_churn)
+    results = {}
+    for combination in combinations:
+        selection = dc.build_selection(
+            filter_options,
+            [int(year) for year in expand_filter(combination.get('anos'), filter_options['years'])],
+            expand_filter(combination.get('meses'), filter_options['months']),
+            expand_filter(combination.get('tipos_cliente'), filter_options['client_types']),
+            expand_filter(combination.get('tipos_churn'), filter_options['churn_types'])
+        )
+        results[dc.selection_key(selection)] = dc.compute_dashboard_results(df_churn, df_facts, selection, df_forecasts)
+    return results
+
+
+def write_snapshot(snapshot_path, dataset_version, results):
+    """Grava o snapshot no formato lido por load_kpi_snapshot (arquivo temporário + troca atômica)."""
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    temp_path = f"{snapshot_path}.tmp"
+    pd.to_pickle({'dataset_version': dataset_version, 'format': dc.snapshot_format_version, 'results': results}, temp_path, compression='gzip')
+    os.replace(temp_path, snapshot_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Materializa o snapshot de KPIs do Dashboard de Churn.")
+    parser.add_argument('--dataset', default=None, help="Nome do conjunto de dados no catálogo (padrão: o primeiro).")
+    parser.add_argument('--combinacoes', default=None, help="Arquivo JSON com as combinações de filtros a materializar.")
+    args = parser.parse_args()
+
+    catalog = dc.load_dataset_catalog(dc.datasets_config_file)
+    dataset_name = args.dataset or next(iter(catalog))
+    if dataset_name not in catalog:
+        raise SystemExit(f"Conjunto de dados '{dataset_name}' não encontrado. Disponíveis: {', '.join(catalog)}.")
+    data_folder = catalog[dataset_name]
+
+    start = time.perf_counter()
+    dataset_version = dc.get_dataset_version(data_folder, dc.dataset_version_files)
+    df_churn, df_active_raw, df_backlog_raw, _ = dc.load_and_transform_data(
+        data_folder, dc.file_2024, dc.file_2025, dc.file_active_base, dc.file_backlog_churn
+    )
+    if df_churn.empty:
+        raise SystemExit("Dados de CHURN vazios: nada a materializar.")
+    df_forecasts = dc.fit_churn_forecasts(df_churn, dataset_version)
+    try:
+        df_otl_targets = dc.load_otl_targets(os.path.join(data_folder, dc.otl_projections_file), dataset_version)
+    except ValueError as e:
+        raise SystemExit(f"Metas OTL fora do formato esperado em '{dc.otl_projections_file}': {e}")
+    current_year_month = pd.Period(df_churn['AnoMes'].max(), freq='M')
+    otl_projections = dc.current_otl_projections(df_otl_targets, current_year_month.year, current_year_month.month)
+    df_facts = dc.assemble_monthly_fact_table(df_churn, df_active_raw, df_backlog_raw, otl_projections)
+
+    if args.combinacoes:
+        with open(args.combinacoes, encoding='utf-8') as f:
+            combinations = json.load(f)
+    else:
+        combinations = default_combinations(dc.get_filter_options(df_churn))
+
+    results = build_snapshot(df_churn, df_facts, df_forecasts, combinations)
+    snapshot_path = os.path.join(data_folder, dc.dataset_cache_subdir, dc.snapshot_file)
+    write_snapshot(snapshot_path, dataset_version, results)
+
+    print(f"Snapshot do conjunto '{dataset_name}' (versão {dataset_version}) gravado em '{snapshot_path}': "
+          f"{len(results)} combinações, {os.path.getsize(snapshot_path) / 1024:.0f} KB, {time.perf_counter() - start:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+Teste de carga do Dashboard de Churn com várias sessões simultâneas.
+
+Abre N sessões do painel no mesmo processo, cada uma com o seu AppTest do Streamlit (os caches
+st.cache_data/st.cache_resource são do processo, compartilhados entre as sessões como num
+servidor). Cada sessão segue um roteiro de trocas de filtro sorteado (anos, meses, tipos de
+cliente e de churn, segmento do Churn LTM e redução do simulador), com uma pausa de leitura entre
+as ações. Ao final informa a latência de cada nova execução do script (p50/p95/p99, no geral e
+por ação), a vazão em execuções por segundo e o pico de memória residente (RSS) do processo.
+Termina com código 1 se alguma execução gerar exceção ou se o p95 passar de --p95-max.
+
+Uso:
+    python verificar_carga.py [--sessoes 30] [--acoes 20] [--pausa 0.5] [--seed 0] [--p95-max SEGUNDOS]
+"""
+import argparse
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+
+app_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'dashboard_churn.py'))
+latency_percentiles = [50, 95, 99]
+
+# Ações do roteiro e o peso de cada uma: a maior parte das interações é nos filtros da barra lateral
+action_weights = {
+    'anos': 0.2,
+    'meses': 0.3,
+    'tipos_cliente': 0.2,
+    'tipos_churn': 0.2,
+    'segmento_ltm': 0.05,
+    'cenario': 0.05
+}
+filter_labels = {
+    'anos': "Selecione o(s) Ano(s)",
+    'meses': "Selecione o(s) Mês(es)",
+    'tipos_cliente': "Selecione o(s) Tipo(s) de Cliente",
+    'tipos_churn': "Selecione o(s) Tipo(s) de Churn"
+}
+
+
+# --- Sessões simultâneas no mesmo processo ---
+def prepare_concurrent_sessions():
+    """
+    Ajusta o AppTest para várias sessões simultâneas, como num servidor. O AppTest instala um
+    Runtime simulado no início de cada execução e o remove ao final (Runtime._instance = None),
+    o que derruba as execuções em andamento nas outras sessões: a última instância instalada
+    continua valendo até outra execução instalar a sua.
+    """
+    last_instance = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_instance[:] = [cls._instance]
+            return cls._instance
+        if last_instance:
+            return last_instance[0]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    Runtime.instance = classmethod(instance)
+
+    # O AppTest compila o script num ScriptCache novo a cada execução; o servidor usa um só.
+    # Compilar em várias threads ao mesmo tempo também esbarra em ast.parse, que não é seguro
+    # entre threads no Python 3.11.
+    shared_script_cache = ScriptCache()
+    get_bytecode = ScriptCache.get_bytecode
+    ScriptCache.get_bytecode = lambda self, script_path: get_bytecode(shared_script_cache, script_path)
+
+
+# --- Memória ---
+def current_rss_bytes():
+    """Memória residente atual do processo (Linux: /proc/self/statm)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def peak_rss_bytes():
+    """Pico de memória residente do processo desde o início (ru_maxrss, em KB no Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# --- Roteiro de uma sessão ---
+def find_widget(widgets, label=None, key=None):
+    """Widget do AppTest pelo rótulo ou pela chave (None se não estiver na página)."""
+    for widget in widgets:
+        if (label is not None and widget.label == label) or (key is not None and widget.key == key):
+            return widget
+    return None
+
+
+def pick_filter_values(rng, options):
+    """Sorteia "Todos" ou um subconjunto não vazio das opções (meses em sequência, como um analista escolhe)."""
+    values = [option for option in options if option != "Todos"]
+    if not values or rng.random() < 0.3:
+        return ["Todos"]
+    size = int(rng.integers(1, len(values) + 1))
+    start = int(rng.integers(0, len(values) - size + 1))
+    return values[start:start + size]
+
+
+def apply_action(at, action, rng):
+    """Aplica a ação na sessão; devolve False se o widget não estiver na página nesta execução."""
+    if action in filter_labels:
+        widget = find_widget(at.sidebar.multiselect, label=filter_labels[action])
+        if widget is None:
+            return False
+        widget.set_value(pick_filter_values(rng, widget.options))
+    elif action == 'segmento_ltm':
+        widget = find_widget(at.selectbox, key="ltm_dimension")
+        if widget is None:
+            return False
+        widget.set_value(widget.options[int(rng.integers(0, len(widget.options)))])
+    elif action == 'cenario':
+        widget = find_widget(at.slider, key="scenario_reason_cut")
+        if widget is None:
+            return False
+        widget.set_value(int(rng.integers(0, 21)) * 5)
+    return True
+
+
+def run_session(session_id, args, start_barrier):
+    """Executa o roteiro de uma sessão e devolve [(ação, segundos, exceções)]."""
+    rng = np.random.default_rng([args.seed, session_id])
+    actions = list(action_weights)
+    weights = np.array(list(action_weights.values()))
+    samples = []
+
+    at = AppTest.from_file(app_path, default_timeout=args.timeout)
+    start_barrier.wait()
+    start = time.perf_counter()
+    at.run()
+    samples.append(('abertura', time.perf_counter() - start, len(at.exception)))
+
+    for _ in range(args.acoes):
+        time.sleep(rng.exponential(args.pausa) if args.pausa > 0 else 0)
+        action = actions[int(rng.choice(len(actions), p=weights / weights.sum()))]
+        if not apply_action(at, action, rng):
+            continue
+        start = time.perf_counter()
+        at.run()
+        samples.append((action, time.perf_counter() - start, len(at.exception)))
+        if at.exception:
+            # Uma exceção interrompe a página: recomeça a sessão com os filtros padrão
+            at = AppTest.from_file(app_path, default_timeout=args.timeout)
+            at.run()
+    return samples
+
+
+# --- Relatório ---
+def format_percentiles(latencies):
+    values = np.percentile(latencies, latency_percentiles)
+    return "  ".join(f"p{percentile} {1000 * value:8.1f} ms" for percentile, value in zip(latency_percentiles, values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do painel com sessões simultâneas.")
+    parser.add_argument('--sessoes', type=int, default=30, help="Sessões simultâneas.")
+    parser.add_argument('--acoes', type=int, default=20, help="Trocas de filtro por sessão.")
+    parser.add_argument('--pausa', type=float, default=0.5, help="Pausa média de leitura entre ações, em segundos (exponencial).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help="Tempo máximo de uma execução do script, em segundos.")
+    parser.add_argument('--p95-max', type=float, default=None, help="Falha se o p95 das execuções passar deste valor, em segundos.")
+    args = parser.parse_args()
+    # Os avisos do Streamlit a cada execução (uma por sessão e ação) encobririam o relatório. O
+    # AppTest redefine o nível dos loggers a cada execução, por isso um filtro em vez do nível.
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith('streamlit'):
+            logging.getLogger(name).addFilter(lambda record: record.levelno >= logging.ERROR)
+
+    prepare_concurrent_sessions()
+
+    baseline_rss = current_rss_bytes()
+    rss_samples = [baseline_rss]
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(0.2):
+            rss_samples.append(current_rss_bytes())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+
+    start_barrier = threading.Barrier(args.sessoes)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessoes) as executor:
+        futures = [executor.submit(run_session, session_id, args, start_barrier) for session_id in range(args.sessoes)]
+        session_samples = [future.result() for future in futures]
+    wall_seconds = time.perf_counter() - start
+    stop_sampling.set()
+    sampler.join()
+
+    samples = [sample for session in session_samples for sample in session]
+    latencies = np.array([seconds for _, seconds, _ in samples])
+    exceptions = sum(count for _, _, count in samples)
+
+    print(f"{args.sessoes} sessões, {len(samples)} execuções do script em {wall_seconds:.1f}s "
+          f"({len(samples) / wall_seconds:.2f} execuções/s).")
+    print(f"  {'geral':<14} n={len(latencies):<5} {format_percentiles(latencies)}")
+    for action in ['abertura'] + list(action_weights):
+        action_latencies = [seconds for name, seconds, _ in samples if name == action]
+        if action_latencies:
+            print(f"  {action:<14} n={len(action_latencies):<5} {format_percentiles(action_latencies)}")
+    print(f"Memória residente: {baseline_rss / 2**20:.0f} MB no início, pico de "
+          f"{max(max(rss_samples), peak_rss_bytes()) / 2**20:.0f} MB.")
+
+    failures = []
+    if exceptions:
+        failures.append(f"{exceptions} exceções durante as execuções")
+    p95 = float(np.percentile(latencies, 95))
+    if args.p95_max is not None and p95 > args.p95_max:
+        failures.append(f"p95 de {p95:.3f}s acima do limite de {args.p95_max:.3f}s")
+    if failures:
+        for failure in failures:
+            print(f"[FALHA] {failure}")
+        sys.exit(1)
+    print("Carga dentro do esperado.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Verificação dos downloads do Dashboard de Churn (CSV, Parquet e XLSX).
+
+Para cada formato de export_formats, gera o arquivo de um DataFrame sintético (mais de um lote
+de export_chunk_rows, com texto, números, datas, valores ausentes e uma coluna toda vazia) e de
+um DataFrame vazio, pelo mesmo caminho do botão de download: build_export_data seguido da
+conversão que o st.download_button aplica ao retorno da função de dados. Em seguida lê o arquivo
+de volta e confere linhas e colunas. Termina com código 1 se algum formato falhar.
+
+Uso:
+    python verificar_exportacao.py [--linhas 60000] [--seed 0]
+"""
+import argparse
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+import dashboard_churn as dc
+
+
+def make_export_frame(rng, n_rows):
+    """DataFrame com os tipos de coluna que aparecem nas tabelas e OS exportadas pelo painel."""
+    df = pd.DataFrame({
+        'Numos': np.arange(n_rows),
+        'Filial': rng.choice(['FRQ_ECO_SP_SANTOS', 'FRQ_ECO_RJ_OESTE', 'Açaí; "Filial"'], n_rows),
+        'Volume': rng.integers(0, 5, n_rows),
+        'Churn Rate (%)': rng.random(n_rows) * 10,
+        'Data de Desinstalacao': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D'),
+        'Sem Valor': None
+    })
+    df.loc[df.index % 7 == 0, 'Churn Rate (%)'] = np.nan
+    return df
+
+
+def read_export(data, export_format):
+    if export_format == 'CSV':
+        return pd.read_csv(io.BytesIO(data), sep=';', decimal=',', encoding='utf-8-sig')
+    if export_format == 'Parquet':
+        return pd.read_parquet(io.BytesIO(data))
+    # XLSX: uma aba por bloco de xlsx_max_rows_per_sheet linhas
+    return pd.concat(pd.read_excel(io.BytesIO(data), sheet_name=None).values(), ignore_index=True)
+
+
+def check_format(df, export_format):
+    """Problemas encontrados na exportação do DataFrame no formato (lista vazia se estiver certo)."""
+    try:
+        data, _ = convert_data_to_bytes_and_infer_mime(
+            dc.build_export_data(lambda: df, export_format),
+            TypeError("Callable returned unsupported type")
+        )
+    except Exception as e:
+        return [f"falha ao gerar o arquivo: {type(e).__name__}: {e}"]
+
+    df_read = read_export(data, export_format)
+    problems = []
+    if list(df_read.columns) != [str(column) for column in df.columns]:
+        problems.append(f"colunas {list(df_read.columns)} em vez de {list(df.columns)}")
+    if len(df_read) != len(df):
+        problems.append(f"{len(df_read)} linhas em vez de {len(df)}")
+    elif len(df) and not np.array_equal(df_read['Numos'].to_numpy(), df['Numos'].to_numpy()):
+        problems.append("linhas fora de ordem ou alteradas")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confere os arquivos de download do painel em todos os formatos.")
+    parser.add_argument('--linhas', type=int, default=60_000, help="Linhas do DataFrame sintético.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    frames = {'sintético': make_export_frame(rng, args.linhas), 'vazio': make_export_frame(rng, 0)}
+
+    failures = []
+    for export_format in dc.export_formats:
+        for frame_name, df in frames.items():
+            problems = check_format(df, export_format)
+            status = "ok" if not problems else "; ".join(problems)
+            print(f"  {export_format:<8} {frame_name:<10} {len(df):>8} linhas  {status}")
+            failures += [f"{export_format} ({frame_name}): {problem}" for problem in problems]
+
+    if failures:
+        for failure in failures:
+            print(f"[FALHA] {failure}")
+        sys.exit(1)
+    print("Todos os formatos de exportação estão corretos.")
+
+
+if __name__ == "__main__":
+    main()
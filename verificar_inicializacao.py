@@ -0,0 +1,88 @@
+"""
+Verificação do tempo de inicialização do Dashboard de Churn.
+
+Mede, em processos Python novos (a frio):
+  - o tempo de importação de dashboard_churn, conferindo que os módulos de deferred_modules
+    (plotly.express, openpyxl) não são importados junto;
+  - o tempo até a primeira renderização completa da página, executando o app com o AppTest
+    do Streamlit.
+Termina com código 1 se algum orçamento (import_time_budget_seconds,
+first_render_budget_seconds, ou os valores passados na linha de comando) for ultrapassado.
+
+Uso:
+    python verificar_inicializacao.py [--repeticoes 3] [--orcamento-import 2.0] [--orcamento-render 60] [--sem-render]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import dashboard_churn as dc
+
+app_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'dashboard_churn.py'))
+
+import_probe = """
+import json, sys, time
+start = time.perf_counter()
+import dashboard_churn
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+"""
+
+render_probe = """
+import json, time
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file(%r, default_timeout=600)
+at.run()
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'exceptions': [e.value for e in at.exception]}))
+"""
+
+
+def run_probe(code):
+    """Executa o código num interpretador novo e devolve o JSON da última linha da saída."""
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=os.path.dirname(app_path))
+    if completed.returncode != 0:
+        raise SystemExit(f"Falha ao medir a inicialização:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confere o tempo de importação e de primeira renderização do painel.")
+    parser.add_argument('--repeticoes', type=int, default=3, help="Medições de importação (vale a mediana).")
+    parser.add_argument('--orcamento-import', type=float, default=dc.import_time_budget_seconds)
+    parser.add_argument('--orcamento-render', type=float, default=dc.first_render_budget_seconds)
+    parser.add_argument('--sem-render', action='store_true', help="Mede apenas a importação.")
+    args = parser.parse_args()
+
+    failures = []
+
+    import_runs = [run_probe(import_probe % (dc.deferred_modules,)) for _ in range(args.repeticoes)]
+    import_seconds = statistics.median(run['seconds'] for run in import_runs)
+    eager_modules = sorted({module for run in import_runs for module in run['loaded']})
+    print(f"Importação de dashboard_churn: {import_seconds:.3f}s (mediana de {len(import_runs)}, orçamento {args.orcamento_import:.3f}s)")
+    if import_seconds > args.orcamento_import:
+        failures.append(f"importação levou {import_seconds:.3f}s, acima do orçamento de {args.orcamento_import:.3f}s")
+    if eager_modules:
+        failures.append(f"módulos que deveriam ser importados sob demanda foram carregados na importação: {', '.join(eager_modules)}")
+
+    if not args.sem_render:
+        render_run = run_probe(render_probe % (app_path,))
+        print(f"Primeira renderização: {render_run['seconds']:.3f}s (orçamento {args.orcamento_render:.3f}s)")
+        if render_run['exceptions']:
+            failures.append(f"a renderização gerou exceções: {render_run['exceptions']}")
+        if render_run['seconds'] > args.orcamento_render:
+            failures.append(f"primeira renderização levou {render_run['seconds']:.3f}s, acima do orçamento de {args.orcamento_render:.3f}s")
+
+    if failures:
+        for failure in failures:
+            print(f"[FALHA] {failure}")
+        sys.exit(1)
+    print("Inicialização dentro do orçamento.")
+
+
+if __name__ == "__main__":
+    main()
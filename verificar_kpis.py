@@ -0,0 +1,266 @@
+"""
+Verificação diferencial dos KPIs do Dashboard de Churn.
+
+Roda a implementação de referência (compute_dashboard_results, a mesma lógica que o main()
+exibe) e um ou mais motores alternativos sobre conjuntos de dados sintéticos e combinações de
+filtros sorteadas, compara todos os resultados (KPIs de projeção, churn rate, média da base
+ativa, variação YoY, churn operacional, agregados dos gráficos e tabelas de motivos/filiais)
+e mede o tempo de cada motor. Termina com código 1 se algum resultado divergir.
+
+Uso:
+    python verificar_kpis.py [--motor NOME ...] [--datasets 5] [--selecoes 40] [--seed 0] [--dados-reais]
+
+Um motor é uma função prepare(df_churn, df_active, df_backlog, df_forecasts) que devolve uma
+função selection -> resultados. Além dos motores em ENGINES, é possível passar "modulo:funcao".
+"""
+import argparse
+import importlib
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import dashboard_churn as dc
+import materializar_snapshot
+
+
+# --- Motores ---
+def reference_engine(df_churn, df_active, df_backlog, df_forecasts):
+    """Lógica atual do painel, calculada ao vivo."""
+    df_facts = dc.assemble_monthly_fact_table(df_churn, df_active, df_backlog)
+    return lambda selection: dc.compute_dashboard_results(df_churn, df_facts, selection, df_forecasts)
+
+
+def snapshot_engine(df_churn, df_active, df_backlog, df_forecasts):
+    """
+    Resultados servidos pelo snapshot materializado, pelo mesmo caminho do painel: o job
+    (materializar_snapshot.build_snapshot/write_snapshot) grava a combinação de filtros da seleção
+    numa pasta temporária, load_kpi_snapshot lê o arquivo e a busca usa selection_key. Seleção
+    ausente do snapshot conta como divergência, sem cálculo ao vivo.
+    """
+    df_facts = dc.assemble_monthly_fact_table(df_churn, df_active, df_backlog)
+    dataset_version = f"verificacao-{id(df_churn)}"
+    snapshot_folder = tempfile.TemporaryDirectory(prefix='verificar_kpis_')
+
+    def compute(selection):
+        combination = {
+            'anos': selection['years'], 'meses': selection['months'],
+            'tipos_cliente': selection['client_types'], 'tipos_churn': selection['churn_types']
+        }
+        # Um arquivo por seleção: caminhos distintos não colidem no cache de load_kpi_snapshot
+        snapshot_path = os.path.join(snapshot_folder.name, f"{len(os.listdir(snapshot_folder.name))}_{dc.snapshot_file}")
+        results = materializar_snapshot.build_snapshot(df_churn, df_facts, df_forecasts, [combination])
+        materializar_snapshot.write_snapshot(snapshot_path, dataset_version, results)
+        kpi_snapshot = dc.load_kpi_snapshot(snapshot_path, dataset_version, os.stat(snapshot_path).st_mtime_ns)
+        return kpi_snapshot.get(dc.selection_key(selection), {})
+    return compute
+
+
+def incremental_engine(df_churn, df_active, df_backlog, df_forecasts):
+    """Grafo de dependências com memória entre seleções, como numa sessão do painel."""
+    memo = {}
+    df_facts = dc.assemble_monthly_fact_table(df_churn, df_active, df_backlog)
+    dataset_version = f"verificacao-{id(df_churn)}"
+    return lambda selection: dc.compute_dashboard_results_incremental(
+        df_churn, df_facts, selection, df_forecasts, dataset_version, memo
+    )
+
+
+ENGINES = {
+    'referencia': reference_engine,
+    'snapshot': snapshot_engine,
+    'incremental': incremental_engine
+}
+
+
+def resolve_engine(name):
+    """Motor pelo nome em ENGINES ou pelo caminho "modulo:funcao"."""
+    if name in ENGINES:
+        return ENGINES[name]
+    module_name, _, function_name = name.partition(':')
+    if not function_name:
+        raise SystemExit(f"Motor '{name}' desconhecido. Disponíveis: {', '.join(ENGINES)} ou 'modulo:funcao'.")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+# --- Dados sintéticos ---
+def make_synthetic_dataset(rng, n_rows):
+    """
+    Gera df_churn, df_active e df_backlog já no formato de load_and_transform_data, com casos
+    de borda: meses faltando, anos sem alguns tipos, motivos vazios/'nan'/'Desconsiderar' e
+    filiais ausentes.
+    """
+    years = np.array([2024, 2025])
+    last_month_2025 = int(rng.integers(1, 13))
+    year = rng.choice(years, size=n_rows, p=[0.6, 0.4])
+    month = np.where(year == 2025, rng.integers(1, last_month_2025 + 1, size=n_rows), rng.integers(1, 13, size=n_rows))
+    # Remove um mês inteiro de vez em quando para exercitar as lacunas
+    if rng.random() < 0.3:
+        keep = ~((year == 2024) & (month == int(rng.integers(1, 13))))
+        year, month = year[keep], month[keep]
+    n_rows = len(year)
+
+    day = rng.integers(1, 29, size=n_rows)
+    uninstall = pd.to_datetime({'year': year, 'month': month, 'day': day})
+    created = uninstall - pd.to_timedelta(rng.integers(-5, 200, size=n_rows), unit='D')
+
+    client_types = np.array(['PF', 'PME', 'Corporativo', 'Outros'])
+    churn_types = np.array(['Voluntário', 'Involuntário', 'Baixa de Ativo'])
+    reasons = np.array(['PRECO', 'MUDANCA', 'CONCORRENCIA', 'nan', '', 'Desconsiderar', 'INADIMPLENCIA'])
+    filiais = np.array([f'FILIAL_{i:02d}' for i in range(int(rng.integers(3, 25)))] + ['nan'])
+
+    df_churn = pd.DataFrame({
+        'Data de Criacao da OS': created,
+        'Data de Desinstalacao': uninstall,
+        'Status da OS': 'Concluído',
+        'Tipo de Churn': rng.choice(churn_types, size=n_rows, p=[0.55, 0.35, 0.10]),
+        'Filial': rng.choice(filiais, size=n_rows),
+        'Categoria4_Motivo': rng.choice(reasons, size=n_rows),
+        'Tipo de Cliente': rng.choice(client_types, size=n_rows, p=[0.6, 0.2, 0.18, 0.02]),
+        'Ano Churn': year.astype(int),
+        'Mes Churn': month.astype(int),
+    })
+    df_churn['Nome Mes Churn'] = df_churn['Mes Churn'].map(lambda m: dc.month_order_num_pt[m - 1])
+    df_churn['Volume'] = 1
+    df_churn['AnoMes'] = df_churn['Data de Desinstalacao'].dt.to_period('M').astype(str)
+
+    active_rows = []
+    for active_month in range(1, last_month_2025 + 1):
+        for client_type in ['PF', 'PME', 'Corporativo']:
+            if rng.random() < 0.95:
+                active_rows.append({
+                    'Data Base Ativa': pd.Timestamp(2025, active_month, 1),
+                    'Volume Base Ativa': int(rng.integers(5_000, 60_000)),
+                    'Ano Base Ativa': 2025,
+                    'Mes Base Ativa': active_month,
+                    'Nome Mes Ativa': dc.month_order_num_pt[active_month - 1],
+                    'Tipo de Cliente Base Ativa': client_type
+                })
+    df_active = pd.DataFrame(active_rows)
+
+    backlog_rows = [{'Ano Backlog': 2024, 'Mes Backlog': 12, 'Nome Mes Backlog': 'Dezembro', 'Volume Backlog': int(rng.integers(500, 2_000))}]
+    backlog_rows += [
+        {'Ano Backlog': 2025, 'Mes Backlog': m, 'Nome Mes Backlog': dc.month_order_num_pt[m - 1], 'Volume Backlog': int(rng.integers(500, 2_000))}
+        for m in range(1, last_month_2025 + 1)
+    ]
+    df_backlog = pd.DataFrame(backlog_rows)
+    return df_churn, df_active, df_backlog
+
+
+def random_selection(rng, filter_options):
+    """Sorteia uma seleção de filtros, com chance de "Todos" em cada filtro."""
+    def pick(options, p_all=0.5):
+        options = list(options)
+        if not options or rng.random() < p_all:
+            return options
+        size = int(rng.integers(1, len(options) + 1))
+        return [options[i] for i in sorted(rng.choice(len(options), size=size, replace=False))]
+
+    return dc.build_selection(
+        filter_options,
+        pick(filter_options['years']),
+        pick(filter_options['months'], p_all=0.4),
+        pick(filter_options['client_types']),
+        pick(filter_options['churn_types'])
+    )
+
+
+# --- Comparação ---
+def compare_values(reference, candidate, path="resultado"):
+    """Lista de divergências entre dois resultados (dicionários, DataFrames ou escalares)."""
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        differences = []
+        for key in sorted(set(reference) | set(candidate), key=str):
+            if key not in reference or key not in candidate:
+                differences.append(f"{path}.{key}: presente em apenas um dos motores")
+            else:
+                differences += compare_values(reference[key], candidate[key], f"{path}.{key}")
+        return differences
+    if isinstance(reference, pd.DataFrame) or isinstance(candidate, pd.DataFrame):
+        try:
+            pd.testing.assert_frame_equal(reference.reset_index(drop=True), candidate.reset_index(drop=True), check_dtype=False, check_exact=False, rtol=1e-9)
+        except (AssertionError, AttributeError) as e:
+            return [f"{path}: {str(e).splitlines()[0]}"]
+        return []
+    if isinstance(reference, (list, tuple)) and isinstance(candidate, (list, tuple)):
+        if len(reference) != len(candidate):
+            return [f"{path}: tamanhos diferentes ({len(reference)} vs {len(candidate)})"]
+        return [d for i, (a, b) in enumerate(zip(reference, candidate)) for d in compare_values(a, b, f"{path}[{i}]")]
+    if reference is None or candidate is None:
+        return [] if reference is candidate else [f"{path}: {reference!r} vs {candidate!r}"]
+    if isinstance(reference, (int, float, np.number)) and isinstance(candidate, (int, float, np.number)) and not isinstance(reference, bool):
+        if pd.isna(reference) and pd.isna(candidate):
+            return []
+        if math.isclose(float(reference), float(candidate), rel_tol=1e-9, abs_tol=1e-9):
+            return []
+        return [f"{path}: {reference!r} vs {candidate!r}"]
+    if pd.api.types.is_scalar(reference) and pd.isna(reference) and pd.api.types.is_scalar(candidate) and pd.isna(candidate):
+        return []
+    return [] if reference == candidate else [f"{path}: {reference!r} vs {candidate!r}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara os KPIs da lógica de referência com motores alternativos.")
+    parser.add_argument('--motor', action='append', default=None, help="Motor alternativo (repetível). Padrão: todos exceto a referência.")
+    parser.add_argument('--datasets', type=int, default=5, help="Quantidade de conjuntos de dados sintéticos.")
+    parser.add_argument('--linhas', type=int, default=20_000, help="Linhas de churn por conjunto sintético.")
+    parser.add_argument('--selecoes', type=int, default=40, help="Combinações de filtros sorteadas por conjunto.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dados-reais', action='store_true', help="Inclui o conjunto de dados padrão do painel.")
+    args = parser.parse_args()
+
+    engine_names = args.motor or [name for name in ENGINES if name != 'referencia']
+    engines = {name: resolve_engine(name) for name in ['referencia'] + engine_names}
+    rng = np.random.default_rng(args.seed)
+
+    datasets = []
+    if args.dados_reais:
+        df_churn, df_active, df_backlog, _ = dc.load_and_transform_data(dc.data_dir, dc.file_2024, dc.file_2025, dc.file_active_base, dc.file_backlog_churn)
+        datasets.append(('dados reais', df_churn, df_active, df_backlog))
+    for i in range(args.datasets):
+        datasets.append((f"sintético {i + 1}", *make_synthetic_dataset(rng, args.linhas)))
+
+    timings = {name: 0.0 for name in engines}
+    calls = 0
+    failures = 0
+    for dataset_label, df_churn, df_active, df_backlog in datasets:
+        df_forecasts = dc.fit_churn_forecasts(df_churn, f"verificacao-{args.seed}-{dataset_label}")
+        filter_options = dc.get_filter_options(df_churn)
+        prepared = {}
+        for name, prepare in engines.items():
+            start = time.perf_counter()
+            prepared[name] = prepare(df_churn, df_active, df_backlog, df_forecasts)
+            timings[name] += time.perf_counter() - start
+
+        for _ in range(args.selecoes):
+            selection = random_selection(rng, filter_options)
+            outputs = {}
+            for name, compute in prepared.items():
+                start = time.perf_counter()
+                outputs[name] = compute(selection)
+                timings[name] += time.perf_counter() - start
+            calls += 1
+            for name in engine_names:
+                differences = compare_values(outputs['referencia'], outputs[name])
+                if differences:
+                    failures += 1
+                    print(f"[DIVERGÊNCIA] {dataset_label} / motor '{name}' / seleção {dc.selection_key(selection)}")
+                    for difference in differences[:10]:
+                        print(f"    {difference}")
+
+    print(f"\n{len(datasets)} conjuntos, {calls} seleções por motor.")
+    for name, total in timings.items():
+        speedup = timings['referencia'] / total if total > 0 else float('inf')
+        print(f"  {name:<20} {total:8.2f}s  {1000 * total / max(calls, 1):8.1f} ms/seleção  {speedup:5.2f}x")
+    if failures:
+        print(f"\n{failures} comparações divergentes.")
+        sys.exit(1)
+    print("\nTodos os motores reproduzem a referência.")
+
+
+if __name__ == "__main__":
+    main()